@@ -10,27 +10,79 @@
 # pip3 install minimalmodbus
 
 import minimalmodbus
-import serial
 import sys, os, io
 import time 
+from sampleSink import openPromFile
+from energyCounter import EnergyIntegrator
+from rs485Bus import getBus, CONFIG
+from promState import writeStateSet, InfoFile
 
 debug = False
 sleepTime = 10
-devName = '/dev/ttyUSB0'
-
-if (len(sys.argv) > 1):
+devName = '/dev/ttyUSB0'  # or a by-id link / usb:VID:PID:SERIAL, see deviceManager.py
+slaveId = 1               # other slaves (power meters) may share the RS485 line, see rs485Bus.py
+
+# Wh counters for PV and load, the dashboards use increase() on them. Keep the state file off /ramdisk.
+energyState = '/var/lib/solarshed/Renogy_energy.json'
+integrator = EnergyIntegrator(energyState, maxGap=3 * sleepTime + 30)
+
+# set a directory (e.g. '/home/pi/tsdb') to keep every reading in the local time-series store
+storeDir = None
+sinks = []
+if (storeDir):
+        from tsStore import TSStore     # only loaded when used, keeps the start fast
+        sinks.append(TSStore(storeDir, writer="Renogy"))
+
+# set an URL (e.g. 'http://prometheus:9090/api/v1/write') to push the readings with remote-write
+remoteWriteUrl = None
+if (remoteWriteUrl):
+        from remoteWrite import RemoteWriter
+        sinks.append(RemoteWriter(remoteWriteUrl, queueDir="/var/spool/solarshed/Renogy"))
+
+# set a rules file (e.g. '/home/pi/alertRules.json') to check every reading against local alert rules
+alertRules = None
+if (alertRules):
+        from alertEngine import AlertEngine
+        sinks.append(AlertEngine(alertRules))
+
+# set a broker (e.g. 'localhost' or 'mqtt.local:1883') to publish the changed values over MQTT, see mqttSink.py
+mqttBroker = None
+if (mqttBroker):
+        from mqttSink import MqttSink
+        sinks.append(MqttSink(mqttBroker))
+
+# set a port (e.g. 8086) to serve every reading as a live event stream (SSE), see liveStream.py
+livePort = None
+if (livePort):
+        from liveStream import LiveStream
+        sinks.append(LiveStream(livePort))
+
+# set a directory (e.g. '/home/pi/recordings') to record every Modbus frame, see serialRecorder.py
+recordDir = None
+
+if (__name__ == "__main__" and len(sys.argv) > 1):     # not when snapshotTick.py imports it
         if (sys.argv[1] == "-d"):
                 debug=True
                 sleepTime = 2
                 print("sys.argv[0]: Debug: enabled")
 
-renogy = minimalmodbus.Instrument(devName, 1)
-renogy.serial.baudrate = 9600
-renogy.serial.bytesize = 8
-renogy.serial.parity   = serial.PARITY_NONE
-renogy.serial.stopbits = 1
-renogy.serial.timeout = 2
-renogy.debug = debug
+# the bus owner opens the port (and reopens it after a USB re-enumeration) and keeps the
+# frames apart from other slaves and scripts on the same line. Live values go first,
+# settings (0xE0xx) are read with CONFIG priority.
+bus = getBus(devName, baudrate=9600, timeout=2, recordDir=recordDir, debug=debug)
+renogy = bus.instrument(slaveId)
+renogyConfig = bus.instrument(slaveId, CONFIG)
+
+# the days of the history table (0xF000...) that are not cached yet, read at the start and when
+# upDays moves on, exported to /ramdisk/Renogy_history.prom. None: not read. See renogyHistory.py
+# Off until the register map of the table is verified on a controller, then set it to
+# '/var/lib/solarshed/Renogy_history.json'
+historyCache = None
+historyDays = 30
+history = None
+if (historyCache):
+        from renogyHistory import RenogyHistory
+        history = RenogyHistory(renogyConfig, historyCache, '/ramdisk/Renogy_history.prom', historyDays, sinks, debug=debug)
 
 BATTERY_TYPE = {
     1: 'open',
@@ -50,6 +102,8 @@ CHARGING_STATE = {
     6: 'current limiting'
 }
 
+infoFile = InfoFile('/ramdisk/Renogy_info.prom')     # battery type, see promState.py
+
 if (debug): print(minimalmodbus._get_diagnostic_string())
 
 if (debug):
@@ -72,6 +126,7 @@ def readRenogy(fileObj):
                         if (debug): print("max discharge:", float(maxD), "a")
                         if (debug): print("sys type:", prodType, "00=controller 1=inverter")
 
+                renogy.prefetch([(0x100, 0x21)])       # 0x100..0x120 in one frame, the reads below use it
                 register = renogy.read_register(0x100)
                 if (debug): print("Battery SOC:", float(register), "%")
                 valName  = "mode=\"SOC\""
@@ -89,6 +144,11 @@ def readRenogy(fileObj):
 
                 register = renogy.read_register(0x102)
                 if (debug): print("Charging Amps:", float(register/100), "a")
+                chgWatts = batVolts * register / 100
+                valName  = "mode=\"chgWatts\""
+                valName  = "{" + valName + "}"
+                dataStr  = f"Renogy{valName} {chgWatts:.1f}"
+                print(dataStr, file=fileObj)
 
                 if (False):     # for chargers with remote temp sensors
                         register = renogy.read_register(0x103)
@@ -116,6 +176,14 @@ def readRenogy(fileObj):
                 dataStr  = f"Renogy{valName} {loadWatts}"
                 print(dataStr, file=fileObj)
 
+                # net battery flow, positive: battery is charging
+                netWatts = chgWatts - loadWatts
+                if (debug): print("Net battery watts:", netWatts, "w")
+                valName  = "mode=\"netWatts\""
+                valName  = "{" + valName + "}"
+                dataStr  = f"Renogy{valName} {netWatts:.1f}"
+                print(dataStr, file=fileObj)
+
                 register = renogy.read_register(0x107)
                 if (debug): print("PV volts:", float(register/10), "v")
                 valName  = "mode=\"pvVolts\""
@@ -137,6 +205,9 @@ def readRenogy(fileObj):
                 dataStr  = f"Renogy{valName} {pvWatts}"
                 print(dataStr, file=fileObj)
 
+                integrator.update("pvWatts", pvWatts, "pvWh")
+                integrator.update("loadWatts", loadWatts, "loadWh")
+
                 register = renogy.read_register(0x10B)
                 if (debug): print("bat max volts:", float(register)/10, "v")
                 valName  = "mode=\"maxBatV\""
@@ -170,18 +241,20 @@ def readRenogy(fileObj):
                 chargeStateStr = CHARGING_STATE.get(chargeStateNum)
                 if (debug): print("Charge state:", chargeStateNum, chargeStateStr)
                 valName  = "mode=\"chargeState\""
-                valName  = "{" + valName + ", myStr=\"" + chargeStateStr + "\"}"
+                valName  = "{" + valName + "}"
                 dataStr  = f"Renogy{valName} {chargeStateNum}"
                 print(dataStr, file=fileObj)
+                writeStateSet(fileObj, "Renogy_state", "chargeState", chargeStateStr, CHARGING_STATE.values())
 
 
-                register = renogy.read_register(0xE004)
+                register = renogyConfig.read_register(0xE004)
                 batTypeStr = BATTERY_TYPE.get(register)
                 if (debug): print("Bat Type:", batTypeStr)
                 valName  = "mode=\"batType\""
-                valName  = "{" + valName + ", myStr=\"" + batTypeStr + "\"}"
+                valName  = "{" + valName + "}"
                 dataStr  = f"Renogy{valName} {register}"
                 print(dataStr, file=fileObj)
+                infoFile.set("Renogy_info", batType=batTypeStr)      # file only written when it changed
 
 
                 register = renogy.read_register(0x113)
@@ -204,6 +277,7 @@ def readRenogy(fileObj):
                 valName  = "{" + valName + "}"
                 dataStr  = f"Renogy{valName} {register}"
                 print(dataStr, file=fileObj)
+                if (history): history.sync(register)   # only reads when a day was finished
 
                 register = renogy.read_register(0x117)
                 if (debug): print("battery full cnt:", register, "#")
@@ -259,20 +333,32 @@ def readRenogy(fileObj):
         except IOError:
                 print("Failed to read from instrument")
 
-# Run the function to read the power meter.
+# read the controller and write the Renogy lines, also used by snapshotTick.py
+def pollRenogy(fileObj):
+        if (debug): print("\nReading Renogy Wanderer data...")
+        readRenogy(fileObj)
+        integrator.write(fileObj, "Renogy_energy")
 
-while True:
-        if (debug): print("Opened new tmp file /ramdisk/Renogy.prom.tmp")
-        file_object = open('/ramdisk/Renogy.prom.tmp', mode='w')
+################ main ##################
 
-        # write data here
+if __name__ == "__main__":
+        import profHooks
+        profHooks.install("RenogyWanderer", debug=debug)      # kill -USR1 / profHooks.py: profile the running loop
+        stages = profHooks.stageTimer("Renogy")
+        while True:
+                if (debug): print("Opened new tmp file /ramdisk/Renogy.prom.tmp")
+                stages.begin()
+                file_object = openPromFile('/ramdisk/Renogy.prom.tmp', sinks)
 
-        if (debug): print("\nReading Renogy Wanderer data...")
-        readRenogy(file_object)
+                # write data here
+                pollRenogy(file_object)
+                stages.mark("poll")
+
+                file_object.flush()
+                file_object.close()
+                outLine = os.system('/bin/mv /ramdisk/Renogy.prom.tmp /ramdisk/Renogy.prom')
+                stages.mark("publish")
 
-        file_object.flush()
-        file_object.close()
-        outLine = os.system('/bin/mv /ramdisk/Renogy.prom.tmp /ramdisk/Renogy.prom')
+                time.sleep(sleepTime)
 
-        time.sleep(sleepTime)
-        
+# End.
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# alertEngine.py
+# Description: local alert rules, evaluated in the collectors on every decoded value.
+#
+# Scrape -> rule evaluation -> Alertmanager takes a minute, too long for a cell over
+# voltage. The engine is a sink (see sampleSink.py): every sample the collector writes
+# is checked against the rules right away and events go to local hooks.
+#
+# Rules file (JSON), see alertRules.example.json:
+#   "rules": [{
+#       "name":   "cellOverVoltage",
+#       "metric": "BMS_*",                      # shell style pattern on the metric name
+#       "labels": {"mode": "CellNum[0-9]*",     # ... and on labels (not CellNumImp*)
+#                  "stat": ""},                 # "" = without this label (not the _agg series)
+#       "above":  3.65,                         # or "below", "equals", "changes": true
+#       "clear":  3.55,                         # hysteresis, resolved only below 3.55
+#       "for":    0.5,                          # must hold 0.5 s before it fires (debounce)
+#       "repeat": 300,                          # notify again every 300 s while active
+#       "hooks":  ["log", "relay"]
+#   }]
+#   "changes" rules fire on every change of the value (state transitions, e.g. modeInt),
+#   optional "from" / "to" values, "for" is then the minimum time between two events.
+#
+#   "hooks": {
+#       "log":   {"type": "script", "command": ["/usr/bin/logger", "-t", "solarshed"]},
+#       "relay": {"type": "gpio", "path": "/sys/class/gpio/gpio17/value"},
+#       "web":   {"type": "webhook", "url": "http://localhost:8080/alert"}
+#   }
+#   script:  command + the event as arguments (name, state, series, value), also in
+#            the environment as ALERT_NAME, ALERT_STATE, ALERT_SERIES, ALERT_VALUE
+#   gpio:    writes 1 when firing and 0 when the last series of the rules on this relay is
+#            resolved, any file works as a stand-in; never dropped, a full queue only
+#            coalesces the writes to the latest state
+#   webhook: POST of the event as JSON
+# The hooks run in their own thread, a slow webhook never blocks the serial reader.
+#
+# Shell collectors: alertEngine.py RULES -s STATEFILE FILE.prom checks a .prom file once,
+# the state file keeps debounce and transitions between two runs.
+
+import os, json, time, queue, fnmatch, threading, subprocess
+from argparse import ArgumentParser
+from sampleSink import splitSeries, parsePromLine
+
+class AlertRule:
+        def __init__(self, spec):
+                self.name     = spec["name"]
+                self.metric   = spec.get("metric", "*")
+                self.labels   = spec.get("labels", {})
+                self.severity = spec.get("severity", "warning")
+                self.forSec   = float(spec.get("for", 0))
+                self.repeat   = spec.get("repeat")
+                self.hooks    = spec.get("hooks", ["log"])
+                self.changes  = bool(spec.get("changes", False))
+                self.fromVal  = spec.get("from")
+                self.toVal    = spec.get("to")
+                self.op       = None
+                for op in ("above", "below", "equals", "notEquals"):
+                        if (op in spec):
+                                self.op, self.threshold = op, float(spec[op])
+                self.clear    = float(spec["clear"]) if "clear" in spec else None
+                if (self.op is None and not self.changes):
+                        raise ValueError(f"rule {self.name}: needs above, below, equals, notEquals or changes")
+
+        def matches(self, metric, labels):
+                if (not fnmatch.fnmatchcase(metric, self.metric)): return(False)
+                for name, pattern in self.labels.items():
+                        if (not fnmatch.fnmatchcase(labels.get(name, ""), str(pattern))): return(False)
+                return(True)
+
+        # is the condition true? active: already firing, then the clear level counts
+        def check(self, value, active):
+                if (self.op == "above"):
+                        return(value > (self.clear if (active and self.clear is not None) else self.threshold))
+                if (self.op == "below"):
+                        return(value < (self.clear if (active and self.clear is not None) else self.threshold))
+                if (self.op == "equals"):
+                        return(value == self.threshold)
+                return(value != self.threshold)
+
+class AlertEngine:
+        def __init__(self, rules, clock=time.monotonic, wallClock=time.time, debug=False):
+                if (isinstance(rules, str)):
+                        with open(rules, mode='r') as fileObj:
+                                rules = json.load(fileObj)
+                self.rules     = [AlertRule(spec) for spec in rules.get("rules", [])]
+                self.ruleHooks = {rule.name: rule.hooks for rule in self.rules}
+                self.hooks     = rules.get("hooks", {})
+                self.clock     = clock
+                self.wallClock = wallClock
+                self.debug     = debug
+                self.matchCache = {}    # series -> matching rules, most series match none
+                self.states    = {}     # (rule, series) -> [pendingSince, active, lastNotify, lastValue]
+                self.lock      = threading.Lock()
+                self.events    = queue.Queue(maxsize=1000)
+                self.relays    = {}     # gpio hook -> "1" / "0" still to write, only the latest
+                self.relayLock = threading.Lock()
+                self.fired     = 0
+                self.dropped   = 0
+                self.worker    = threading.Thread(target=self.runHooks, name="alertEngine", daemon=True)
+                self.worker.start()
+                for rule in self.rules:
+                        for hook in rule.hooks:
+                                if (hook not in self.hooks and hook != "log"):
+                                        print("Alert rule", rule.name, "uses unknown hook", hook)
+
+        def rulesFor(self, series):
+                rules = self.matchCache.get(series)
+                if (rules is None):
+                        metric, labels = splitSeries(series)
+                        labels = dict(labels)
+                        rules = [r for r in self.rules if r.matches(metric, labels)]
+                        self.matchCache[series] = rules
+                return(rules)
+
+        # sink interface
+        def append(self, series, value, ts):
+                rules = self.rulesFor(series)
+                if (not rules): return
+                now = self.clock()
+                with self.lock:
+                        for rule in rules:
+                                self.evaluate(rule, series, value, now)
+
+        def commit(self, ts):
+                pass
+
+        def evaluate(self, rule, series, value, now):
+                key = (rule.name, series)
+                state = self.states.get(key)
+                if (state is None):
+                        state = self.states[key] = [None, False, None, None]
+                pendingSince, active, lastNotify, lastValue = state
+                state[3] = value
+
+                if (rule.changes):
+                        if (lastValue is None or value == lastValue): return
+                        if (rule.fromVal is not None and lastValue != rule.fromVal): return
+                        if (rule.toVal is not None and value != rule.toVal): return
+                        if (lastNotify is not None and now - lastNotify < rule.forSec): return
+                        state[2] = now
+                        self.fire(rule, series, value, "changed", lastValue)
+                        return
+
+                if (rule.check(value, active)):
+                        if (not active):
+                                if (pendingSince is None): state[0] = pendingSince = now
+                                if (now - pendingSince >= rule.forSec):
+                                        state[1] = True
+                                        state[2] = now
+                                        self.fire(rule, series, value, "firing", lastValue)
+                        elif (rule.repeat and now - lastNotify >= rule.repeat):
+                                state[2] = now
+                                self.fire(rule, series, value, "firing", lastValue)
+                else:
+                        state[0] = None
+                        if (active):
+                                state[1] = False
+                                self.fire(rule, series, value, "resolved", lastValue)
+
+        def fire(self, rule, series, value, stateName, previous):
+                event = {"name": rule.name, "severity": rule.severity, "state": stateName, "series": series,
+                         "value": value, "previous": previous, "time": self.wallClock()}
+                self.fired += 1
+                if (self.debug): print("Alert:", event)
+                for hook in rule.hooks:
+                        if (self.hooks.get(hook, {}).get("type") == "gpio"):
+                                if (stateName not in ("firing", "resolved")): continue
+                                with self.relayLock:
+                                        self.relays[hook] = "1" if self.hookActive(hook) else "0"
+                                event = None    # only wakes the worker, it writes the latest state
+                        try:
+                                self.events.put_nowait((hook, event))
+                        except queue.Full:
+                                if (event is not None): self.dropped += 1       # a relay is written after the current event
+
+        # any series of any rule on this hook still firing, called with the lock held
+        def hookActive(self, hook):
+                return(any(state[1] for (name, series), state in self.states.items() if hook in self.ruleHooks.get(name, ())))
+
+        def writeRelays(self):
+                with self.relayLock:
+                        relays, self.relays = self.relays, {}
+                for hook, value in relays.items():
+                        try:
+                                with open(self.hooks[hook]["path"], mode='w') as fileObj:
+                                        fileObj.write(value)
+                        except OSError as err:
+                                print("Alert hook", hook, "failed:", err)
+
+        def runHooks(self):
+                while True:
+                        item = self.events.get()
+                        if (item is None):
+                                self.writeRelays()
+                                self.events.task_done()
+                                return
+                        try:
+                                if (item[1] is not None): self.runHook(*item)
+                        except Exception as err:
+                                print("Alert hook", item[0], "failed:", err)
+                        self.writeRelays()
+                        self.events.task_done()
+
+        def runHook(self, hookName, event):
+                hook = self.hooks.get(hookName, {"type": "log"} if hookName == "log" else None)
+                if (hook is None): return
+                kind = hook.get("type", "log")
+                if (kind == "log"):
+                        print(time.strftime("%Y-%m-%d %H:%M:%S"), "ALERT", event["name"], event["state"], event["series"], event["value"])
+                elif (kind == "script"):
+                        env = dict(os.environ, ALERT_NAME=event["name"], ALERT_STATE=event["state"],
+                                   ALERT_SERIES=event["series"], ALERT_VALUE=str(event["value"]),
+                                   ALERT_SEVERITY=event["severity"])
+                        subprocess.run(list(hook["command"]) + [event["name"], event["state"], event["series"], str(event["value"])],
+                                       env=env, timeout=hook.get("timeout", 10))
+                elif (kind == "gpio"):
+                        if (event["state"] in ("firing", "resolved")):
+                                with open(hook["path"], mode='w') as fileObj:
+                                        fileObj.write("1" if event["state"] == "firing" else "0")
+                elif (kind == "webhook"):
+                        import urllib.request
+                        request = urllib.request.Request(hook["url"], data=json.dumps(event).encode(),
+                                                         headers={"Content-Type": "application/json"}, method="POST")
+                        urllib.request.urlopen(request, timeout=hook.get("timeout", 5)).close()
+                else:
+                        print("Unknown alert hook type:", kind)
+
+        # state between two runs of the command line check (wall clock times)
+        def loadState(self, fileName):
+                try:
+                        with open(fileName, mode='r') as fileObj:
+                                for item in json.load(fileObj):
+                                        self.states[(item[0], item[1])] = item[2]
+                except (OSError, ValueError):
+                        pass
+
+        def saveState(self, fileName):
+                tmpName = fileName + ".tmp"
+                with open(tmpName, mode='w') as fileObj:
+                        json.dump([[k[0], k[1], v] for k, v in self.states.items()], fileObj)
+                os.replace(tmpName, fileName)
+
+        # wait until the hooks ran, then stop the worker
+        def close(self):
+                if (not self.worker.is_alive()): return
+                self.events.put(None)
+                self.worker.join(timeout=30)
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Check .prom files against local alert rules")
+        parser.add_argument("rules", help="rules file (JSON), see alertRules.example.json")
+        parser.add_argument("files", nargs="*", help=".prom files to check")
+        parser.add_argument("-s", "--state", help="state file, keeps debounce and transitions between runs")
+        parser.add_argument("-t", "--test", metavar="HOOK", help="send a test event to this hook and exit")
+        parser.add_argument("-D", "--debug", action="store_true", help="print every event")
+        args = parser.parse_intermixed_args()
+
+        engine = AlertEngine(args.rules, clock=time.time, debug=args.debug)
+        if (args.test):
+                engine.events.put((args.test, {"name": "test", "severity": "info", "state": "firing",
+                                               "series": "test", "value": 1, "previous": None, "time": time.time()}))
+        else:
+                if (args.state): engine.loadState(args.state)
+                for fileName in args.files:
+                        try:
+                                with open(fileName, mode='r') as fileObj:
+                                        for line in fileObj:
+                                                sample = parsePromLine(line)
+                                                if (sample is not None): engine.append(sample[0], sample[1], None)
+                        except OSError as err:
+                                print("Cannot read", fileName, err)
+                if (args.state): engine.saveState(args.state)
+        engine.close()
+
+# End.
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# backfill.py
+# Description: turn recorded device data into timestamped OpenMetrics for
+# promtool tsdb create-blocks-from openmetrics, to fill the gaps of an outage.
+#
+# The .prom files in /ramdisk only hold the latest snapshot, Prometheus can't fetch what
+# it missed while the shed was offline. What was kept meanwhile can be backfilled:
+#  - a local store directory (tsStore.py, -S of the collectors)
+#  - a recording of serialRecorder.py (.ssr / .ssr.zst, -r of getChargeryData.py): the BMS
+#    bytes of every channel BMS_<pack> are decoded again, with the time they came in
+#  - a raw capture with one hex line per read (like doc/raw_imp.txt): decoded like a
+#    recording, the lines have no time, they are --interval seconds apart and the last
+#    one is at the time of the file (or --first for the first one)
+#  - the daily history cache of the Renogy controller (renogyHistory.py, .json): one
+#    sample of Renogy_daily{mode="genWh"} (and the other fields) at the end of every day
+# The decoded values are the ones of the BMS_<pack>_sys/_imp files with the derived values,
+# without the window rollups and the energy counters (they count from the live state).
+#
+# Streams in constant memory: the samples go to one spool file per metric family, at the
+# end the spools are copied into the output one after the other (OpenMetrics wants the
+# families in one piece). In memory is only the series name -> OpenMetrics name map and
+# the last timestamp per series: samples that don't move forward in time are dropped,
+# promtool refuses duplicates. The spool directory is next to the output file, keep it
+# off /ramdisk for days of data.
+#
+# Usage: backfill.py SOURCE... [-o backfill.om] [-s START] [-e END] [-m PREFIX] [-c 16] [-P V126]
+#        promtool tsdb create-blocks-from openmetrics backfill.om /var/lib/prometheus/metrics2
+
+import os, sys, time, shutil, tempfile, binascii
+from argparse import ArgumentParser, Namespace
+from sampleSink import SinkFile, splitSeries
+
+debug = False
+
+def escapeLabel(value):
+        return(value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+
+# BMS_A{mode="SOC", pack="A"} -> BMS_A{mode="SOC",pack="A"}, OpenMetrics allows no blanks
+def openMetricsName(series):
+        metric, labels = splitSeries(series)
+        if (not labels): return(metric, metric)
+        return(metric, metric + "{" + ",".join(f"{name}=\"{escapeLabel(value)}\"" for name, value in labels) + "}")
+
+# one spool file per metric family, also a sink (append/commit/close) for the decoders
+class FamilySpool:
+        def __init__(self, directory, start=None, end=None, match=None):
+                self.directory = directory
+                self.start     = start      # ms, samples outside are left out
+                self.end       = end
+                self.match     = match
+                self.files     = {}         # metric -> spool file
+                self.series    = {}         # series -> [spool file, OpenMetrics name, last ts ms], None: not wanted
+                self.samples   = 0
+                self.dropped   = 0          # not after the last sample of their series
+
+        def add(self, series, value, tsMs):
+                entry = self.series.get(series, False)
+                if (entry is False):
+                        entry = self.series[series] = self.newSeries(series)
+                if (entry is None): return
+                if (tsMs <= entry[2] or value != value):        # duplicate, back in time or NaN
+                        self.dropped += 1
+                        return
+                if ((self.start is not None and tsMs < self.start) or (self.end is not None and tsMs > self.end)): return
+                entry[2] = tsMs
+                entry[0].write(f"{entry[1]} {value!r} {tsMs / 1000:.3f}\n")
+                self.samples += 1
+
+        def newSeries(self, series):
+                if (self.match is not None and not series.startswith(self.match)): return(None)
+                metric, name = openMetricsName(series)
+                fileObj = self.files.get(metric)
+                if (fileObj is None):
+                        fileObj = self.files[metric] = open(os.path.join(self.directory, f"{len(self.files):04d}.om"),
+                                                            mode='w', buffering=1 << 20)
+                return([fileObj, name, -1])
+
+        # sink interface, ts in seconds
+        def append(self, series, value, ts):
+                self.add(series, value, int(ts * 1000))
+
+        def commit(self, ts):
+                pass
+
+        def close(self):
+                pass
+
+        # the families one after the other, then the end marker
+        def writeTo(self, out):
+                for metric in sorted(self.files):
+                        fileObj = self.files[metric]
+                        fileObj.close()
+                        with open(fileObj.name, mode='r') as spool:
+                                shutil.copyfileobj(spool, out, 1 << 20)
+                        os.remove(fileObj.name)
+                out.write("# EOF\n")
+                self.files = {}
+
+############ sources ############
+
+def readStore(path, spool):
+        from tsStore import TSStore
+        store = TSStore(path, writer="backfill", retentionDays=0)
+        start = spool.start or 0
+        for fileName in store.segments():
+                if (debug): print("Reading", fileName, file=sys.stderr)
+                for name, ts, value in store.scanFile(os.path.join(path, fileName), None, start, spool.end):
+                        spool.add(name, value, ts)
+
+# decodes the BMS stream of one pack into the spool, with the time of the bytes
+class PackDecoder:
+        def __init__(self, name, cellCount, protocol, spool):
+                import getChargeryData
+                from deviceManager import DeviceManager
+                from energyCounter import EnergyIntegrator
+                self.bms  = getChargeryData
+                # no state files: the counters and estimates of the replay are thrown away
+                args = Namespace(window=15, store=None, remote_write=None, energy_state="", health_state="")
+                self.pack = getChargeryData.ChargeryPack(name, "backfill", cellCount, args, DeviceManager(pollInterval=3600), protocol)
+                self.pack.integrator = EnergyIntegrator(maxGap=0)      # integrates nothing, no efficiency from a replay
+                self.now  = 0.0
+                self.out  = SinkFile(None, [spool], clock=lambda: self.now)
+
+        def feed(self, data, ts):
+                bms, pack = self.bms, self.pack
+                self.now = ts
+                for frame in pack.reassembler.feed(data):
+                        hexLine = binascii.hexlify(frame).decode()
+                        if (frame[2] == 0x56):
+                                bms.getCellData(pack, self.out, hexLine, frame[3])
+                        elif (frame[2] == 0x57):
+                                if (not bms.getSysData(pack, self.out, hexLine, frame[3])):
+                                        bms.writeDerived(pack, self.out)
+                        elif (frame[2] == 0x58):
+                                bms.getCellImpedance(pack, self.out, hexLine, frame[3])
+
+def readRecording(fileName, spool, cellCount, protocol, channel=None):
+        from serialRecorder import RecordingReader, RX
+        reader = RecordingReader(fileName)
+        decoders = {}
+        for ts, name, kind, payload in reader.records(channel=channel, kinds=(RX,)):
+                decoder = decoders.get(name)
+                if (decoder is None):
+                        if (channel is None and not name.startswith("BMS_")): continue      # Modbus traffic, no register map here
+                        decoder = decoders[name] = PackDecoder(name[4:] if name.startswith("BMS_") else name, cellCount, protocol, spool)
+                decoder.feed(payload, reader.wallTime(ts))
+        reader.close()
+
+def readHistory(fileName, spool):
+        from renogyHistory import dailySamples
+        for ts, field, value in dailySamples(fileName):
+                spool.append(f"Renogy_daily{{mode=\"{field}\"}}", value, ts)
+
+def readHexCapture(fileName, spool, cellCount, protocol, pack, interval, start=None):
+        with open(fileName, mode='r') as fileObj:
+                lines = sum(1 for line in fileObj if line.strip())
+        if (start is None): start = os.path.getmtime(fileName) - (lines - 1) * interval
+        decoder = PackDecoder(pack, cellCount, protocol, spool)
+        n = 0
+        with open(fileName, mode='r') as fileObj:
+                for line in fileObj:
+                        line = line.strip()
+                        if (not line): continue
+                        try:
+                                data = binascii.unhexlify(line)
+                        except binascii.Error:
+                                if (debug): print("Not hex:", line[:40], file=sys.stderr)
+                                continue
+                        decoder.feed(data, start + n * interval)
+                        n += 1
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Export recorded data as OpenMetrics for promtool tsdb create-blocks-from openmetrics")
+        parser.add_argument("sources", nargs="+", help="store directory, recording (.ssr, .ssr.zst), Renogy history (.json) or hex capture (one line per read)")
+        parser.add_argument("-o", "--output", default="-", help="OpenMetrics file (default: stdout)")
+        parser.add_argument("-s", "--start", type=float, help="only samples from this unix time on", default=None)
+        parser.add_argument("-e", "--end", type=float, help="only samples up to this unix time", default=None)
+        parser.add_argument("-m", "--match", type=str, help="only series starting with this prefix", default=None)
+        parser.add_argument("-c", "--cells", type=int, help="cells of the BMS packs (default 16)", default=16)
+        parser.add_argument("-P", "--protocol", choices=["V121", "V122", "V124", "V125", "V126"], default="V126",
+                            help="BMS protocol version (default V126)")
+        parser.add_argument("-n", "--name", default="A", help="pack name of a hex capture (default A)")
+        parser.add_argument("-C", "--channel", help="only this channel of a recording (e.g. BMS_A)")
+        parser.add_argument("-i", "--interval", type=float, default=1.0, help="seconds between the lines of a hex capture (default 1)")
+        parser.add_argument("--first", type=float, help="unix time of the first line of a hex capture (default: the last line is the file time)")
+        parser.add_argument("-D", "--debug", action="store_true", help="Enable Debug and above (i.e. all) messages")
+        args = parser.parse_args()
+        debug = args.debug
+
+        spoolDir = os.path.dirname(os.path.abspath(args.output)) if (args.output != "-") else None
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory(prefix="backfill", dir=spoolDir) as directory:
+                spool = FamilySpool(directory, int(args.start * 1000) if (args.start is not None) else None,
+                                    int(args.end * 1000) if (args.end is not None) else None, args.match)
+                for source in args.sources:
+                        if (os.path.isdir(source)):
+                                readStore(source, spool)
+                        elif (".ssr" in os.path.basename(source)):
+                                readRecording(source, spool, args.cells, args.protocol, args.channel)
+                        elif (source.endswith(".json")):
+                                readHistory(source, spool)
+                        else:
+                                readHexCapture(source, spool, args.cells, args.protocol, args.name, args.interval, args.first)
+                if (args.output == "-"):
+                        spool.writeTo(sys.stdout)
+                else:
+                        with open(args.output + ".tmp", mode='w') as out:
+                                spool.writeTo(out)
+                        os.replace(args.output + ".tmp", args.output)
+        seconds = time.monotonic() - started
+        print(f"{spool.samples} samples of {len(spool.series)} series in {seconds:.1f} s "
+              f"({spool.samples / max(seconds, 1e-3) * 60 / 1e6:.1f} M/min), {spool.dropped} dropped", file=sys.stderr)
+
+# End.
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# cellHealth.py
+# Description: streaming cell health estimator for the Chargery BMS, fed with every
+# impedance (0x58) and cell block (0x56) the collector decodes.
+#
+# Trends over months would need long range PromQL, far too slow on a Pi. Here every
+# sample costs O(1) and the state is a few numbers per cell:
+#  - impedance per cell: EWMA (the trend) and its exponentially weighted variance
+#    (outlier check), seeded with the Welford variance of the first baseSamples samples.
+#    A sample further than outlierSigma from the trend is dropped, shiftSamples outliers
+#    in a row are a new level (new cell connector, recalibrated BMS) and the trend jumps.
+#    The BMS repeats its last measurement in every 0x58 frame, only a changed value of a
+#    cell is a new sample; sigma is at least minSigma (the 0.1 mOhm step of the BMS).
+#    The first baseSamples samples give the baseline of the cell, afterwards it is frozen.
+#  - health score per cell: 100 % at the baseline impedance, 0 % when it has doubled
+#    (common end of life criterion), the pack score is the weakest cell.
+#  - capacity: the BMS reports the remaining capacity_ah / capacity_wh. Between a full
+#    battery (SOC >= fullSoc) and the lowest SOC of the discharge, the used Ah over the
+#    SOC swing give the full capacity. Swings of at least minSwing % are averaged (EWMA),
+#    the first swings give the baseline, capacityFade is the loss against it.
+#  - cycles: equivalent full cycles (sum of the SOC swings / 100)
+# The state is saved to a JSON file every saveInterval seconds and at exit, like the
+# energy counters. Don't put the state file on /ramdisk, it is gone after a reboot.
+#
+# Output example (metric BMS_A_health):
+# BMS_A_health{mode="CellNumHealth3", pack="A"} 96.2
+# BMS_A_health{mode="capacityFade", pack="A"} 3.1
+#
+# python3 cellHealth.py /var/lib/solarshed/BMS_A_health.json    # print the saved estimates
+
+import os, sys, json, math, time, atexit
+
+class CellStats:
+        __slots__ = ("ewma", "count", "mean", "m2", "base", "baseCount", "outliers", "var", "streak", "last")
+
+        def __init__(self, state=None):
+                self.ewma, self.count, self.mean, self.m2, self.base, self.baseCount, self.outliers = \
+                        state[:7] if state else (None, 0, 0.0, 0.0, 0.0, 0, 0)
+                # state files before the EWMA variance: start it from the Welford variance
+                self.var, self.streak = state[7:9] if (state and len(state) >= 9) else (self.stddev() ** 2, 0)
+                self.last = None                # last value of the BMS, repeated until it measures again
+
+        def state(self):
+                return([self.ewma, self.count, self.mean, self.m2, self.base, self.baseCount, self.outliers,
+                        self.var, self.streak])
+
+        def stddev(self):
+                return(math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0)
+
+class CellHealth:
+        def __init__(self, stateFile=None, alpha=0.05, baseSamples=20, outlierSigma=5.0, shiftSamples=10, minSigma=0.1,
+                     fullSoc=95, minSwing=40, capAlpha=0.2, baseSwings=3, saveInterval=300, clock=time.monotonic):
+                self.stateFile    = stateFile
+                self.alpha        = alpha
+                self.baseSamples  = baseSamples
+                self.outlierSigma = outlierSigma
+                self.shiftSamples = shiftSamples
+                self.minSigma     = minSigma
+                self.fullSoc      = fullSoc
+                self.minSwing     = minSwing
+                self.capAlpha     = capAlpha
+                self.baseSwings   = baseSwings
+                self.saveInterval = saveInterval
+                self.clock        = clock
+                self.cells        = {}          # cell number -> CellStats
+                self.capacity     = {"ah": None, "wh": None, "baseAh": 0.0, "baseWh": 0.0, "swings": 0, "cycles": 0.0}
+                self.anchor       = None        # [soc, ah, wh] at the last full battery
+                self.low          = None        # [soc, ah, wh] at the lowest SOC since then
+                self.lastSoc      = None
+                self.dirty        = True        # new estimates to export
+                self.lastSave     = clock()
+                self.load()
+                if (stateFile): atexit.register(self.save)
+
+        def load(self):
+                if (not self.stateFile): return
+                try:
+                        with open(self.stateFile, mode='r') as fileObj:
+                                state = json.load(fileObj)
+                        self.cells = {int(k): CellStats(v) for k, v in state.get("cells", {}).items()}
+                        self.capacity.update(state.get("capacity", {}))
+                        self.anchor = state.get("anchor")
+                        self.low    = state.get("low")
+                except (OSError, ValueError, TypeError):
+                        self.cells = {}
+
+        def save(self):
+                if (not self.stateFile): return
+                try:
+                        stateDir = os.path.dirname(self.stateFile)
+                        if (stateDir): os.makedirs(stateDir, exist_ok=True)
+                        tmpName = self.stateFile + ".tmp"
+                        with open(tmpName, mode='w') as fileObj:
+                                json.dump({"cells": {k: c.state() for k, c in self.cells.items()},
+                                           "capacity": self.capacity, "anchor": self.anchor, "low": self.low}, fileObj)
+                                fileObj.flush()
+                                os.fsync(fileObj.fileno())
+                        os.replace(tmpName, self.stateFile)
+                except OSError as err:
+                        print("Failed to save cell health state:", self.stateFile, err)
+                self.lastSave = self.clock()
+
+        def maybeSave(self):
+                if ((self.clock() - self.lastSave) >= self.saveInterval): self.save()
+
+        # one impedance value (mOhm) of one cell, returns False for a rejected outlier
+        def updateImpedance(self, cellNum, value):
+                if (value <= 0): return(False)          # cell not measured
+                cell = self.cells.get(cellNum)
+                if (cell is None): cell = self.cells[cellNum] = CellStats()
+                if (value == cell.last): return(True)   # the same measurement again
+                cell.last = value
+                if (cell.count >= self.baseSamples):
+                        sigma = max(math.sqrt(cell.var), self.minSigma)
+                        if (abs(value - cell.ewma) > self.outlierSigma * sigma):
+                                cell.outliers += 1
+                                cell.streak += 1
+                                if (cell.streak < self.shiftSamples): return(False)
+                                cell.ewma = value       # not an outlier but a new level, the variance stays
+                        cell.streak = 0
+                        cell.count += 1
+                        # EWMA and its variance
+                        delta = value - cell.ewma
+                        cell.ewma += self.alpha * delta
+                        cell.var = (1 - self.alpha) * (cell.var + self.alpha * delta * delta)
+                else:
+                        # Welford over the first samples, seeds the variance
+                        cell.count += 1
+                        delta = value - cell.mean
+                        cell.mean += delta / cell.count
+                        cell.m2 += delta * (value - cell.mean)
+                        cell.var = cell.stddev() ** 2
+                        # EWMA, the first sample starts it
+                        cell.ewma = value if cell.ewma is None else cell.ewma + self.alpha * (value - cell.ewma)
+                if (cell.baseCount < self.baseSamples):
+                        cell.baseCount += 1
+                        cell.base += (value - cell.base) / cell.baseCount
+                self.dirty = True
+                self.maybeSave()
+                return(True)
+
+        # remaining capacity from the cell block and the SOC from the system block
+        def updateCapacity(self, ah, wh, soc):
+                if (soc is None or ah is None): return
+                if (soc >= self.fullSoc):
+                        self.closeSwing()
+                        self.anchor = [soc, ah, wh]
+                        self.low = None
+                elif (self.anchor is not None and (self.low is None or soc < self.low[0])):
+                        self.low = [soc, ah, wh]
+                if (self.lastSoc is not None and soc < self.lastSoc):
+                        self.capacity["cycles"] += (self.lastSoc - soc) / 100.0
+                self.lastSoc = soc
+                self.maybeSave()
+
+        # back at full: the swing anchor -> low gives one capacity estimate
+        def closeSwing(self):
+                if (self.anchor is None or self.low is None): return
+                swing = self.anchor[0] - self.low[0]
+                if (swing < self.minSwing): return
+                cap = self.capacity
+                for key, index in (("ah", 1), ("wh", 2)):
+                        used = self.anchor[index] - self.low[index]
+                        if (used <= 0): continue
+                        full = used / (swing / 100.0)
+                        cap[key] = full if cap[key] is None else cap[key] + self.capAlpha * (full - cap[key])
+                        if (cap["swings"] < self.baseSwings):
+                                base = "base" + key.capitalize()
+                                cap[base] += (full - cap[base]) / (cap["swings"] + 1)
+                cap["swings"] += 1
+                self.dirty = True
+
+        # 100 % at the baseline, 0 % when the impedance has doubled
+        def score(self, cell):
+                if (cell.ewma is None or cell.base <= 0): return(None)
+                return(max(0.0, min(100.0, (2.0 - cell.ewma / cell.base) * 100.0)))
+
+        # labels: extra labels for every line, e.g. ', pack="A"'
+        def write(self, fileObj, metric, labels=""):
+                scores = []
+                for cellNum in sorted(self.cells):
+                        cell = self.cells[cellNum]
+                        score = self.score(cell)
+                        if (score is None): continue
+                        scores.append(score)
+                        print(f"{metric}{{mode=\"CellNumHealth{cellNum}\"{labels}}} {score:.1f}", file=fileObj)
+                        print(f"{metric}{{mode=\"CellNumImpTrend{cellNum}\"{labels}}} {cell.ewma:.2f}", file=fileObj)
+                        print(f"{metric}{{mode=\"CellNumImpGrowth{cellNum}\"{labels}}} {(cell.ewma / cell.base - 1) * 100:.1f}", file=fileObj)
+                if (scores):
+                        print(f"{metric}{{mode=\"packHealth\"{labels}}} {min(scores):.1f}", file=fileObj)
+                        print(f"{metric}{{mode=\"impOutliers\"{labels}}} {sum(c.outliers for c in self.cells.values())}", file=fileObj)
+                cap = self.capacity
+                if (cap["ah"] is not None):
+                        print(f"{metric}{{mode=\"capacityAh\"{labels}}} {cap['ah']:.2f}", file=fileObj)
+                        if (cap["baseAh"] > 0):
+                                print(f"{metric}{{mode=\"capacityFade\"{labels}}} {(1 - cap['ah'] / cap['baseAh']) * 100:.1f}", file=fileObj)
+                if (cap["wh"] is not None):
+                        print(f"{metric}{{mode=\"capacityWh\"{labels}}} {cap['wh']:.1f}", file=fileObj)
+                print(f"{metric}{{mode=\"capacitySwings\"{labels}}} {cap['swings']}", file=fileObj)
+                print(f"{metric}{{mode=\"cycles\"{labels}}} {cap['cycles']:.2f}", file=fileObj)
+                self.dirty = False
+
+################ main ##################
+
+if __name__ == "__main__":
+        if (len(sys.argv) < 2):
+                print("usage: cellHealth.py STATEFILE [METRIC]")
+                sys.exit(1)
+        health = CellHealth()
+        health.stateFile = sys.argv[1]
+        health.load()
+        health.stateFile = None         # only print, never write back
+        health.write(sys.stdout, sys.argv[2] if len(sys.argv) > 2 else "BMS_health")
+
+# End.
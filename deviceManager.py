@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# deviceManager.py
+# Description: follow USB serial / hidraw adapters by a stable identity and reopen them
+# after the adapter re-enumerates (USB glitch, replug, hub reset).
+#
+# /dev/ttyUSB0 is just the order in which the kernel found the adapters. After a glitch
+# the same adapter can come back as /dev/ttyUSB1 and the old file descriptor is dead.
+# A device spec names the adapter instead of the slot:
+#   /dev/serial/by-id/usb-FTDI_FT232R_USB_UART_A10K1ABC-if00-port0   udev by-id link
+#   /dev/serial/by-id/*FTDI*          glob, the first match (sorted) is used
+#   usb:0403:6001                     USB vendor:product from sysfs (udev attributes)
+#   usb:0403:6001:A10K1ABC            ... and serial number
+#   usb:0665:5161@hidraw              ... a hidraw device instead of a tty (MPP inverters)
+#   /dev/ttyUSB0                      a plain path still works
+#
+# The manager thread waits for inotify events on /dev and /dev/serial/by-id (udev creates
+# and removes the nodes and links there) and resolves all specs again. Without inotify
+# (no ctypes/libc) it polls every pollInterval seconds. A reader checks device.changed()
+# and calls device.open(opener) again, which waits until the adapter is back.
+#
+# Usage from the shell (getMPPSolarMGX.sh):
+#   deviceManager.py list                    all tty/hidraw devices with their identity
+#   deviceManager.py resolve SPEC            print the current path, exit 1 if not present
+#   deviceManager.py watch SPEC [SPEC ...]   print every change
+
+import os, sys, glob, time, select, threading
+from argparse import ArgumentParser
+
+IN_ATTRIB     = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO   = 0x080
+IN_CREATE     = 0x100
+IN_DELETE     = 0x200
+IN_NONBLOCK   = 0o4000
+IN_CLOEXEC    = 0o2000000
+IN_MASK       = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+WATCH_DIRS = ["/dev", "/dev/serial/by-id"]
+
+def readAttr(dirName, attr):
+        try:
+                with open(os.path.join(dirName, attr), mode='r') as fileObj:
+                        return(fileObj.read().strip())
+        except OSError:
+                return(None)
+
+# USB attributes (vendor, product, serial) of a tty or hidraw node, from sysfs
+def usbIdentity(devClass, name):
+        devDir = os.path.realpath(f"/sys/class/{devClass}/{name}/device")
+        for i in range(8):
+                if (readAttr(devDir, "idVendor") is not None):
+                        return(readAttr(devDir, "idVendor").lower(), readAttr(devDir, "idProduct").lower(),
+                               readAttr(devDir, "serial") or "")
+                parent = os.path.dirname(devDir)
+                if (parent == devDir): break
+                devDir = parent
+        return(None)
+
+def listDevices():
+        result = []
+        for devClass in ("tty", "hidraw"):
+                for sysPath in sorted(glob.glob(f"/sys/class/{devClass}/*")):
+                        name = os.path.basename(sysPath)
+                        ident = usbIdentity(devClass, name)
+                        if (ident is None): continue    # built-in ttyS*, consoles
+                        result.append(("/dev/" + name, devClass, ident))
+        return(result)
+
+# current /dev path of a spec, None if the adapter is not there
+def resolveDevice(spec):
+        if (spec.startswith("usb:")):
+                devClass = "tty"
+                if ("@" in spec):
+                        spec, devClass = spec.split("@", 1)
+                want = spec[4:].lower().split(":")
+                for path, cls, ident in listDevices():
+                        if (cls != devClass): continue
+                        if (want[0] != ident[0] or want[1] != ident[1]): continue
+                        if (len(want) > 2 and want[2] != ident[2].lower()): continue
+                        return(path)
+                return(None)
+        if (any(c in spec for c in "*?[")):
+                matches = sorted(glob.glob(spec))
+                if (not matches): return(None)
+                spec = matches[0]
+        if (not os.path.exists(spec)): return(None)
+        return(os.path.realpath(spec))
+
+# inotify through ctypes, None where it is not available
+class Inotify:
+        def __init__(self):
+                import ctypes, ctypes.util
+                self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+                if (self.fd < 0): raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+                self.watched = set()
+
+        # (re)add the watches, /dev/serial/by-id only exists while an adapter is plugged in
+        def addWatches(self):
+                for dirName in WATCH_DIRS:
+                        if (dirName in self.watched or not os.path.isdir(dirName)): continue
+                        if (self.libc.inotify_add_watch(self.fd, dirName.encode(), IN_MASK) >= 0):
+                                self.watched.add(dirName)
+
+        def drain(self):
+                try:
+                        while os.read(self.fd, 4096): pass
+                except BlockingIOError:
+                        pass
+                except OSError:
+                        pass
+                self.watched = {d for d in self.watched if os.path.isdir(d)}
+
+        def wait(self, timeout):
+                ready = select.select([self.fd], [], [], timeout)[0]
+                return(bool(ready))
+
+        def close(self):
+                os.close(self.fd)
+
+def openInotify():
+        try:
+                return(Inotify())
+        except (OSError, AttributeError, ImportError):
+                return(None)
+
+class ManagedDevice:
+        def __init__(self, manager, spec):
+                self.manager       = manager
+                self.spec          = spec
+                self.path          = resolveDevice(spec)
+                self.generation    = 0          # +1 every time the path changes (also to / from None)
+                self.openGeneration = None      # generation of the last successful open
+                self.reopens       = 0
+
+        def present(self):
+                return(self.path is not None)
+
+        # True when the adapter went away or came back under another path since open()
+        def changed(self):
+                return(self.openGeneration != self.generation)
+
+        # Open the device with opener(path) (e.g. serial.Serial), waiting and retrying
+        # until it works. maxWait: give up after so many seconds and return None.
+        def open(self, opener, maxWait=None, maxDelay=5.0):
+                start = time.monotonic()
+                delay = 0.2
+                reported = False
+                while True:
+                        generation, path = self.generation, self.path
+                        if (path is not None):
+                                try:
+                                        handle = opener(path)
+                                        if (self.openGeneration is not None): self.reopens += 1
+                                        self.openGeneration = generation
+                                        if (self.manager.debug or reported): print("Opened:", self.spec, "as", path)
+                                        return(handle)
+                                except OSError as err:
+                                        if (not reported): print("Failed to open port:", self.spec, path, err)
+                                        reported = True
+                        elif (not reported):
+                                print("Waiting for device:", self.spec)
+                                reported = True
+                        if (maxWait is not None and time.monotonic() - start >= maxWait): return(None)
+                        self.manager.waitChange(delay)
+                        delay = min(delay * 2, maxDelay)
+
+class DeviceManager:
+        def __init__(self, pollInterval=2.0, debug=False):
+                self.pollInterval = pollInterval
+                self.debug        = debug
+                self.devices      = []
+                self.cond         = threading.Condition()
+                self.thread       = None
+
+        def watch(self, spec):
+                device = ManagedDevice(self, spec)
+                with self.cond:
+                        self.devices.append(device)
+                if (self.thread is None):
+                        self.thread = threading.Thread(target=self.run, name="deviceManager", daemon=True)
+                        self.thread.start()
+                return(device)
+
+        def unwatch(self, device):
+                with self.cond:
+                        if (device in self.devices): self.devices.remove(device)
+
+        def rescan(self):
+                with self.cond:
+                        for device in self.devices:
+                                path = resolveDevice(device.spec)
+                                if (path == device.path): continue
+                                if (self.debug): print("Device", device.spec, "moved:", device.path, "->", path)
+                                device.path = path
+                                device.generation += 1
+                        self.cond.notify_all()
+
+        # sleep until the next rescan or timeout seconds
+        def waitChange(self, timeout):
+                with self.cond:
+                        self.cond.wait(timeout)
+
+        def run(self):
+                inotify = openInotify()
+                if (self.debug): print("deviceManager:", "inotify" if inotify else f"polling every {self.pollInterval} s")
+                while True:
+                        if (inotify):
+                                inotify.addWatches()
+                                if (inotify.wait(self.pollInterval)):
+                                        time.sleep(0.2)         # udev adds the by-id links right after the node
+                                inotify.drain()
+                        else:
+                                time.sleep(self.pollInterval)
+                        self.rescan()
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Find USB serial / hidraw devices by identity")
+        parser.add_argument("command", choices=["list", "resolve", "watch"])
+        parser.add_argument("spec", nargs="*", help="device spec, e.g. usb:0403:6001 or /dev/serial/by-id/...")
+        parser.add_argument("-D", "--debug", action="store_true", help="print the rescans")
+        args = parser.parse_args()
+
+        if (args.command == "list"):
+                for path, devClass, ident in listDevices():
+                        links = [l for l in glob.glob("/dev/serial/by-id/*") if os.path.realpath(l) == path]
+                        print(path, f"usb:{ident[0]}:{ident[1]}" + (f":{ident[2]}" if ident[2] else "")
+                              + ("@hidraw" if devClass == "hidraw" else ""), " ".join(links))
+        elif (args.command == "resolve"):
+                if (len(args.spec) != 1): parser.error("resolve needs one spec")
+                path = resolveDevice(args.spec[0])
+                if (path is None): sys.exit(1)
+                print(path)
+        else:
+                manager = DeviceManager(debug=args.debug)
+                devices = [manager.watch(spec) for spec in args.spec]
+                seen = {}
+                try:
+                        while True:
+                                for device in devices:
+                                        if (seen.get(device.spec) != device.generation):
+                                                seen[device.spec] = device.generation
+                                                print(time.strftime("%H:%M:%S"), device.spec, device.path or "(gone)", flush=True)
+                                manager.waitChange(5)
+                except KeyboardInterrupt:
+                        pass
+
+# End.
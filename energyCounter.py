@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# energyCounter.py
+# Description: integrate power (W) and current (A) at full sample rate into energy (Wh)
+# and charge (Ah) counters inside the collectors.
+#
+# Grafana integral()/sum_over_time() queries over days or months are expensive on a Pi.
+# With monotonic counters in the .prom files a panel only needs a cheap increase().
+#
+# - trapezoidal integration between two samples
+# - positive and negative flow go into separate counters, so every counter only goes up
+#   (e.g. chargeAh / dischargeAh for the battery current)
+# - gaps longer than maxGap seconds are not integrated (device offline, port reopened)
+# - the totals are saved to a JSON state file every saveInterval seconds and loaded
+#   again on start, so the counters survive a restart or reboot.
+#   Don't put the state file on /ramdisk, it is gone after a reboot.
+#
+# Output example (metric QC_energy):
+# # TYPE QC_energy counter
+# QC_energy{mode="whA"} 12345.678
+
+import os, json, time, atexit
+
+class EnergyIntegrator:
+        def __init__(self, stateFile=None, saveInterval=60, maxGap=30, clock=time.monotonic):
+                self.stateFile    = stateFile
+                self.saveInterval = saveInterval
+                self.maxGap       = maxGap
+                self.clock        = clock
+                self.totals       = {}  # counter name -> accumulated value (unit * h)
+                self.lastSample   = {}  # input name -> (timestamp, value)
+                self.lastSave     = clock()
+                self.load()
+                if (stateFile): atexit.register(self.save)
+
+        def load(self):
+                if (not self.stateFile): return
+                try:
+                        with open(self.stateFile, mode='r') as fileObj:
+                                self.totals = {k: float(v) for k, v in json.load(fileObj).items()}
+                except (OSError, ValueError):
+                        self.totals = {}
+
+        def save(self):
+                if (not self.stateFile): return
+                try:
+                        stateDir = os.path.dirname(self.stateFile)
+                        if (stateDir): os.makedirs(stateDir, exist_ok=True)
+                        tmpName = self.stateFile + ".tmp"
+                        with open(tmpName, mode='w') as fileObj:
+                                json.dump(self.totals, fileObj)
+                                fileObj.flush()
+                                os.fsync(fileObj.fileno())
+                        os.replace(tmpName, self.stateFile)     # atomic, a crash never leaves half a file
+                except OSError as err:
+                        print("Failed to save energy state:", self.stateFile, err)
+                self.lastSave = self.clock()
+
+        def add(self, name, amount):
+                self.totals[name] = self.totals.get(name, 0.0) + amount
+
+        # Feed one sample. Positive area goes to posName, negative area to negName (as a
+        # positive number). Without negName negative values are ignored.
+        def update(self, name, value, posName, negName=None, ts=None):
+                if (ts is None): ts = self.clock()
+                value = float(value)
+                last = self.lastSample.get(name)
+                self.lastSample[name] = (ts, value)
+
+                # make sure the counters are exported from the first sample on
+                if (posName not in self.totals): self.totals[posName] = 0.0
+                if (negName and negName not in self.totals): self.totals[negName] = 0.0
+
+                if (last is None): return
+                dt = ts - last[0]
+                if (dt <= 0 or dt > self.maxGap): return
+                v0 = last[1]
+                hours = dt / 3600.0
+
+                if (v0 >= 0 and value >= 0):
+                        self.add(posName, (v0 + value) / 2 * hours)
+                elif (v0 <= 0 and value <= 0):
+                        if (negName): self.add(negName, -(v0 + value) / 2 * hours)
+                else:
+                        # sign change: split the trapezoid at the zero crossing
+                        tZero = hours * abs(v0) / (abs(v0) + abs(value))
+                        posArea = (max(v0, value) / 2) * (tZero if v0 > 0 else hours - tZero)
+                        negArea = (-min(v0, value) / 2) * (tZero if v0 < 0 else hours - tZero)
+                        self.add(posName, posArea)
+                        if (negName): self.add(negName, negArea)
+
+                if ((self.clock() - self.lastSave) >= self.saveInterval): self.save()
+
+        # labels: extra labels for every line, e.g. ', pack="A"'
+        def write(self, fileObj, metric, labels=""):
+                print(f"# TYPE {metric} counter", file=fileObj)
+                for name, total in self.totals.items():
+                        print(f"{metric}{{mode=\"{name}\"{labels}}} {total:.4f}", file=fileObj)
+
+# End.
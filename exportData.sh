@@ -34,6 +34,27 @@ done
 # Add a description string of your solar installation
 unitName="1440w-3x4-120W LifePO4-8s4p 24v-640a/h 15.4kW/h"
 
+# Strings are not put into labels of the values, every change would start a new series in
+# Prometheus (see promState.py). States are a state set, one series per known state:
+# stateSet METRIC MODE VALUE STATE...  -> METRIC_state{mode="MODE",state="..."} 1 or 0
+stateSet() {
+        local metric=$1 mode=$2 value=$3 found=0 state
+        shift 3
+        for state in "$@" ; do
+                if [ "$state" == "$value" ] ; then found=1 ; fi
+                printf '%s_state{mode="%s",state="%s"} %d\n' $metric $mode "$state" $([ "$state" == "$value" ] && echo 1 || echo 0)
+        done
+        printf '%s_state{mode="%s",state="other"} %d\n' $metric $mode $((1 - found))
+}
+# Static strings (unit name) are an info metric in their own file, only written when they
+# changed: writeInfo FILE LINE
+writeInfo() {
+        if [ "$(cat $1 2>/dev/null)" != "$2" ] ; then
+                printf '%s\n' "$2" > $1.$$
+                mv $1.$$ $1
+        fi
+}
+
 # The source text file containing the output from the getTracerData.py script
 dataFile="/ramdisk/solarData.txt"
 
@@ -54,6 +75,9 @@ chargeStatVal=`cat $dataFile | \grep chargeStatus | cut -f2 -d" "`
 chargeStatStr=`cat $dataFile | \grep chargeStatus | cut -f3 -d" "`
 sysStatus=`cat $dataFile | \grep Battery\ is | cut -f3 -d" "`
 
+# net battery flow (charge power - load power), so Grafana doesn't have to calculate it
+netBatWatts=$(echo "scale=2; $batwatts - $loadWatts" | bc)
+
 :>/ramdisk/$dataFile.prom.$$
 
  # numeric values
@@ -70,12 +94,22 @@ printf "AB_SolarStats{mode=\"devTemp\"} $devTemp\n"   >> /ramdisk/$dataFile.prom
 printf "AB_SolarStats{mode=\"genWatts\"} $genWatts\n" >> /ramdisk/$dataFile.prom.$$
 printf "AB_SolarStats{mode=\"conWatts\"} $conWatts\n" >> /ramdisk/$dataFile.prom.$$
 printf "AB_SolarStats{mode=\"chargeStatVal\"} $chargeStatVal\n" >> /ramdisk/$dataFile.prom.$$
+printf "AB_SolarStats{mode=\"netBatWatts\"} $netBatWatts\n" >> /ramdisk/$dataFile.prom.$$
 
 # text values
-printf "AB_SolarStats{myVar=\"chargeStatStr\",myStr=\"$chargeStatStr\"} $chargeStatVal\n" >> /ramdisk/$dataFile.prom.$$
-printf "AB_SolarStats{myVar=\"sysStatus\",myStr=\"$sysStatus\"} $chargeStatVal\n" >> /ramdisk/$dataFile.prom.$$
-printf "AB_SolarStats{myVar=\"unitName\",myStr=\"$unitName\"} 0\n" >> /ramdisk/$dataFile.prom.$$
+stateSet AB_SolarStats chargeStatus "$chargeStatStr" Standby Float Bulk Equalize >> /ramdisk/$dataFile.prom.$$
+stateSet AB_SolarStats sysStatus "$sysStatus" Charging Discharging             >> /ramdisk/$dataFile.prom.$$
+writeInfo /ramdisk/AB_SolarStats_info.prom "AB_SolarStats_info{unit=\"$unitName\"} 1"
 
 `mv /ramdisk/$dataFile.prom.$$ /ramdisk/$dataFile.prom`
 
+# keep the samples in the local time-series store as well (see tsStore.py)
+# python3 /home/solar/tsStore.py /home/pi/tsdb ingest -w AB_SolarStats /ramdisk/$dataFile.prom
+
+# check the local alert rules (battery temperature, see alertEngine.py)
+# python3 /home/solar/alertEngine.py /home/pi/alertRules.json -s /var/lib/solarshed/alerts_AB_SolarStats.json /ramdisk/$dataFile.prom
+
+# publish the changed values over MQTT (see mqttSink.py)
+# python3 /home/solar/mqttSink.py -s localhost -c /var/lib/solarshed/mqtt_AB_SolarStats.json /ramdisk/$dataFile.prom
+
 # End
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# genDashboards.py
+# Description: generate the Grafana dashboards from metricRegistry.py
+#
+# Instead of one hand edited panel and query per value (and per cell) every panel gets
+# a single query over all of its series, e.g.
+#   BMS_${pack}{mode=~"CellNum.*"}   legend {{mode}}
+# and the rows of a device with several instances (BMS packs) are repeated per value
+# of the dashboard variable. The dashboard refresh follows the poll rate of the device.
+#
+# Usage: genDashboards.py [-o dashboards] [-d name] [-D]
+# Import the files in Grafana with Dashboards -> Import, pick the Prometheus data source.
+
+import os, re, sys, json, argparse
+
+import metricRegistry
+
+REFRESH = [("5s", 5), ("10s", 10), ("30s", 30), ("1m", 60), ("5m", 300)]
+debug = False
+
+# smallest refresh that is not faster than the collector, Grafana's minimum is 5s
+def refreshFor(poll):
+        for name, seconds in REFRESH:
+                if (seconds >= poll): return(name)
+        return(REFRESH[-1][0])
+
+def isRegex(name):
+        return(re.search(r"[\[\]\.\*\|\+\?]", name.replace("${", "").replace("}", "")) is not None)
+
+# prometheus selector for one panel
+def selector(metric, modes, labels=None):
+        if (isinstance(modes, (list, tuple))):
+                matchers = ["mode=~\"" + "|".join(modes) + "\""]
+        elif (modes.endswith("*")):
+                matchers = ["mode=~\"" + modes[:-1] + ".*\""]
+        else:
+                matchers = ["mode=\"" + modes + "\""]
+        if (labels): matchers.append(labels)
+        if (isRegex(metric)):
+                return("{__name__=~\"" + metric + "\", " + ", ".join(matchers) + "}")
+        return(metric + "{" + ", ".join(matchers) + "}")
+
+def legendFor(panel, metric):
+        if (panel["legend"]): return(panel["legend"])
+        if (panel["kind"] == "state"):
+                return("{{__name__}} {{state}}" if isRegex(metric) else "{{state}}")
+        many = isinstance(panel["modes"], (list, tuple)) or panel["modes"].endswith("*")
+        if (isRegex(metric)):
+                return("{{__name__}} {{mode}}" if many else "{{__name__}}")
+        return("{{mode}}" if many else panel["title"])
+
+def fieldConfig(panel):
+        defaults = {"unit": panel["unit"]}
+        if (panel["min"] is not None): defaults["min"] = panel["min"]
+        if (panel["max"] is not None): defaults["max"] = panel["max"]
+        if (panel["kind"] == "timeseries"):
+                defaults["custom"] = {"lineWidth": 1, "fillOpacity": 0, "showPoints": "never", "spanNulls": True}
+        return({"defaults": defaults, "overrides": []})
+
+def options(kind):
+        if (kind == "timeseries"):
+                return({"legend": {"displayMode": "list", "placement": "bottom"}, "tooltip": {"mode": "multi"}})
+        reduce = {"calcs": ["lastNotNull"], "fields": "", "values": False}
+        if (kind == "bargauge"):
+                return({"reduceOptions": reduce, "orientation": "vertical", "displayMode": "gradient",
+                        "showUnfilled": True})
+        if (kind == "gauge"):
+                return({"reduceOptions": reduce, "showThresholdLabels": False, "showThresholdMarkers": True})
+        if (kind == "state"):
+                return({"reduceOptions": reduce, "colorMode": "none", "graphMode": "none", "textMode": "name"})
+        return({"reduceOptions": reduce, "colorMode": "value", "graphMode": "area", "textMode": "auto"})
+
+def panelSize(panel):
+        if (panel["width"]): return(panel["width"], 8)
+        if (panel["kind"] in ("stat", "gauge", "state")): return(4, 5)
+        return(8, 8)
+
+class Layout:
+        def __init__(self):
+                self.x = 0
+                self.y = 0
+                self.rowHeight = 0
+
+        def newRow(self):
+                if (self.x): self.y += self.rowHeight
+                self.x = 0
+                self.rowHeight = 0
+                pos = {"x": 0, "y": self.y, "w": 24, "h": 1}
+                self.y += 1
+                return(pos)
+
+        def place(self, w, h):
+                if (self.x + w > 24):
+                        self.y += self.rowHeight
+                        self.x = 0
+                        self.rowHeight = 0
+                pos = {"x": self.x, "y": self.y, "w": w, "h": h}
+                self.x += w
+                self.rowHeight = max(self.rowHeight, h)
+                return(pos)
+
+def buildPanel(device, panel, panelId, gridPos):
+        metric = panel["metric"] or device["metric"]
+        sel = selector(metric, panel["modes"], panel["labels"])
+        expr = panel["expr"].format(sel=sel) if panel["expr"] else sel
+        if (panel["kind"] == "state" and not panel["expr"]): expr = sel + " == 1"     # the active state only
+        if (debug): print(device["name"], panel["title"], expr)
+        return({
+                "id": panelId,
+                "type": "stat" if panel["kind"] == "state" else panel["kind"],
+                "title": panel["title"],
+                "datasource": "${DS_PROMETHEUS}",
+                "gridPos": gridPos,
+                "fieldConfig": fieldConfig(panel),
+                "options": options(panel["kind"]),
+                "targets": [{"refId": "A", "expr": expr, "legendFormat": legendFor(panel, metric),
+                             "interval": str(device["poll"]) + "s"}],
+        })
+
+def templating(device):
+        varList = []
+        for name, query in device["vars"]:
+                varList.append({
+                        "name": name, "label": name, "type": "query", "datasource": "${DS_PROMETHEUS}",
+                        "query": query, "refresh": 2, "includeAll": True, "multi": True,
+                        "current": {"selected": True, "text": ["All"], "value": ["$__all"]},
+                        "sort": 1, "hide": 0,
+                })
+        return({"list": varList})
+
+def buildDashboard(device):
+        layout = Layout()
+        panels = []
+        panelId = 1
+        repeat = device["vars"][0][0] if device["vars"] else None
+        for rowTitle, rowPanels in device["groups"]:
+                row = {"id": panelId, "type": "row", "title": rowTitle, "collapsed": False,
+                       "gridPos": layout.newRow(), "panels": []}
+                if (repeat): row["repeat"] = repeat
+                panels.append(row)
+                panelId += 1
+                for panel in rowPanels:
+                        w, h = panelSize(panel)
+                        panels.append(buildPanel(device, panel, panelId, layout.place(w, h)))
+                        panelId += 1
+        return({
+                "__inputs": [{"name": "DS_PROMETHEUS", "label": "Prometheus", "type": "datasource",
+                              "pluginId": "prometheus", "pluginName": "Prometheus"}],
+                "uid": "solarshed-" + device["name"],
+                "title": device["title"],
+                "tags": ["solarshed"],
+                "timezone": "browser",
+                "schemaVersion": 27,
+                "version": 1,
+                "editable": True,
+                "refresh": refreshFor(device["poll"]),
+                "time": {"from": "now-6h", "to": "now"},
+                "timepicker": {"refresh_intervals": [name for name, seconds in REFRESH if seconds >= device["poll"]]},
+                "templating": templating(device),
+                "annotations": {"list": []},
+                "panels": panels,
+        })
+
+def main(argv=None):
+        global debug
+        parser = argparse.ArgumentParser(description="Generate the Grafana dashboards from metricRegistry.py")
+        parser.add_argument("-o", "--outdir", default="dashboards", help="output directory (default dashboards)")
+        parser.add_argument("-d", "--device", action="append", help="only this device, e.g. chargery (repeatable)")
+        parser.add_argument("-D", "--debug", action="store_true", help="print the queries")
+        args = parser.parse_args(argv)
+        debug = args.debug
+
+        devices = [d for d in metricRegistry.DEVICES if not args.device or d["name"] in args.device]
+        if (not devices):
+                print("No such device:", ", ".join(args.device))
+                return(1)
+        os.makedirs(args.outdir, exist_ok=True)
+        for device in devices:
+                fileName = os.path.join(args.outdir, device["name"] + ".json")
+                dashboard = buildDashboard(device)
+                with open(fileName + ".tmp", mode='w') as fileObj:
+                        json.dump(dashboard, fileObj, indent=1)
+                        fileObj.write("\n")
+                os.replace(fileName + ".tmp", fileName)
+                queries = sum(1 for p in dashboard["panels"] if p["type"] != "row")
+                print(f"{fileName}: {queries} queries, refresh {dashboard['refresh']}")
+        return(0)
+
+if __name__ == "__main__":
+        sys.exit(main())
+
+# End.
@@ -30,17 +30,29 @@
 import serial
 import sys, os, io
 import time
+import threading
 import binascii
+from array import array
 from argparse import ArgumentParser
+from windowAggregator import WindowAggregator
+from energyCounter import EnergyIntegrator
+from cellHealth import CellHealth
+from promState import writeStateSet
+from sampleSink import SinkFile, openPromFile
+from deviceManager import DeviceManager
+from profHooks import stageTimer
 
 modeList= ["Discharge", "Charge", "Storage"]
 chargeList=["Release", "Protection"]
-gotCellData = False;
-gotSysData  = False;
-gotCellImpedance = False;
 debug=False;
-cellCount = 8
-protocolVersion = ["V126"] # 122, 124, 125     
+protocolVersion = "V126"   # 122, 124, 125, a string like the -P choices
+staleTime = 10          # seconds without data before a pack is left out of the totals
+alertEngine = None      # alertEngine.AlertEngine with -A, shared by all packs
+recorder = None         # serialRecorder.SerialRecorder with -r, shared by all packs
+mqttSink = None         # mqttSink.MqttSink with -M, one broker connection for all packs
+liveStream = None       # liveStream.LiveStream with -E, one port for all packs
+readTimeout = 0.1       # s, a read returns after this or 256 bytes
+quietGap = None         # s, with -L a read also returns after a pause in the stream
 
 def bin2hex(str1):
         bytes_str = bytes(str1)
@@ -83,7 +95,8 @@ def getCheckSum(hexLine):
         # MOD by 256 and retun hex value without formating: get rid of '0x'       
         return(format(chk_sum % 256, '02x')) 
 
-def getValidData(hexLine, strLen, minLen):
+# checkLen: compare the reported data length with the frame, not for 0x58 (see FrameReassembler)
+def getValidData(hexLine, strLen, minLen, checkLen=True):
         decStrLen = len(hexLine)        # length of hex String: 2 Chars = 1 Byte
         dataLen = hexLine[6:8]          # data length         
 
@@ -94,7 +107,7 @@ def getValidData(hexLine, strLen, minLen):
                 if (debug): print("hexLine len", len(hexLine))
 
         # check if length is correct
-        if (int(dataLen,16) !=  (decStrLen/2)):
+        if (checkLen and int(dataLen,16) !=  (decStrLen/2)):
                 if (debug): print("Missmatch of datalength! Expected: ", int(dataLen,16), " Received: ", (decStrLen/2))
                 return(True)
         else:
@@ -113,12 +126,13 @@ def getValidData(hexLine, strLen, minLen):
 
 # Command 56
 # Report cells voltage (main control board)
-def getCellData(fileObj, hexLine, strLen):
+def getCellData(pack, fileObj, hexLine, strLen):
         minLen = 44     # minimal bytes for the 8s inc header (each byte is 2 chars)
         dataStart = 8   # cell voltage data starts at byte 9 in 2 byte chunks (hi-lo)
         cellNum = 1
         aggVolts = 0    # total voltage of the battery
-        global gotCellData
+        minCell = None  # lowest / highest cell, for the totals over all packs
+        maxCell = None
 
         if (debug): print("getCellData: called - ", hexLine)
 
@@ -130,20 +144,21 @@ def getCellData(fileObj, hexLine, strLen):
 
         if (getValidData(hexLine, strLen, minLen)): return(True)
 
-        for cell in range(dataStart, dataStart + cellCount * 4, 4):    # 2 charaters for one byte, every cell value: 2 byte.
+        for cell in range(dataStart, dataStart + pack.cellCount * 4, 4):    # 2 charaters for one byte, every cell value: 2 byte.
                 cellVolts = get_voltage_value(int(hexLine[cell:cell+2], 16), int(hexLine[cell+2:cell+4], 16))
                 if (debug): print("Cell ", cellNum, ":", cellVolts, "v")
                 # format the data for node_exporter to read into prometheus
                 #valName  = "mode={}{}".format("CellNum", cellNum)
-                valName  = "mode=\"CellNum" + str(cellNum) + "\""
-                valName = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {cellVolts}"
-                print(dataStr, file=fileObj)
+                print(pack.cellLines[cellNum - 1] + str(cellVolts), file=fileObj)
+                pack.aggregator.update(pack.cellModes[cellNum - 1], cellVolts)
+                pack.cells[cellNum - 1] = cellVolts
 
                 aggVolts += cellVolts
+                if (minCell is None or cellVolts < minCell): minCell = cellVolts
+                if (maxCell is None or cellVolts > maxCell): maxCell = cellVolts
                 cellNum += 1
       
-        if (protocolVersion in ['V126','V125']):
+        if (pack.protocol in ['V126','V125']):
                 # Add Discharge End voltage of cell, and charge, discharge status send out
                 # 4 Bytes = 1 byte: 4 chars
                 # From cell+4 to cell+12 WH
@@ -151,51 +166,56 @@ def getCellData(fileObj, hexLine, strLen):
                 # is there a smater solution to call this function ? \(°J°)/
                 capacity_wh = get_capacity_value(hexLine[cell+4:cell+12])
                 valName  = "mode=\"capacity_wh\""
-                valName = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {capacity_wh}"
+                valName = "{" + valName + pack.label + "}"
+                dataStr  = f"{pack.metric}{valName} {capacity_wh}"
                 print(dataStr, file=fileObj)
 
                 # 4 Bytes = 1 Byte: 2 chars
                 capacity_ah = get_capacity_value(hexLine[cell+12:cell+20])	
                 valName  = "mode=\"capacity_ah\""
-                valName = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {capacity_ah}"
+                valName = "{" + valName + pack.label + "}"
+                dataStr  = f"{pack.metric}{valName} {capacity_ah}"
                 print(dataStr, file=fileObj)	
 
+                pack.health.updateCapacity(capacity_ah, capacity_wh, pack.soc)
+
                 if(debug):
                         print("Battery AH:", capacity_ah)
                         print("Battery WH:", capacity_wh)
 
-        elif (protocolVersion in ['V122']):
+        elif (pack.protocol in ['V122']):
                 soc = int(hexLine[cell], 16)
                 if(debug): print("SOC2", soc)
 
                 valName  = "mode=\"SOC2\""
-                valName = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {soc}"
+                valName = "{" + valName + pack.label + "}"
+                dataStr  = f"{pack.metric}{valName} {soc}"
                 print(dataStr, file=fileObj)
         else:
                 print("Unknow BMS Protocol")
                 
+        pack.aggregator.update("aggVolts", aggVolts)
+        pack.volts   = aggVolts
+        pack.minCell = minCell
+        pack.maxCell = maxCell
         aggVolts = "{:4.2f}".format(aggVolts)
         valName  = "mode=\"aggVolts\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {aggVolts}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {aggVolts}"
         print(dataStr, file=fileObj)
         
         if (debug):
                 #print("Checksum:", asdf , "Calc Checksum: ", getCheckSum(hexLine))
                 print("Battery voltage:", aggVolts, "v")
 
-        gotCellData = True;
+        pack.gotCellData = True;
         return(False)
 
 # Command 57
 # Report measure value (main control board)
 # the data length is always 13 
-def getSysData(fileObj, hexLine, strLen):    
+def getSysData(pack, fileObj, hexLine, strLen):    
         minLen = 30     # minimal bytes inc header (each byte is 2 chars)
-        global gotSysData
 
         if (debug): print("getSysData: called - ", hexLine)
 
@@ -241,38 +261,48 @@ def getSysData(fileObj, hexLine, strLen):
                 #print("currentFlow:", currentFlow)
 
         valName  = "mode=\"current\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {currentFlow}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {currentFlow}"
         print(dataStr, file=fileObj)
+        pack.aggregator.update("current", currentFlow)
+        pack.current    = currentFlow
+        pack.soc        = socInt
+        pack.lastUpdate = time.monotonic()
+
+        # charge in / out of the battery, integrated at full sample rate
+        pack.integrator.update("current", currentFlow, "chargeAh", "dischargeAh")
+        if (pack.volts is not None):
+                pack.integrator.update("power", currentFlow * pack.volts, "chargeWh", "dischargeWh")
 
         valName  = "mode=\"maxEndVolts\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {maxEndVolts}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {maxEndVolts}"
         print(dataStr, file=fileObj)
 
-        valName  = "mode=\"modeInt\", myStr=\""
-        valName  = valName + modeName + "\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {modeInt}"
+        valName  = "mode=\"modeInt\""
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {modeInt}"
         print(dataStr, file=fileObj)
+        # the mode name as a state set, not as a label of modeInt (see promState.py)
+        writeStateSet(fileObj, pack.metric + "_state", "workMode", modeName, modeList, pack.label)
 
         valName  = "mode=\"temp1\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {temp1}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {temp1}"
         print(dataStr, file=fileObj)
 
         valName  = "mode=\"temp2\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {temp2}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {temp2}"
         print(dataStr, file=fileObj)
 
         valName  = "mode=\"SOC\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A{valName} {socInt}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}{valName} {socInt}"
         print(dataStr, file=fileObj)   
 
         ## grap block of Data
-        if(protocolVersion=="V126"):
+        if(pack.protocol=="V126"):
                 minEndVolt_hi = hexLine[28:30]  # Discharge End Voltage of cell
                 minEndVolt_lo = hexLine[30:32]  # Discharge End Voltage of cell
                 chgProtectionStatus = hexLine[32:34]    # 1: Over Charge Protection (P) / 0: Over Charge Release (R)
@@ -290,21 +320,21 @@ def getSysData(fileObj, hexLine, strLen):
                 dsgProtectionName = chargeList[int(dsgProtectionStatus,16)]
              
                 valName  = "mode=\"minEndVolts\""
-                valName  = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {minEndVolts}"
+                valName  = "{" + valName + pack.label + "}"
+                dataStr  = f"{pack.metric}{valName} {minEndVolts}"
                 print(dataStr, file=fileObj)
 
-                valName  = "mode=\"chgProtectionInt\", myStr=\""
-                valName  = valName + chgProtectionName + "\""
-                valName  = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {chgProtectionInt}"
+                valName  = "mode=\"chgProtectionInt\""      # 0: Release, 1: Protection
+                valName  = "{" + valName + pack.label + "}"
+                dataStr  = f"{pack.metric}{valName} {chgProtectionInt}"
                 print(dataStr, file=fileObj)
 
-                valName  = "mode=\"dsgProtectionInt\", myStr=\""
-                valName  = valName + dsgProtectionName + "\""
-                valName  = "{" + valName + "}"
-                dataStr  = f"BMS_A{valName} {dsgProtectionInt}"
+                valName  = "mode=\"dsgProtectionInt\""      # 0: Release, 1: Protection
+                valName  = "{" + valName + pack.label + "}"
+                dataStr  = f"{pack.metric}{valName} {dsgProtectionInt}"
                 print(dataStr, file=fileObj)
+                writeStateSet(fileObj, pack.metric + "_state", "chgProtection", chgProtectionName, chargeList, pack.label)
+                writeStateSet(fileObj, pack.metric + "_state", "dsgProtection", dsgProtectionName, chargeList, pack.label)
 
                 ## output if debug
                 if (debug):
@@ -312,21 +342,19 @@ def getSysData(fileObj, hexLine, strLen):
                         print("Charge Protectoin Status", chgProtectionName)
                         print("Discharge Protection Status", dsgProtectionName)
                               
-        gotSysData = True;
+        pack.gotSysData = True;
         return(False)
 
 # Command 58
 # Report cells impedance (main control board)
 # updates only on mode change 
-def getCellImpedance(fileObj, hexLine, strLen):
+def getCellImpedance(pack, fileObj, hexLine, strLen):
         dataStart = 8   # cell impedance data starts at byte 9 in 2 byte chunks (hi-lo)
         # for BMS8T, 16T, and 24T, the data length depends on cell counts, each cell impedance is 2 bytes
         # header + command + dataLen + mode + current + 2 * count of cells + checksum 
-        minLen = 8 + 2 + 4 + cellCount * 4 + 2
+        minLen = 8 + 2 + 4 + pack.cellCount * 4 + 2
         cellNum = 1
         aggImpedance = 0    # total impedance of the battery
-        
-        global gotCellImpedance
 
         if (debug): print("getCellImpedance: called - ", hexLine)
 
@@ -337,8 +365,9 @@ def getCellImpedance(fileObj, hexLine, strLen):
                 print("header:", header)
                 print("command:", command)
 
-        # My 16T BMS should have a Datalength of 40 Bytes but it sends out 59. Something wrong here?
-        # if (getValidData(hexLine, strLen, minLen)): return(True)  
+        # the reported length can be wrong (BMS bug), the reassembler cut the frame by the cell
+        # count and checked the checksum, here only the length from the cell count counts
+        if (getValidData(hexLine, minLen, minLen, checkLen=False)): return(True)
 
         amp1_mode = hexLine[8:10]	# currentMode1
         amp1_hi = hexLine[10:12]	# instant current1
@@ -355,25 +384,23 @@ def getCellImpedance(fileObj, hexLine, strLen):
                 print("currentMode1", Current1ModeName)
                 print("current1", current1)
 
-        valName  = "mode=\"currentMode1\", myStr=\""
-        valName  = valName + Current1ModeName + "\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A_imp{valName} {Current1ModeInt}"
+        valName  = "mode=\"currentMode1\""          # index of modeList
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}_imp{valName} {Current1ModeInt}"
         print(dataStr, file=fileObj)
+        writeStateSet(fileObj, pack.metric + "_state", "currentMode1", Current1ModeName, modeList, pack.label)
 
         valName  = "mode=\"current1\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A_imp{valName} {current1}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}_imp{valName} {current1}"
         print(dataStr, file=fileObj)       
 
-        for cell in range(dataStart, dataStart + cellCount * 4, 4):  
+        for cell in range(dataStart, dataStart + pack.cellCount * 4, 4):  
                 cellImpedance = get_impedance_value(int(hexLine[cell:cell+2], 16), int(hexLine[cell+2:cell+4], 16))
                 if (debug): print("Cell ", cellNum, ":", cellImpedance, "mOhm")
-                valName  = "mode=\"CellNumImp" + str(cellNum) + "\""
-                valName = "{" + valName + "}"
-                dataStr  = f"BMS_A_imp{valName} {cellImpedance}"
-                print(dataStr, file=fileObj)
+                print(pack.impLines[cellNum - 1] + str(cellImpedance), file=fileObj)
 
+                pack.health.updateImpedance(cellNum, cellImpedance)
                 aggImpedance += cellImpedance
                 cellNum += 1
 
@@ -382,73 +409,262 @@ def getCellImpedance(fileObj, hexLine, strLen):
 
         aggImpedance = "{:4.2f}".format(aggImpedance)
         valName  = "mode=\"aggImpedance\""
-        valName  = "{" + valName + "}"
-        dataStr  = f"BMS_A_imp{valName} {aggImpedance}"
+        valName  = "{" + valName + pack.label + "}"
+        dataStr  = f"{pack.metric}_imp{valName} {aggImpedance}"
         print(dataStr, file=fileObj)
 
-        gotCellImpedance = True;
+        pack.gotCellImpedance = True;
         return(False)
 
-################ main ##################
-
-parser = ArgumentParser(description='Get BMS Data')
-
-parser.add_argument(
-        "-p",
-        "--port",
-        type=str,
-        help="Specifies the device communications port (/dev/ttyUSB0 [default], /dev/hidraw0, COM3, ...)",
-        default="/dev/ttyUSB0",
-)
-
-parser.add_argument(
-        "-D",
-        "--debug",
-        help="Enable Debug and above (i.e. all) messages",
-        action="store_true",
-        #type=int,
-        #default="1",
-)
-
-parser.add_argument(
-        "-P",
-        "--protocol",
-        type=str,
-        help="Specifies the device command and response protocol, (default: V122)",
-        default="V122",
-        choices=[
-                "V121",
-                "V122",
-                "V124",
-                "V125",
-                "V126",
-        ],
-)
-
-parser.add_argument(
-        "-c",
-        "--cells",
-        type=int,
-        help="Specifies the number of cells (1-24)",
-        default="8",
-)
-
-args = parser.parse_args()
-
-if args.debug:
-        debug = True
-        print("Debug: enabled")
-
-if args.port:
-        devName = args.port
-else:
-        devName='/dev/ttyUSB0'
-
-if args.protocol:
-        protocolVersion = args.protocol
-
-if args.cells:
-        cellCount = args.cells     
+# Reassemble the serial byte stream into single frames.
+# The BMS sends the frames back to back without any gap, a read of 256 bytes can hold
+# several frames or only a part of one. Every pack (port) has its own reassembler.
+# Frame: 24 24 | command | length (header to checksum, incl. checksum) | data | checksum
+# Every frame is checked against its checksum. A frame that fails is dropped from its
+# header on only, the search goes on with the next 2424 inside it, so a broken length
+# byte can't swallow the frames behind it.
+# Command 0x58 (impedance) is known to report a wrong length on some BMS (confirmed by
+# the vendor). Its real length follows from the cell count: header, command, length,
+# current mode, current, 2 bytes per cell and the checksum. That length is tried first,
+# the reported one only when the checksum doesn't match (cell count set wrong).
+# Between two reads the buffer holds at most one incomplete frame (< maxFrame bytes).
+class FrameReassembler:
+        minFrame = 5            # header, command, length, checksum
+        maxFrame = 128          # 24 cells V1.26 cell block is 61 bytes
+
+        def __init__(self, cellCount=None):
+                self.buf = bytearray()
+                self.impLen = 4 + 1 + 2 + 2 * cellCount + 1 if cellCount else None
+                # ok: checksum fine with the reported length, recovered: 0x58 only fine with
+                # the inferred length, discarded: no valid frame at this header, skipped: bytes
+                self.stats = {"ok": 0, "recovered": 0, "discarded": 0, "skippedBytes": 0}
+
+        # the port was reopened, don't glue old bytes to the new stream
+        def reset(self):
+                self.buf = bytearray()
+
+        def checksumOk(self, frameLen):
+                return((sum(memoryview(self.buf)[:frameLen - 1]) & 0xff) == self.buf[frameLen - 1])
+
+        # returns the complete frames found so far, the rest is kept for the next call
+        def feed(self, data):
+                frames = []
+                self.buf += data
+                stats = self.stats
+                while True:
+                        start = self.buf.find(b"\x24\x24")
+                        if (start < 0):
+                                # keep a trailing 0x24, it could be the first half of the next header
+                                keep = 1 if self.buf[-1:] == b"\x24" else 0
+                                stats["skippedBytes"] += len(self.buf) - keep
+                                del self.buf[:len(self.buf) - keep]
+                                break
+                        if (start > 0):
+                                if (debug): print("Skip", start, "bytes before header")
+                                stats["skippedBytes"] += start
+                                del self.buf[:start]
+                        if (len(self.buf) < 4): break
+                        declared = self.buf[3]
+                        lengths = [declared] if (self.minFrame <= declared <= self.maxFrame) else []
+                        if (self.buf[2] == 0x58 and self.impLen and self.impLen != declared):
+                                lengths.insert(0, self.impLen)
+                        if (not lengths):
+                                stats["discarded"] += 1
+                                del self.buf[:2]        # no valid header, resync on the next 2424
+                                continue
+                        if (len(self.buf) < max(lengths)):
+                                # wait for more bytes, unless a shorter candidate is complete and valid
+                                if (not (len(self.buf) >= lengths[0] and self.checksumOk(lengths[0]))): break
+                        frameLen = None
+                        for length in lengths:
+                                if (len(self.buf) >= length and self.checksumOk(length)):
+                                        frameLen = length
+                                        break
+                        if (frameLen is None):
+                                if (debug): print("Checksum mismatch, resync - command", hex(self.buf[2]), "length", declared)
+                                stats["discarded"] += 1
+                                del self.buf[:2]        # resync on the next 2424 inside this frame
+                                continue
+                        stats["recovered" if frameLen != declared else "ok"] += 1
+                        frames.append(bytes(self.buf[:frameLen]))
+                        del self.buf[:frameLen]
+                return(frames)
+
+        # labels: extra labels for every line, e.g. ', pack="A"'
+        def write(self, fileObj, metric, labels=""):
+                print(f"# TYPE {metric} counter", file=fileObj)
+                for name, count in self.stats.items():
+                        print(f"{metric}{{mode=\"{name}\"{labels}}} {count}", file=fileObj)
+
+# All state of one battery pack (one BMS on one port)
+class ChargeryPack:
+        def __init__(self, name, devName, cellCount, args, devices, protocol=None):
+                self.name       = name
+                self.devName    = devName
+                self.device     = devices.watch(devName)        # follows the adapter, see deviceManager.py
+                self.port       = None                          # the open serial port
+                self.running    = True                          # False: readPack returns, the port stays open
+                self.cellCount  = cellCount
+                self.protocol   = protocol or protocolVersion
+                self.metric     = "BMS_" + name
+                self.label      = ", pack=\"" + name + "\""
+                self.sysFile    = "/ramdisk/" + self.metric + "_sys.prom"
+                self.impFile    = "/ramdisk/" + self.metric + "_imp.prom"
+                self.healthFile = "/ramdisk/" + self.metric + "_health.prom"
+                self.reassembler = FrameReassembler(cellCount)
+                self.readBuf    = bytearray(256)                # every read of the port goes here, see readPack
+                self.stages     = stageTimer(self.metric)       # read ... publish, when switched on (profHooks.py)
+                self.recChannel = recorder.channel(self.metric) if recorder else None
+                self.gotCellData = False
+                self.gotSysData  = False
+                self.gotCellImpedance = False
+                self.fileObj    = None
+                self.fileObjImp = None
+
+                # latest values for the totals over all packs
+                self.volts      = None  # last battery voltage from the cell block, needed for Wh
+                self.current    = None
+                self.soc        = None
+                self.minCell    = None
+                self.maxCell    = None
+                self.lastUpdate = None
+                self.cells      = array('d', bytes(8 * cellCount))     # latest cell voltages
+
+                # the series of the cells, built once and not for every value
+                self.cellModes  = ["CellNum" + str(n) for n in range(1, cellCount + 1)]
+                self.cellLines  = [f"{self.metric}{{mode=\"{mode}\"{self.label}}} " for mode in self.cellModes]
+                self.impLines   = [f"{self.metric}_imp{{mode=\"CellNumImp{n}\"{self.label}}} " for n in range(1, cellCount + 1)]
+
+                # min/max/mean rollup per scrape interval, see windowAggregator.py
+                self.aggregator = WindowAggregator(args.window, ["current", "aggVolts", "CellNum*"])
+                # Ah/Wh counters, see energyCounter.py
+                self.integrator = EnergyIntegrator(args.energy_state.format(pack=name))
+                # impedance trend, capacity fade and health scores, see cellHealth.py
+                self.health     = CellHealth(args.health_state.format(pack=name))
+
+                # consumers of every sample beside the .prom files, see sampleSink.py
+                self.sinks = []
+                if args.store:
+                        from tsStore import TSStore     # only loaded when used, keeps the start fast
+                        self.sinks.append(TSStore(args.store, writer=self.metric))
+                if args.remote_write:
+                        from remoteWrite import RemoteWriter
+                        self.sinks.append(RemoteWriter(args.remote_write, queueDir="/var/spool/solarshed/" + self.metric, debug=debug))
+                if alertEngine:
+                        self.sinks.append(alertEngine)  # shared by all packs, checks every decoded value
+                if mqttSink:
+                        self.sinks.append(mqttSink)     # shared by all packs, topic per pack
+                if liveStream:
+                        self.sinks.append(liveStream)   # shared by all packs, event per pack
+                if self.sinks:
+                        self.nullFile = SinkFile(None, self.sinks)      # frames we only aggregate go to the sinks as well
+                else:
+                        self.nullFile = open(os.devnull, mode='w')      # decode target for frames we only aggregate
+
+        def online(self):
+                return(self.lastUpdate is not None and (time.monotonic() - self.lastUpdate) < staleTime)
+
+        def close(self):
+                for sink in self.sinks:
+                        sink.close()
+
+# Derived values, computed once here instead of in PromQL on every dashboard refresh:
+# pack power, lowest/highest/average cell, cell spread (mV) and the efficiency from
+# the energy counters (discharged / charged, lifetime).
+def writeDerived(pack, fileObj):
+        if (pack.current is not None and pack.volts is not None):
+                power = pack.current * pack.volts
+                print(f"{pack.metric}{{mode=\"power\"{pack.label}}} {power:.1f}", file=fileObj)
+        if (pack.minCell is not None):
+                print(f"{pack.metric}{{mode=\"minCell\"{pack.label}}} {pack.minCell}", file=fileObj)
+                print(f"{pack.metric}{{mode=\"maxCell\"{pack.label}}} {pack.maxCell}", file=fileObj)
+                print(f"{pack.metric}{{mode=\"avgCell\"{pack.label}}} {pack.volts / pack.cellCount:.3f}", file=fileObj)
+                cellSpread = (pack.maxCell - pack.minCell) * 1000
+                print(f"{pack.metric}{{mode=\"cellSpread\"{pack.label}}} {cellSpread:.0f}", file=fileObj)
+        totals = pack.integrator.totals
+        if (totals.get("chargeAh", 0) > 0):
+                coulombEff = totals.get("dischargeAh", 0) / totals["chargeAh"] * 100
+                print(f"{pack.metric}{{mode=\"coulombEff\"{pack.label}}} {coulombEff:.2f}", file=fileObj)
+        if (totals.get("chargeWh", 0) > 0):
+                energyEff = totals.get("dischargeWh", 0) / totals["chargeWh"] * 100
+                print(f"{pack.metric}{{mode=\"energyEff\"{pack.label}}} {energyEff:.2f}", file=fileObj)
+
+# finish a tmp file and move it to its final name (atomic for node_exporter)
+def publishFile(fileObj, fileName):
+        fileObj.flush()
+        fileObj.close()
+        os.replace(fileName + ".tmp", fileName)
+        if (debug):
+                print("\n")
+                with open(fileName, mode='r') as promFile:
+                        print(promFile.read())
+
+def handleFrame(pack, frame):
+        hexLine = binascii.hexlify(frame).decode('utf-8')
+        byteA = hexLine[0:2]    # header
+        byteB = hexLine[2:4]    # header
+        byteC = hexLine[4:6]    # packet type 56 | 57 | 58
+        byteD = hexLine[6:8]    # packet len
+
+        if (pack.fileObj is None):
+                if (debug): print("Opened new tmp file", pack.sysFile + ".tmp")
+                pack.fileObj = openPromFile(pack.sysFile + ".tmp", pack.sinks)
+        if (pack.fileObjImp is None):
+                if (debug): print("Opened new tmp file", pack.impFile + ".tmp")
+                pack.fileObjImp = openPromFile(pack.impFile + ".tmp", pack.sinks)
+
+        # SysData very second
+        # CellData very 2 seconds
+        # Impedance Data: on change between charge & discharge -> Flush with sys/cell data (every 2 seconds)
+
+        # every 2 seconds a dataset should be completed
+        if (pack.gotSysData and pack.gotCellData):
+                # We have a complete set, before we overwrite, copy the temp file to its final dest
+                if (debug): print("BINGO!!! - complete set - copying file to", pack.sysFile)
+                writeDerived(pack, pack.fileObj)
+                pack.aggregator.write(pack.fileObj, pack.metric + "_agg", pack.label)
+                pack.integrator.write(pack.fileObj, pack.metric + "_energy", pack.label)
+                pack.reassembler.write(pack.fileObj, pack.metric + "_frames", pack.label)
+                pack.stages.mark("format")
+                publishFile(pack.fileObj, pack.sysFile)
+                # open new temp file as we have data to write
+                pack.fileObj = openPromFile(pack.sysFile + ".tmp", pack.sinks)
+                pack.gotSysData  = False;    # start all over again
+                pack.gotCellData = False;
+                if (pack.health.dirty):
+                        # the estimates change slowly, the file is only written when they moved
+                        with openPromFile(pack.healthFile + ".tmp", pack.sinks) as fileObj:
+                                pack.health.write(fileObj, pack.metric + "_health", pack.label)
+                        os.replace(pack.healthFile + ".tmp", pack.healthFile)
+                pack.stages.mark("publish")
+
+        if (pack.gotCellImpedance):
+                # We have a Impedance data copy the temp file to its final dest
+                if (debug): print("BINGO!!! - copying file to", pack.impFile)
+                publishFile(pack.fileObjImp, pack.impFile)
+                pack.fileObjImp = openPromFile(pack.impFile + ".tmp", pack.sinks)
+                pack.gotCellImpedance = False;
+                pack.stages.mark("publish")
+
+        if (byteC == "56"):
+                if (debug): print("Found Cell block", pack.name, byteC, hexLine)
+                if (not pack.gotCellData):
+                        getCellData(pack, pack.fileObj, hexLine, int(byteD, 16))
+                else:
+                        getCellData(pack, pack.nullFile, hexLine, int(byteD, 16))      # only feed the aggregator
+        elif (byteC == "57"):
+                if (debug): print("Found System block", pack.name, byteC, hexLine)
+                if (not pack.gotSysData):
+                        getSysData(pack, pack.fileObj, hexLine, int(byteD, 16))
+                else:
+                        getSysData(pack, pack.nullFile, hexLine, int(byteD, 16))       # only feed the aggregator
+        elif (byteC == "58"):
+                if (debug): print("Found Impedance block", pack.name, byteC, hexLine)
+                if (not pack.gotCellImpedance):
+                        getCellImpedance(pack, pack.fileObjImp, hexLine, int(byteD, 16))
+        else:
+                if (debug): print("Found Unexpected command block", pack.name, byteC, hexLine)
+        pack.stages.mark("decode")
 
 # id id type len data                          checksum
 # 24 24 57   0F  10 68 02 00 00 FF 21 FF 21 00 68
@@ -457,108 +673,260 @@ if args.cells:
 
 # data is written to the serial port every second or less, waiting too long results in garbled lines.
 # Read fast and often to get the best results. System and Cell data is written at different frequencies.
+def openPort(path):
+        return(serial.Serial(path, 115200, bytesize=8, parity='N', stopbits=1, timeout=readTimeout, inter_byte_timeout=quietGap))
+
+# -L: a read waits for the frames and ends after a short pause instead of every 100 ms.
+# About one wakeup per burst of frames, the reassembler glues frames cut in the middle.
+def lowPower():
+        global readTimeout, quietGap
+        readTimeout, quietGap = 2.0, 0.02
+
+# Stops when pack.running is cleared and leaves pack.port open, solarshed.py hands it to
+# the pack that replaces this one after a config reload.
+def readPack(pack):
+        while pack.running:
+                if (pack.port is None or not pack.port.is_open):
+                        # waits until the adapter is there, also after it re-enumerated under another name
+                        pack.port = pack.device.open(openPort)
+                        if (debug): print("Opened:", pack.port.name, "pack", pack.name)
+                        if (recorder): recorder.mark(pack.recChannel, "opened " + str(pack.device.path))
+                ser = pack.port
+                try:
+                        while (ser.is_open and not pack.device.changed() and pack.running):
+                                # read up to 256 bytes into the buffer of the pack, the reassembler cuts the frames
+                                pack.stages.begin()
+                                myBin = memoryview(pack.readBuf)[:ser.readinto(pack.readBuf)]
+                                if (recorder): recorder.record(pack.recChannel, RX, myBin)
+                                pack.stages.mark("read")
+                                if (debug): print("Read", pack.name, len(myBin), "bytes:", myBin.hex(), " gotSysData:", pack.gotSysData,
+                                                  " gotCellData:", pack.gotCellData, " gotCellImpedance:", pack.gotCellImpedance)
+                                frames = pack.reassembler.feed(myBin)
+                                pack.stages.mark("reassemble")
+                                for frame in frames:
+                                        handleFrame(pack, frame)
+                except OSError as err:          # serial.SerialException: adapter unplugged or reset
+                        print("Lost port:", pack.device.spec, "pack", pack.name, err)
+                        if (recorder): recorder.mark(pack.recChannel, "lost " + str(err))
+                        time.sleep(1)
+                if (not pack.running): break
+                ser.close()
+                pack.port = None
+                pack.reassembler.reset()                # don't glue old bytes to the new stream
+
+# Totals over all packs, written to /ramdisk/BMS_total.prom. Packs without data for
+# staleTime seconds are left out (packsOnline shows how many are in).
+def writeTotals(packs):
+        online = [p for p in packs if p.online()]
+        with open('/ramdisk/BMS_total.prom.tmp', mode='w') as fileObj:
+                print(f"BMS_total{{mode=\"packsOnline\"}} {len(online)}", file=fileObj)
+                if (online):
+                        current = sum(p.current for p in online)
+                        print(f"BMS_total{{mode=\"current\"}} {current:.1f}", file=fileObj)
+                        print(f"BMS_total{{mode=\"minSOC\"}} {min(p.soc for p in online)}", file=fileObj)
+                        print(f"BMS_total{{mode=\"maxSOC\"}} {max(p.soc for p in online)}", file=fileObj)
+                        withVolts = [p for p in online if p.volts is not None]
+                        if (withVolts):
+                                power = sum(p.current * p.volts for p in withVolts)
+                                print(f"BMS_total{{mode=\"power\"}} {power:.1f}", file=fileObj)
+                                print(f"BMS_total{{mode=\"minCell\"}} {min(p.minCell for p in withVolts)}", file=fileObj)
+                                print(f"BMS_total{{mode=\"maxCell\"}} {max(p.maxCell for p in withVolts)}", file=fileObj)
+        os.replace('/ramdisk/BMS_total.prom.tmp', '/ramdisk/BMS_total.prom')
 
-try:
-        ser = serial.Serial(devName, 115200, bytesize=8, parity='N', stopbits=1, timeout=0.1)
-        if (debug): print("Opened:", ser.name)
-except OSError as err:
-        print("Failed to open port: ", devName)
-        exit()
-
-while (ser.is_open):
-        #myBin = ser.read()     # read 1 byte
-        myBin  = ser.read(256)  # read up to 15 bytes
-        #myBin = ser.readline(255)      # read a '\n' terminated line??
-        myPid  = os.getpid()    # for temp file buffering
-
-        hexLine = bin2hex(myBin)
-        hexLine = hexLine.decode('utf-8')       # remove leading b in Python3
-        dataLen = len(hexLine)
-
-        if (gotSysData or gotCellData or gotCellImpedance):
-                if (debug): print("Skip new tmp file")
-        else:
-                if (debug): print("Opened new tmp file /ramdisk/BMS_A_sys.prom.tmp")
-                file_object = open('/ramdisk/BMS_A_sys.prom.tmp', mode='w')
-                if (debug): print("Opened new tmp file /ramdisk/BMS_A_imp.prom.tmp")
-                file_object_imp = open('/ramdisk/BMS_A_imp.prom.tmp', mode='w')
-
-        if (debug): print("Read ", len(hexLine), "bytes: ", hexLine, " gotSysData: ", gotSysData, " gotCellData: ", gotCellData, " gotCellImpedance ", gotCellImpedance)
-
-        if (dataLen > 14):
-                byteA = hexLine[0:2]    # header
-                byteB = hexLine[2:4]    # header
-                byteC = hexLine[4:6]    # packet type 56 | 57 | 58
-                byteD = hexLine[6:8]    # packet len
-
-                if (byteA == "24" and byteB == "24"):
-
-                        # SysData very second
-                        # CellData very 2 seconds
-                        # Impedance Data: on change between charge & discharge -> Flush with sys/cell data (every 2 seconds)
-
-                        # every 2 seconds a dataset should be completed
-                        if (gotSysData and gotCellData):
-                                # We have a complete set, before we overwrite, copy the temp file to its final dest
-                                if (debug): print("BINGO!!! - complete set - copying file to /ramdisk/BMS_A_sys.prom")
-                                file_object.flush()
-                                file_object.close()                                     
-
-                                outLine = os.system('/bin/mv /ramdisk/BMS_A_sys.prom.tmp /ramdisk/BMS_A_sys.prom')
-                                if (debug):    
-                                        print("\n")
-                                        outLine = os.system('/bin/cat /ramdisk/BMS_A_sys.prom')
-                                        
-                                #if (debug): sys.exit()
-                                # open new temp file as we have data to write
-                                file_object = open('/ramdisk/BMS_A_sys.prom.tmp', mode='w')
-                                if (debug): print("Opened new tmp file /ramdisk/BMS_A_sys.prom.tmp")
-                                gotSysData  = False;    # start all over again
-                                gotCellData = False;
-
-                        if(gotCellImpedance):
-                                # We have a Impedance data copy the temp file to its final dest
-                                if (debug): print("BINGO!!! - copying file to /ramdisk/BMS_A_imp.prom")
-                                file_object_imp.flush()
-                                file_object_imp.close()                                 
-
-                                # outLine = os.system('/bin/cp /ramdisk/BMS_A_imp.prom.tmp /home/pi/BMS_A_imp.txt')
-                                outLine = os.system('/bin/mv /ramdisk/BMS_A_imp.prom.tmp /ramdisk/BMS_A_imp.prom')
-                                if (debug):    
-                                        print("\n")
-                                        outLine = os.system('/bin/cat /ramdisk/BMS_A_imp.prom')
-                                
-                                # open new temp file as we have data to write
-                                file_object_imp = open('/ramdisk/BMS_A_imp.prom.tmp', mode='w')
-                                if (debug): print("Opened new tmp file /ramdisk/BMS_A_imp.prom.tmp")
-                                gotCellImpedance = False;
-
-                        if (byteC == "56"):
-                                if (debug): print("Found Cell block", byteA, byteB, byteC, hexLine)
-                                if (not gotCellData):
-                                        getCellData(file_object, hexLine, int(byteD, 16))
-                        elif (byteC == "57"):
-                                if (debug): print("Found System block", byteA, byteB, byteC, hexLine)
-                                if (not gotSysData):
-                                        getSysData(file_object, hexLine, int(byteD, 16))
-                        elif (byteC == "58"):
-                                if (debug): print("Found Impedance block", byteA, byteB, byteC, hexLine)
-                                # collect impedance data
-                                # if (debug == 2): 
-                                # file_object_debug = open('/home/pi/raw_imp.txt', mode='a')
-                                # print(hexLine, file=file_object_debug)
-                                # file_object_debug.flush()
-                                # file_object_debug.close() 
-                                        
-                                if (not gotCellImpedance):
-                                        getCellImpedance(file_object_imp, hexLine, int(byteD, 16))                
-                        else:
-                                if (debug): print("Found Unexpected command block", byteA, byteB, byteC, hexLine)
-                else:
-                        if (debug): print("Found Unexpected header block", byteA, byteB, byteC, hexLine)
-        else:
-                if (debug): print("Read Empty line", len(hexLine), "bytes: ", hexLine)
-
-ser.close()
+################ main ##################
 
-# End.
\ No newline at end of file
+if __name__ == "__main__":
+        parser = ArgumentParser(description='Get BMS Data')
+
+        parser.add_argument(
+                "-p",
+                "--port",
+                type=str,
+                action="append",
+                help="Specifies the device communications port (/dev/ttyUSB0 [default], /dev/serial/by-id/..., "
+                     "usb:VID:PID[:SERIAL], see deviceManager.py), repeat for several packs",
+        )
+
+        parser.add_argument(
+                "-n",
+                "--name",
+                type=str,
+                action="append",
+                help="Pack name for each port, used in the metric name and pack label (default: A, B, C, ...)",
+        )
+
+        parser.add_argument(
+                "-D",
+                "--debug",
+                help="Enable Debug and above (i.e. all) messages",
+                action="store_true",
+                #type=int,
+                #default="1",
+        )
+
+        parser.add_argument(
+                "-P",
+                "--protocol",
+                type=str,
+                help="Specifies the device command and response protocol, (default: V122)",
+                default="V122",
+                choices=[
+                        "V121",
+                        "V122",
+                        "V124",
+                        "V125",
+                        "V126",
+                ],
+        )
+
+        parser.add_argument(
+                "-c",
+                "--cells",
+                type=int,
+                action="append",
+                help="Specifies the number of cells (1-24), once for all packs or once per port",
+        )
+
+        parser.add_argument(
+                "-w",
+                "--window",
+                type=float,
+                help="Aggregation window for min/max/mean series in seconds, use the scrape interval (default: 15)",
+                default="15",
+        )
+
+        parser.add_argument(
+                "-e",
+                "--energy-state",
+                type=str,
+                help="State file for the Ah/Wh counters, must survive a reboot, {pack} is replaced by the pack name "
+                     "(default: /var/lib/solarshed/BMS_{pack}_energy.json)",
+                default="/var/lib/solarshed/BMS_{pack}_energy.json",
+        )
+
+        parser.add_argument(
+                "-H",
+                "--health-state",
+                type=str,
+                help="State file of the cell health estimator (impedance trend, capacity fade), {pack} is replaced "
+                     "by the pack name (default: /var/lib/solarshed/BMS_{pack}_health.json)",
+                default="/var/lib/solarshed/BMS_{pack}_health.json",
+        )
+
+        parser.add_argument(
+                "-S",
+                "--store",
+                type=str,
+                help="Also write every sample into the local time-series store in this directory (e.g. /home/pi/tsdb)",
+                default=None,
+        )
+
+        parser.add_argument(
+                "-R",
+                "--remote-write",
+                type=str,
+                help="Also push all samples in batches to this Prometheus remote-write URL (e.g. http://prometheus:9090/api/v1/write)",
+                default=None,
+        )
+
+        parser.add_argument(
+                "-r",
+                "--record",
+                type=str,
+                help="Record all bytes read from the ports into rotating binary files in this directory "
+                     "(see serialRecorder.py)",
+                default=None,
+        )
+
+        parser.add_argument(
+                "-A",
+                "--alerts",
+                type=str,
+                help="Check every value against the local alert rules in this file (see alertRules.example.json)",
+                default=None,
+        )
+
+        parser.add_argument(
+                "-M",
+                "--mqtt",
+                type=str,
+                help="Also publish the changed values of every snapshot to this MQTT broker (host[:port], see mqttSink.py)",
+                default=None,
+        )
+
+        parser.add_argument(
+                "-E",
+                "--events",
+                type=int,
+                help="Also serve every snapshot as a live event stream (SSE) on this port (see liveStream.py)",
+                default=None,
+        )
+
+        parser.add_argument(
+                "-L",
+                "--low-power",
+                action="store_true",
+                help="Wake up once per burst of frames instead of every 100 ms (see lowPower.py)",
+        )
+
+        args = parser.parse_args()
+
+        if args.debug:
+                debug = True
+                print("Debug: enabled")
+
+        if args.protocol:
+                protocolVersion = args.protocol
+
+        if args.low_power:
+                lowPower()
+
+        ports = args.port or ['/dev/ttyUSB0']
+        names = args.name or []
+        cells = args.cells or [8]
+        if (len(names) > len(ports) or len(cells) not in (1, len(ports))):
+                parser.error("give one name and one cell count (or one for all) per port")
+
+        if args.record:
+                from serialRecorder import getRecorder, RX
+                recorder = getRecorder(args.record, prefix="chargery")
+
+        if args.alerts:
+                from alertEngine import AlertEngine
+                alertEngine = AlertEngine(args.alerts, debug=debug)
+        if args.mqtt:
+                from mqttSink import MqttSink
+                mqttSink = MqttSink(args.mqtt, debug=debug)
+        if args.events:
+                from liveStream import LiveStream
+                liveStream = LiveStream(args.events, debug=debug)
+
+        import profHooks
+        profHooks.install("getChargeryData", debug=debug)     # kill -USR1 / profHooks.py: profile the running reader
+
+        devices = DeviceManager(debug=debug)
+        packs = []
+        for i, devName in enumerate(ports):
+                name = names[i] if (i < len(names)) else chr(ord('A') + i)
+                cellCount = cells[i] if (len(cells) > 1) else cells[0]
+                packs.append(ChargeryPack(name, devName, cellCount, args, devices))
+
+        # one reader thread per port, the main thread writes the totals
+        threads = []
+        for pack in packs:
+                thread = threading.Thread(target=readPack, args=(pack,), name="BMS_" + pack.name, daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        try:
+                while any(t.is_alive() for t in threads):
+                        if (len(packs) > 1): writeTotals(packs)
+                        time.sleep(2)
+        except KeyboardInterrupt:
+                pass
+
+        for pack in packs:
+                pack.close()
+        if (recorder): recorder.close()
+
+# End.
@@ -19,7 +19,34 @@ dataFileP1="MPP3048_P1"
 dataFileP2="MPP3048_P2"
 dataDir="/ramdisk/"
 
+# Strings are not put into labels of the values, every change would start a new series in
+# Prometheus (see promState.py). States are a state set, one series per known state:
+# stateSet METRIC MODE VALUE STATE...  -> METRIC_state{mode="MODE",state="..."} 1 or 0
+workModes="PowerOnMode StandbyMode LineMode BatteryMode FaultMode PowerSavingMode ShutdownMode"
+srcModes="Utilityfirst Solarfirst Solar+Utility Onlysolarchargingpermitted"
+stateSet() {
+        local metric=$1 mode=$2 value=$3 found=0 state
+        shift 3
+        for state in "$@" ; do
+                if [ "$state" == "$value" ] ; then found=1 ; fi
+                printf '%s_state{mode="%s",state="%s"} %d\n' $metric $mode "$state" $([ "$state" == "$value" ] && echo 1 || echo 0)
+        done
+        printf '%s_state{mode="%s",state="other"} %d\n' $metric $mode $((1 - found))
+}
+# Static strings (serial number, unit name) are an info metric in their own file,
+# only written when they changed: writeInfo FILE LINE
+writeInfo() {
+        if [ "$(cat $1 2>/dev/null)" != "$2" ] ; then
+                printf '%s\n' "$2" > $1.$$
+                mv $1.$$ $1
+        fi
+}
+
 while : ; do
+        # sums over both phases, written to ${dataDir}MPP3048_total.prom
+        totalPvWatts=0
+        totalAcWatts=0
+        totalLoadPC=0
         # Collect the raw data from each Phase inverter.
         # Use double buffering to avoid race conditions.
         `/home/joe/mpp-solar -c QPGS0 > ${dataDir}${dataFileP1}.$$`
@@ -77,10 +104,15 @@ while : ; do
                 printf "$mppDev{mode=\"batUnderV\"} $batUnderV\n"     >> ${dataDir}$mppDev.prom.$$ 
                 printf "$mppDev{mode=\"confChange\"} $confChange\n"   >> ${dataDir}$mppDev.prom.$$ 
 
-                printf "$mppDev{mode=\"serNum\"} $serNum\n"                     >> ${dataDir}$mppDev.prom.$$ 
-                printf "$mppDev{mode=\"workMode\",  myStr=\"$workMode\"}  0\n"  >> ${dataDir}$mppDev.prom.$$ 
-                printf "$mppDev{mode=\"srcMode\",   myStr=\"$srcMode\"}   0\n"  >> ${dataDir}$mppDev.prom.$$ 
-                printf "$mppDev{mode=\"faultCode\", myStr=\"$faultCode\"} 0\n"  >> ${dataDir}$mppDev.prom.$$ 
+                faultNum=$(echo "0$faultCode" | tr -cd '0-9')               # numeric, alert rules watch its changes
+                printf "$mppDev{mode=\"faultCode\"} $((10#$faultNum))\n"      >> ${dataDir}$mppDev.prom.$$ 
+                stateSet $mppDev workMode "$workMode" $workModes                >> ${dataDir}$mppDev.prom.$$
+                stateSet $mppDev srcMode  "$srcMode"  $srcModes                 >> ${dataDir}$mppDev.prom.$$
+                writeInfo ${dataDir}${mppDev}_info.prom "${mppDev}_info{serial=\"$serNum\",unit=\"$unitName\"} 1"
+
+                totalPvWatts=$(echo "scale=2; $totalPvWatts + $pvWatts" | bc)
+                totalAcWatts=$(echo "scale=2; $totalAcWatts + $acWatts" | bc)
+                totalLoadPC=$(echo "scale=2; $totalLoadPC + $acLoadPC" | bc)
 
                 if (( $debug )) ; then
                         printf "handled file:${dataDir}$mppDev batVolts:$batVolts pvVolts:$pvVolts batCap:$batCap gridVolts:$gridVolts pvAmps:$pvAmps pvWatts:$pvWatts acWatts:$acWatts acLoadPC:$acLoadPC\n"
@@ -90,5 +122,21 @@ while : ; do
         `mv ${dataDir}${dataFileP1}.prom.$$ ${dataDir}${dataFileP1}.prom`
         `mv ${dataDir}${dataFileP2}.prom.$$ ${dataDir}${dataFileP2}.prom`
 
+        # both phases together, the dashboards read these instead of adding P1 + P2
+        avgLoadPC=$(echo "scale=2; $totalLoadPC / 2" | bc)
+        printf "MPP3048_total{mode=\"pvWatts\"}  $totalPvWatts\n" >  ${dataDir}MPP3048_total.prom.$$
+        printf "MPP3048_total{mode=\"acWatts\"}  $totalAcWatts\n" >> ${dataDir}MPP3048_total.prom.$$
+        printf "MPP3048_total{mode=\"acLoadPC\"} $avgLoadPC\n"    >> ${dataDir}MPP3048_total.prom.$$
+        `mv ${dataDir}MPP3048_total.prom.$$ ${dataDir}MPP3048_total.prom`
+
+        # keep the samples in the local time-series store as well (see tsStore.py)
+        # python3 /home/joe/tsStore.py /home/pi/tsdb ingest -w MPP3048 ${dataDir}${dataFileP1}.prom ${dataDir}${dataFileP2}.prom
+
+        # check the local alert rules (grid lost, battery under voltage, see alertEngine.py)
+        # python3 /home/joe/alertEngine.py /home/pi/alertRules.json -s /var/lib/solarshed/alerts_MPP3048.json ${dataDir}${dataFileP1}.prom ${dataDir}${dataFileP2}.prom
+
+        # publish the changed values over MQTT (see mqttSink.py)
+        # python3 /home/joe/mqttSink.py -s localhost -c /var/lib/solarshed/mqtt_MPP3048.json ${dataDir}${dataFileP1}.prom ${dataDir}${dataFileP2}.prom ${dataDir}MPP3048_total.prom
+
         sleep 4
 done
@@ -17,28 +17,51 @@
 # create DISK load with # find /usr -exec grep joe {} \;
 # create Network load with # ping -f 8.8.8.8 
 
+# mppSession.py writes the same ${dataFileP1}.prom but keeps the device open and polls every second,
+# start it instead of this script: python3 /home/pi/mppSession.py -p /dev/hidraw0
+
 # For any trouble running the script: file Encoding UTF-8 without BOM, only LF (not CRLF) - make the file excecutable 'chmod -x'
 
 debug=0
 unitName="MPP5048MGX"
 dataFileP1="MPP5048MGX"
 dataDir="/ramdisk/"
+# the inverter, /dev/hidraw0 or a stable identity like usb:0665:5161@hidraw (see deviceManager.py list)
+devSpec="/dev/hidraw0"
+solarShedDir="/home/pi"
+
+# Static strings (serial number) are an info metric in their own file, only written when
+# they changed, not a value or label in the .prom file (see promState.py): writeInfo FILE LINE
+writeInfo() {
+        if [ "$(cat $1 2>/dev/null)" != "$2" ] ; then
+                printf '%s\n' "$2" > $1.$$
+                mv $1.$$ $1
+        fi
+}
 
 while : ; do
+        # find the inverter again every round, the hidraw number changes when USB re-enumerates
+        devName=`python3 ${solarShedDir}/deviceManager.py resolve ${devSpec} 2>/dev/null`
+        if [ -z "$devName" ]; then
+                if (( $debug )) ; then echo "waiting for ${devSpec}" ; fi
+                sleep 4
+                continue
+        fi
+
         # Collect the raw data from inverter.
         # Use double buffering to avoid race conditions.
 
-        # sudo mpp-solar -p /dev/hidraw0 --getstatus - also possible
+        # sudo mpp-solar -p ${devName} --getstatus - also possible
 
         # request Device Rating Information 
         # RATED Information not current - apply first, otherwise you will not get actual data
-        # `mpp-solar -p /dev/hidraw0 -c QPIRI > ${dataDir}${dataFileP1}.$$`       
+        # `mpp-solar -p ${devName} -c QPIRI > ${dataDir}${dataFileP1}.$$`       
         
         #request Device General Status Parameter
-        `mpp-solar -p /dev/hidraw0 -c QPIGS >> ${dataDir}${dataFileP1}.$$`      
+        `mpp-solar -p ${devName} -c QPIGS >> ${dataDir}${dataFileP1}.$$`      
 
         # request serial number
-        `mpp-solar -p /dev/hidraw0 -c QID >> ${dataDir}${dataFileP1}.$$`        
+        `mpp-solar -p ${devName} -c QID >> ${dataDir}${dataFileP1}.$$`        
 
         # move tmp file to txt file
         `mv ${dataDir}${dataFileP1}.$$ ${dataDir}${dataFileP1}.txt`       
@@ -104,10 +127,8 @@ while : ; do
                 #printf "$mppDev{mode=\"batUnderV\"} $batUnderV\n"     >> ${dataDir}$mppDev.prom.$$ 
                 printf "$mppDev{mode=\"confChange\"} $confChange\n"   >> ${dataDir}${dataFileP1}.prom.$$ 
 
-                printf "$mppDev{mode=\"serNum\"} $serNum\n"                     >> ${dataDir}${dataFileP1}.prom.$$ 
-                #printf "$mppDev{mode=\"workMode\",  myStr=\"$workMode\"}  0\n"  >> ${dataDir}$mppDev.prom.$$ 
-                #printf "$mppDev{mode=\"srcMode\",   myStr=\"$srcMode\"}   0\n"  >> ${dataDir}${dataFileP1}.prom.$$ 
-                #printf "$mppDev{mode=\"faultCode\", myStr=\"$faultCode\"} 0\n"  >> ${dataDir}$mppDev.prom.$$ 
+                writeInfo ${dataDir}${dataFileP1}_info.prom "${dataFileP1}_info{serial=\"$serNum\"} 1"
+                # work mode / source priority: as a state set, see stateSet in getMPPSolar.sh
 
                 if (( $debug )) ; then
                         printf "handled file:${dataDir}$mppDev batVolts:$batVolts pvVolts:$pvVolts batCap:$batCap gridVolts:$gridVolts pvAmps:$pvAmps pvWatts:$pvWatts acWatts:$acWatts acLoadPC:$acLoadPC\n"
@@ -116,5 +137,11 @@ while : ; do
 
         `mv ${dataDir}${dataFileP1}.prom.$$ ${dataDir}${dataFileP1}.prom`
 
+        # keep the samples in the local time-series store as well (see tsStore.py)
+        # python3 /home/pi/tsStore.py /home/pi/tsdb ingest -w ${dataFileP1} ${dataDir}${dataFileP1}.prom
+
+        # publish the changed values over MQTT (see mqttSink.py)
+        # python3 /home/pi/mqttSink.py -s localhost -c /var/lib/solarshed/mqtt_${dataFileP1}.json ${dataDir}${dataFileP1}.prom
+
         sleep 4
 done
@@ -24,17 +24,20 @@
 #        $this->tracer->sendRawQuery("\x01\x05\x00\x02\x00\x00\x6c\x0a", false);
 #    }
 #
+# exportData.sh starts this script again for every reading, so keep the start cheap:
+# only the modbus client is imported up front, everything else when it is used.
+# (pyepsolartracer.registers was imported but never used, so it is gone.)
+# Check the start time with: python3 importBench.py -c getTracerData
+#
 import os
 import sys
-import time
-import serial
 import ctypes
 #
 from pymodbus.client.sync import ModbusSerialClient as ModbusClient
-from pymodbus.mei_message import *      # ReadDeviceInformationRequest()
-from pyepsolartracer.registers import registers,coils
 #
 DEBUG=0
+# a /dev/serial/by-id/... link keeps working when the adapter comes back as another ttyXRUSB*
+devName = '/dev/ttyXRUSB0'
 
 c_uint8 = ctypes.c_uint8
 
@@ -54,17 +57,18 @@ class Flags( ctypes.Union ):
                   ]
 flags = Flags()
 
-# configure the client logging
-import logging
-logging.basicConfig()
-log = logging.getLogger()
-log.setLevel(logging.INFO) # DEBUG or INFO
+# configure the client logging, only needed when debugging
+if (DEBUG):
+        import logging
+        logging.basicConfig()
+        log = logging.getLogger()
+        log.setLevel(logging.DEBUG)
 
 client = ModbusClient(  method = 'rtu',
-                        port = '/dev/ttyXRUSB0',
+                        port = devName,
                         baudrate = 115200,
-                        stopbits = serial.STOPBITS_ONE,
-                        parity=serial.PARITY_NONE,
+                        stopbits = 1,           # serial.STOPBITS_ONE
+                        parity = 'N',           # serial.PARITY_NONE
                         bytesize = 8,
                         timeout=2)
 
@@ -83,6 +87,7 @@ else:
                 print('insmod installing USB driver failed. XXXX')
                 sys.exit()
 
+from pymodbus.mei_message import ReadDeviceInformationRequest
 request = ReadDeviceInformationRequest(unit=1)
 response = client.execute(request)
 # print "Response:"
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# importBench.py
+# Description: measure the start time of the collectors and check it against a budget.
+#
+# systemd and the shell wrappers restart the collectors (getTracerData.py even once per
+# reading), so every import at the top of a script is paid again and again. Heavy or
+# optional modules belong inside the function that needs them.
+#
+# For every collector the imports at the top level of the script (column 0, the ones run
+# at start) are collected and imported in a fresh interpreter:
+#  - wall time of "import ..." minus the wall time of an empty interpreter, best of -n runs
+#  - for python3 the slowest modules from "python3 -X importtime"
+# The exit code is 1 if a collector is over its budget, so it can run after a change.
+#
+# Usage: importBench.py [-c getChargeryData] [-b 1000] [-n 5] [-t 5]
+
+import os, re, sys, time, subprocess
+from argparse import ArgumentParser
+
+# collector: (interpreter, budget in ms for the imports). The budgets are for a Pi Zero.
+COLLECTORS = {
+        "getChargeryData": ("python3", 1000),
+        "powerMeter":      ("python3", 1000),
+        "RenogyWanderer":  ("python3", 1000),
+        "getTracerData":   ("python2", 1000),
+}
+
+importRe = re.compile(r"^(?:import\s+([\w\., ]+)|from\s+([\w\.]+)\s+import\s)")
+
+# top level imports of a script, without the script itself running
+def startupImports(fileName):
+        modules = []
+        with open(fileName, mode='r', encoding='utf-8', errors='replace') as fileObj:
+                for line in fileObj:
+                        match = importRe.match(line)
+                        if (not match): continue
+                        names = match.group(1) or match.group(2)
+                        for name in names.split(","):
+                                name = name.split(" as ")[0].strip()
+                                if (name and name not in modules): modules.append(name)
+        return(modules)
+
+def runOnce(cmd, cwd):
+        start = time.perf_counter()
+        try:
+                proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as err:
+                return(0, 127, str(err))
+        return(time.perf_counter() - start, proc.returncode, proc.stderr.decode(errors='replace'))
+
+def bestOf(cmd, cwd, runs):
+        best = None
+        for i in range(runs):
+                elapsed, rc, err = runOnce(cmd, cwd)
+                if (rc != 0): return(None, err)
+                if (best is None or elapsed < best): best = elapsed
+        return(best, "")
+
+# [(cumulative us, module)] of the modules imported directly by the statement
+def slowestModules(python, modules, cwd, top):
+        stmt = "import " + ", ".join(modules)
+        elapsed, rc, err = runOnce([python, "-X", "importtime", "-c", stmt], cwd)
+        result = []
+        for line in err.splitlines():
+                if (not line.startswith("import time:") or "|" not in line): continue
+                fields = line[len("import time:"):].split("|")
+                if (len(fields) < 3 or not fields[1].strip().isdigit()): continue
+                name = fields[2].rstrip()
+                if (name.startswith("  ")): continue     # indented: imported by another module
+                if (name.strip() not in modules): continue      # interpreter start (site, encodings)
+                result.append((int(fields[1]), name.strip()))
+        result.sort(reverse=True)
+        return(result[:top])
+
+def bench(name, python, budget, cwd, runs, top):
+        modules = startupImports(os.path.join(cwd, name + ".py"))
+        stmt = "import " + ", ".join(modules)
+        base, err = bestOf([python, "-c", "pass"], cwd, runs)
+        if (base is None):
+                print(f"{name}: {python} not available, skipped")
+                return(True)
+        elapsed, err = bestOf([python, "-c", stmt], cwd, runs)
+        if (elapsed is None):
+                lastLine = err.strip().splitlines()[-1] if err.strip() else "failed"
+                print(f"{name}: cannot import ({lastLine}), skipped")
+                return(True)
+        ms = (elapsed - base) * 1000
+        ok = ms <= budget
+        print(f"{name}: {ms:.0f} ms for {len(modules)} imports, budget {budget} ms {'ok' if ok else 'OVER BUDGET'}")
+        if (python == "python3"):
+                for usec, module in slowestModules(python, modules, cwd, top):
+                        print(f"    {usec / 1000:8.1f} ms  {module}")
+        return(ok)
+
+def main(argv=None):
+        parser = ArgumentParser(description="Check the start time of the collectors")
+        parser.add_argument("-c", "--collector", action="append", choices=sorted(COLLECTORS), help="only this collector (repeatable)")
+        parser.add_argument("-b", "--budget", type=int, help="budget in ms for every collector instead of the defaults")
+        parser.add_argument("-n", "--runs", type=int, default=3, help="runs per measurement, the best one counts (default 3)")
+        parser.add_argument("-t", "--top", type=int, default=5, help="list the N slowest imports (default 5)")
+        args = parser.parse_args(argv)
+
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        allOk = True
+        for name in (args.collector or COLLECTORS):
+                python, budget = COLLECTORS[name]
+                if (not bench(name, python, args.budget or budget, cwd, args.runs, args.top)): allOk = False
+        return(0 if allOk else 1)
+
+if __name__ == "__main__":
+        sys.exit(main())
+
+# End.
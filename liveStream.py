@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# liveStream.py
+# Description: push every snapshot of the collectors to live panels as server-sent events.
+#
+# The Grafana dashboards poll Prometheus every 5-10 s with about 100 queries per viewer
+# and refresh. For a live view (cell balancing during a top charge) the sink (see
+# sampleSink.py) serves the snapshots itself, as soon as they are decoded:
+#  - GET /events is a text/event-stream, one event per device (metric) and snapshot:
+#      event: BMS_A
+#      data: {"ts":1700000000.0,"SOC":81.0,"CellNum3":3.312,"current.max":85.1}
+#    the fields are named like in mqttSink.py (mode, other labels after a dot, no pack).
+#    /events?device=BMS_A&device=QC_power only sends these devices. A new client gets
+#    the last event of every device at once. GET / is a small page with live tables.
+#  - an event is encoded once and the same bytes go to every client. One thread serves all
+#    clients with non-blocking sockets, the collector thread only appends to the buffers.
+#  - backpressure: every client has a bounded send buffer (maxBuffer). A client that can't
+#    keep up (slow link, stopped tab) is disconnected when its buffer would overflow, it
+#    never holds up the collector or the other clients. EventSource reconnects by itself.
+#  - a comment line every heartbeat seconds keeps proxies open and finds dead clients
+#
+# One port per process: solarshed.py ("sinks": {"live": PORT}) and snapshotTick.py serve all
+# their devices on one. The shell collectors are served from their .prom files:
+#   liveStream.py -p 8087 -w /ramdisk/solarData.txt.prom /ramdisk/MPP3048_P1.prom
+# and watched in a browser at http://<pi>:8087/ or with: curl -N http://<pi>:8087/events
+
+import os, json, time, socket, selectors, threading
+from argparse import ArgumentParser
+from urllib.parse import urlsplit, parse_qs
+from mqttSink import seriesField
+from sampleSink import parsePromLine
+
+EVENT_HEAD = (b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+              b"Connection: keep-alive\r\nAccess-Control-Allow-Origin: *\r\n\r\nretry: 2000\n\n")
+MAX_REQUEST = 8192
+
+PAGE = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>SolarShed live</title>
+<style>body{font-family:sans-serif}table{display:inline-table;margin:8px;border-collapse:collapse}
+td,th{padding:2px 8px;border-bottom:1px solid #ddd;text-align:right}th{text-align:left}</style></head>
+<body><div id="devices"></div><script>
+var tables = {};
+var source = new EventSource("events" + location.search);
+function show(device, data) {
+        var t = tables[device];
+        if (!t) {
+                t = tables[device] = document.createElement("table");
+                t.innerHTML = "<caption>" + device + "</caption>";
+                document.getElementById("devices").appendChild(t);
+        }
+        for (var field in data) {
+                var row = document.getElementById(device + "/" + field);
+                if (!row) {
+                        row = t.insertRow();
+                        row.id = device + "/" + field;
+                        row.insertCell().outerHTML = "<th>" + field + "</th>";
+                        row.insertCell();
+                }
+                row.cells[1].textContent = field == "ts" ? new Date(data[field] * 1000).toLocaleTimeString() : data[field];
+        }
+}
+var seen = {};
+function listen(device) {
+        if (seen[device]) return;
+        seen[device] = true;
+        source.addEventListener(device, function(e) { show(device, JSON.parse(e.data)); });
+}
+source.addEventListener("devices", function(e) { JSON.parse(e.data).forEach(listen); });
+</script></body></html>
+"""
+
+class Client:
+        __slots__ = ("sock", "addr", "inbuf", "outbuf", "devices", "streaming", "closing")
+
+        def __init__(self, sock, addr):
+                self.sock      = sock
+                self.addr      = addr
+                self.inbuf     = b""
+                self.outbuf    = bytearray()
+                self.devices   = None           # None: all devices
+                self.streaming = False          # request read, events go out
+                self.closing   = False          # close when the buffer is sent
+
+        def wants(self, device):
+                return(self.devices is None or device in self.devices)
+
+class LiveStream:
+        # port:      TCP port of the event stream and the page
+        # maxBuffer: bytes waiting for one client before it is dropped
+        # heartbeat: seconds between two keep-alive comments
+        def __init__(self, port=8086, host="", maxBuffer=256 * 1024, heartbeat=15, debug=False):
+                self.maxBuffer = maxBuffer
+                self.heartbeat = heartbeat
+                self.debug     = debug
+                self.fields    = {}             # series -> (device, field)
+                self.local     = threading.local()      # .pending: device -> {field: value} since the last commit,
+                                                        # per thread, the solarshed workers share the sink
+                self.last      = {}             # device -> last event, for new clients
+                self.clients   = {}             # socket -> Client
+                self.lock      = threading.Lock()
+                self.events    = 0
+                self.dropped   = 0              # clients disconnected for being too slow
+                self.running   = True
+                self.listener  = socket.create_server((host, int(port)))
+                self.listener.setblocking(False)
+                self.wakeRead, self.wakeWrite = socket.socketpair()
+                self.wakeRead.setblocking(False)
+                self.wakeWrite.setblocking(False)
+                self.selector  = selectors.DefaultSelector()
+                self.selector.register(self.listener, selectors.EVENT_READ)
+                self.selector.register(self.wakeRead, selectors.EVENT_READ)
+                self.thread = threading.Thread(target=self.serve, name="liveStream", daemon=True)
+                self.thread.start()
+                if (debug): print("Live stream on port", port)
+
+        # sink interface, see sampleSink.py
+        def append(self, series, value, ts):
+                key = self.fields.get(series)
+                if (key is None): key = self.fields[series] = seriesField(series)
+                self.pendingValues().setdefault(key[0], {})[key[1]] = value
+
+        def pendingValues(self):
+                pending = getattr(self.local, "pending", None)
+                if (pending is None): pending = self.local.pending = {}
+                return(pending)
+
+        def commit(self, ts):
+                pending, self.local.pending = self.pendingValues(), {}
+                with self.lock:
+                        for device, values in pending.items():
+                                message = dict(ts=round(ts, 3) if ts else time.time())
+                                for field, value in values.items():
+                                        message[field] = value if (value == value) else None   # NaN is no JSON
+                                # one encode, the same bytes for every client
+                                event = f"event: {device}\ndata: {json.dumps(message, separators=(',', ':'))}\n\n".encode()
+                                if (device not in self.last):
+                                        self.sendAll(self.devicesEvent(device), device)
+                                self.last[device] = event
+                                self.sendAll(event, device)
+                                self.events += 1
+                if (pending): self.wake()
+
+        # the list of devices, the page adds a table for every one
+        def devicesEvent(self, newDevice=None):
+                devices = sorted(set(self.last) | ({newDevice} if newDevice else set()))
+                return(f"event: devices\ndata: {json.dumps(devices)}\n\n".encode())
+
+        # called with the lock held
+        def sendAll(self, event, device):
+                for client in self.clients.values():
+                        if (not client.streaming or client.closing or not client.wants(device)): continue
+                        if (len(client.outbuf) + len(event) > self.maxBuffer):
+                                if (self.debug): print("Live client", client.addr, "too slow, dropped")
+                                client.outbuf = bytearray()
+                                client.closing = True
+                                self.dropped += 1
+                                continue
+                        client.outbuf += event
+
+        def wake(self):
+                try:
+                        self.wakeWrite.send(b"\0")
+                except BlockingIOError:
+                        pass            # the loop is awake anyway
+
+        def serve(self):
+                lastBeat = time.monotonic()
+                while (self.running):
+                        self.updateInterest()
+                        for key, mask in self.selector.select(self.heartbeat):
+                                if (key.fileobj is self.listener):
+                                        self.accept()
+                                elif (key.fileobj is self.wakeRead):
+                                        try:
+                                                while (self.wakeRead.recv(4096)): pass
+                                        except BlockingIOError:
+                                                pass
+                                else:
+                                        client = self.clients.get(key.fileobj)
+                                        if (client is None): continue
+                                        try:
+                                                if (mask & selectors.EVENT_READ): self.receive(client)
+                                                if (mask & selectors.EVENT_WRITE): self.send(client)
+                                        except Exception as err:        # one broken client, not the stream
+                                                print("Live client", client.addr, "dropped:", repr(err))
+                                                self.drop(client)
+                        if (time.monotonic() - lastBeat >= self.heartbeat):
+                                lastBeat = time.monotonic()
+                                with self.lock:
+                                        for client in self.clients.values():
+                                                if (client.streaming and not client.outbuf): client.outbuf += b": ping\n\n"
+
+        def updateInterest(self):
+                with self.lock:
+                        clients = list(self.clients.values())
+                for client in clients:
+                        if (client.closing and not client.outbuf):
+                                self.drop(client)
+                                continue
+                        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+                        if (self.selector.get_key(client.sock).events != events):
+                                self.selector.modify(client.sock, events)
+
+        def accept(self):
+                try:
+                        sock, addr = self.listener.accept()
+                except BlockingIOError:
+                        return
+                sock.setblocking(False)
+                client = Client(sock, addr)
+                with self.lock:
+                        self.clients[sock] = client
+                self.selector.register(sock, selectors.EVENT_READ)
+
+        def receive(self, client):
+                try:
+                        data = client.sock.recv(4096)
+                except BlockingIOError:
+                        return
+                except OSError:
+                        data = b""
+                if (not data):
+                        self.drop(client)
+                        return
+                if (client.streaming): return          # nothing expected from a subscriber
+                client.inbuf += data
+                if (b"\r\n\r\n" not in client.inbuf):
+                        if (len(client.inbuf) > MAX_REQUEST): self.drop(client)
+                        return
+                requestLine = client.inbuf.split(b"\r\n", 1)[0].decode(errors="replace").split()
+                client.inbuf = b""
+                url = urlsplit(requestLine[1] if (len(requestLine) > 1) else "")
+                with self.lock:
+                        if (len(requestLine) < 2):
+                                client.outbuf += b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                                client.closing = True
+                        elif (requestLine[0] != "GET"):
+                                client.outbuf += b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                                client.closing = True
+                        elif (url.path.endswith("/events")):
+                                devices = parse_qs(url.query).get("device")
+                                client.devices = set(devices) if devices else None
+                                client.outbuf += EVENT_HEAD + self.devicesEvent()
+                                for device, event in self.last.items():
+                                        if (client.wants(device)): client.outbuf += event
+                                client.streaming = True
+                                if (self.debug): print("Live client", client.addr, "subscribed", sorted(client.devices or ["all"]))
+                        elif (url.path == "/"):
+                                client.outbuf += (b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: "
+                                                  + str(len(PAGE)).encode() + b"\r\nConnection: close\r\n\r\n" + PAGE)
+                                client.closing = True
+                        else:
+                                client.outbuf += b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                                client.closing = True
+
+        def send(self, client):
+                with self.lock:
+                        try:
+                                sent = client.sock.send(client.outbuf)
+                        except BlockingIOError:
+                                return
+                        except OSError:
+                                client.outbuf = bytearray()
+                                client.closing = True
+                                return
+                        del client.outbuf[:sent]
+
+        def drop(self, client):
+                with self.lock:
+                        self.clients.pop(client.sock, None)
+                try:
+                        self.selector.unregister(client.sock)
+                except (KeyError, ValueError):
+                        pass
+                client.sock.close()
+
+        def close(self):
+                self.running = False
+                self.wake()
+                self.thread.join(5)
+                for client in list(self.clients.values()):
+                        self.drop(client)
+                self.selector.close()
+                for sock in (self.listener, self.wakeRead, self.wakeWrite):
+                        sock.close()
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Serve .prom files as a live event stream")
+        parser.add_argument("-p", "--port", type=int, default=8086, help="port (default 8086)")
+        parser.add_argument("-w", "--watch", nargs="+", required=True, help=".prom files, sent again when they change")
+        parser.add_argument("-i", "--interval", type=float, default=0.5, help="seconds between two checks of the files (default 0.5)")
+        parser.add_argument("-D", "--debug", action="store_true", help="Enable Debug and above (i.e. all) messages")
+        args = parser.parse_args()
+
+        stream = LiveStream(args.port, debug=args.debug)
+        mtimes = {}
+        try:
+                while True:
+                        for promFile in args.watch:
+                                try:
+                                        mtime = os.path.getmtime(promFile)
+                                        if (mtimes.get(promFile) == mtime): continue
+                                        mtimes[promFile] = mtime
+                                        with open(promFile, mode="r") as fileObj:
+                                                for line in fileObj:
+                                                        sample = parsePromLine(line)
+                                                        if (sample is not None): stream.append(sample[0], sample[1], mtime)
+                                except OSError:
+                                        continue        # replaced right now, next round
+                                stream.commit(mtime)
+                        time.sleep(args.interval)
+        except KeyboardInterrupt:
+                pass
+        stream.close()
+
+# End.
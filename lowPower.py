@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# lowPower.py
+# Description: one timer for all polled devices, aligned slots and longer intervals at night.
+#
+# The collector Pi runs from the battery bank it monitors. Every device loop sleeping on
+# its own timer wakes the CPU at its own moments, a few devices keep it from ever
+# reaching a deep idle state. Here (solarshed.py, "schedule": {"lowPower": true, ...}):
+#  - the poll intervals are rounded up to whole slots ("slot", default 5 s) and aligned to
+#    wall clock multiples of themselves, so devices of 10 s and 30 s are asked in the same
+#    wakeup every 30 s. One thread sleeps until the next slot and releases the due workers.
+#  - the sleep is an absolute timerfd in epoll (no drift, no wakeup between slots). On a
+#    Python or libc without timerfd the epoll timeout is used. The timer slack of the thread
+#    is raised ("slack", 0.05 s) so the kernel can fold the slot into other wakeups close by.
+#  - at night the intervals are stretched ("nightFactor", 6) when the series matching the PV
+#    patterns ("pv", default the ones of snapshotTick.py) sum up to at most "pvThreshold"
+#    (0 W) for "nightAfter" (900 s). The first PV reading above it ends the night at once;
+#    it comes with the stretched interval of the PV device. Without a PV device it is day.
+#  - the wakeups per second of the whole process (voluntary context switches of all
+#    threads, from /proc) and of this timer go to <output>/solarshed_power.prom every
+#    "report" seconds (60), in a slot as well.
+#
+# The BMS can't be scheduled, it sends by itself. In low-power mode its port is read with a
+# long timeout that ends a read after a quiet gap (getChargeryData.py -L), about one
+# wakeup per frame burst instead of ten per second.
+#
+# Output example:
+# solarshed_power{mode="wakeupsPerSec"} 3.2
+# solarshed_power{mode="timerWakeupsPerSec"} 0.2
+# solarshed_power{mode="night"} 0
+#
+# Usage: see solarshed.py and solarshed.example.json
+
+import os, math, time, fnmatch, select, threading
+
+TFD_TIMER_ABSTIME  = 1
+TFD_NONBLOCK       = 0o4000
+TFD_CLOEXEC        = 0o2000000
+PR_SET_TIMERSLACK  = 29
+
+# absolute wall clock timer as a file descriptor, None when there is none
+def timerFd():
+        if (hasattr(os, "timerfd_create")):            # Python 3.13
+                fd = os.timerfd_create(time.CLOCK_REALTIME, flags=os.TFD_NONBLOCK | os.TFD_CLOEXEC)
+                return(fd, lambda at: os.timerfd_settime(fd, flags=os.TFD_TIMER_ABSTIME, initial=at))
+        try:
+                import ctypes
+                libc = ctypes.CDLL(None, use_errno=True)
+                class timespec(ctypes.Structure):
+                        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+                class itimerspec(ctypes.Structure):
+                        _fields_ = [("it_interval", timespec), ("it_value", timespec)]
+                fd = libc.timerfd_create(time.CLOCK_REALTIME, TFD_NONBLOCK | TFD_CLOEXEC)
+                if (fd < 0): return(None, None)
+        except (OSError, AttributeError):
+                return(None, None)
+
+        def settime(at):
+                value = timespec(int(at), int((at % 1) * 1e9))
+                if (libc.timerfd_settime(fd, TFD_TIMER_ABSTIME, ctypes.byref(itimerspec(timespec(0, 0), value)), None) < 0):
+                        raise OSError(ctypes.get_errno(), "timerfd_settime")
+        return(fd, settime)
+
+# how long the kernel may delay the timers of this thread to merge them with others
+def setTimerSlack(seconds):
+        try:
+                import ctypes
+                ctypes.CDLL(None).prctl(PR_SET_TIMERSLACK, ctypes.c_ulong(int(seconds * 1e9)), 0, 0, 0)
+        except (OSError, AttributeError):
+                pass
+
+# voluntary context switches of all threads of this process: every one is a sleep that ended
+def contextSwitches():
+        total = 0
+        for task in os.listdir("/proc/self/task"):
+                try:
+                        with open(f"/proc/self/task/{task}/status", mode='r') as fileObj:
+                                for line in fileObj:
+                                        if (line.startswith("voluntary_ctxt_switches:")):
+                                                total += int(line.split()[1])
+                except OSError:
+                        pass            # the thread just ended
+        return(total)
+
+# a worker in the schedule: wait() returns at its slot, False after remove()
+class Job:
+        def __init__(self, name, interval):
+                self.name     = name
+                self.interval = interval
+                self.nextDue  = None
+                self.removed  = False
+                self.due      = threading.Event()
+
+        def wait(self):
+                self.due.wait()
+                self.due.clear()
+                return(not self.removed)
+
+# Also a sink (append/commit/close): gets the samples of all devices to see the night.
+class SlotScheduler:
+        def __init__(self, slot=5.0, nightFactor=6, nightAfter=900, pvSeries=None, pvThreshold=0.0,
+                     fileName=None, reportInterval=60, slack=0.05, debug=False):
+                if (pvSeries is None):
+                        from snapshotTick import PV_SERIES
+                        pvSeries = PV_SERIES
+                self.slot        = float(slot)
+                self.nightFactor = int(nightFactor)
+                self.nightAfter  = float(nightAfter)
+                self.pvSeries    = pvSeries
+                self.pvThreshold = float(pvThreshold)
+                self.fileName    = fileName
+                self.reportInterval = float(reportInterval)
+                self.slack       = slack
+                self.debug       = debug
+                self.jobs        = []
+                self.lock        = threading.Lock()
+                self.pv          = {}           # PV series -> last value
+                self.pvSeen      = False
+                self.night       = False
+                self.nightSince  = None
+                self.wakeups     = 0
+                self.lastReport  = (time.monotonic(), contextSwitches(), 0)
+                self.running     = True
+                self.epoll       = select.epoll()
+                self.wakeFd      = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+                self.epoll.register(self.wakeFd, select.EPOLLIN)
+                self.timer, self.setTimer = timerFd()
+                if (self.timer is not None): self.epoll.register(self.timer, select.EPOLLIN)
+                self.thread = threading.Thread(target=self.run, name="slots", daemon=True)
+                self.thread.start()
+
+        # whole slots, aligned to multiples of itself, stretched at night
+        def effective(self, interval):
+                slots = max(1, math.ceil(interval / self.slot - 1e-9))
+                if (self.night): slots *= self.nightFactor
+                return(slots * self.slot)
+
+        def nextSlot(self, interval, now):
+                return((math.floor(now / interval + 1e-6) + 1) * interval)
+
+        def add(self, name, interval):
+                job = Job(name, interval)
+                with self.lock:
+                        job.nextDue = self.nextSlot(self.effective(interval), time.time())
+                        self.jobs.append(job)
+                self.wake()
+                return(job)
+
+        def remove(self, job):
+                with self.lock:
+                        if (job in self.jobs): self.jobs.remove(job)
+                job.removed = True
+                job.due.set()
+
+        def wake(self):
+                os.eventfd_write(self.wakeFd, 1)
+
+        def sleepUntil(self, at):
+                if (self.timer is not None):
+                        self.setTimer(max(at, 1e-3))
+                        events = self.epoll.poll()
+                else:
+                        events = self.epoll.poll(max(0.0, at - time.time()))
+                for fd, mask in events:
+                        try:
+                                os.read(fd, 8)
+                        except BlockingIOError:
+                                pass
+
+        def run(self):
+                setTimerSlack(self.slack)
+                nextReport = self.nextSlot(self.effective(self.reportInterval), time.time())
+                while (self.running):
+                        with self.lock:
+                                at = min([job.nextDue for job in self.jobs] + [nextReport])
+                        self.sleepUntil(at)
+                        self.wakeups += 1
+                        now = time.time() + self.slack  # a slot is not missed because the timer fired early
+                        with self.lock:
+                                for job in self.jobs:
+                                        if (job.nextDue <= now):
+                                                job.due.set()
+                                                job.nextDue = self.nextSlot(self.effective(job.interval), now)
+                                                if (self.debug): print("Slot", round(now - self.slack, 3), job.name, "next in", round(job.nextDue - now, 1), "s")
+                        if (nextReport <= now):
+                                self.report()
+                                nextReport = self.nextSlot(self.effective(self.reportInterval), now)
+
+        def setNight(self, night):
+                if (night == self.night): return
+                print("Night mode", "on" if night else "off", "PV", sum(self.pv.values()))
+                with self.lock:
+                        self.night = night
+                        now = time.time()
+                        for job in self.jobs:   # at dawn don't wait for the slot of the night interval
+                                job.nextDue = min(job.nextDue, self.nextSlot(self.effective(job.interval), now))
+                self.wake()
+
+        def report(self):
+                last, lastSwitches, lastWakeups = self.lastReport
+                now, switches = time.monotonic(), contextSwitches()
+                self.lastReport = (now, switches, self.wakeups)
+                if (self.fileName is None or now <= last): return
+                try:
+                        self.writeReport(now - last, switches - lastSwitches, self.wakeups - lastWakeups)
+                except OSError as err:          # the slots go on, the workers wait for them
+                        print("Failed to write", self.fileName, err)
+
+        def writeReport(self, seconds, switches, wakeups):
+                with open(self.fileName + ".tmp", mode='w') as fileObj:
+                        print(f"solarshed_power{{mode=\"wakeupsPerSec\"}} {switches / seconds:.2f}", file=fileObj)
+                        print(f"solarshed_power{{mode=\"timerWakeupsPerSec\"}} {wakeups / seconds:.3f}", file=fileObj)
+                        print(f"solarshed_power{{mode=\"night\"}} {int(self.night)}", file=fileObj)
+                        print(f"solarshed_power{{mode=\"slot\"}} {self.slot}", file=fileObj)
+                        print(f"solarshed_power{{mode=\"jobs\"}} {len(self.jobs)}", file=fileObj)
+                        print(f"solarshed_power{{mode=\"timerfd\"}} {int(self.timer is not None)}", file=fileObj)
+                        if (self.pvSeen): print(f"solarshed_power{{mode=\"pvWatts\"}} {sum(self.pv.values()):.1f}", file=fileObj)
+                os.replace(self.fileName + ".tmp", self.fileName)
+
+        # sink interface, every device file passes here
+        def append(self, series, value, ts):
+                for pattern in self.pvSeries:
+                        if (fnmatch.fnmatchcase(series, pattern)):
+                                self.pv[series] = value
+                                self.pvSeen = True
+
+        def commit(self, ts):
+                if (not self.pvSeen): return
+                if (sum(self.pv.values()) > self.pvThreshold):
+                        self.nightSince = None
+                        self.setNight(False)
+                        return
+                now = time.monotonic()
+                if (self.nightSince is None): self.nightSince = now
+                if (now - self.nightSince >= self.nightAfter): self.setNight(True)
+
+        def close(self):
+                self.running = False
+                self.wake()
+                self.thread.join(5)
+                with self.lock:
+                        jobs, self.jobs = self.jobs, []
+                for job in jobs:
+                        job.removed = True
+                        job.due.set()
+                self.epoll.close()
+                for fd in (self.wakeFd, self.timer):
+                        if (fd is not None): os.close(fd)
+
+# End.
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# memBench.py
+# Description: measure the memory of a collector over a long replay and check it against a budget.
+#
+# On a 512 MB Pi Zero the collectors share the memory with Prometheus and Grafana, a
+# collector that grows a little with every frame takes it away from them after weeks.
+# Every bench runs the decode path of one device in a fresh interpreter and feeds it a
+# capture again and again (-n frames), like a long day on the serial port:
+#  - RSS at the end and its high water mark (VmHWM), interpreter and imports included
+#  - in a second run with tracemalloc: peak of the Python allocations of the device and
+#    the growth between the end of the first quarter and the end of the run. Fixed memory
+#    use means no growth, a few KiB are allowed for the caches filling up. The open
+#    blocks of the local store fill up for tens of thousands of frames (up to 4 KiB per
+#    series, then written), their bytes are in the peak but not counted as growth.
+# The exit code is 1 if a bench is over its budget or still growing.
+#
+# benches:
+#   chargery        one pack: reassembler, decode, .prom files, aggregator, energy, health
+#   chargery-sinks  the same, every value also into the local store and the remote-write
+#                   batches (written to the queue, nothing is sent)
+# The captures (doc/raw_imp_1.txt, hex lines) only hold 0x57 and 0x58 frames, a 0x56 cell
+# frame is put before every line so the snapshots are complete. With a recording of
+# serialRecorder.py (-i rec.ssr -C BMS_A) the received bytes are replayed as they came.
+# The Modbus devices need an answering slave, they are not benched here.
+#
+# Usage: memBench.py [-b chargery] [-n 10000] [-c 16] [-i doc/raw_imp_1.txt | -i rec.ssr -C BMS_A]
+
+import os, sys, json, time, tempfile, subprocess
+from argparse import ArgumentParser, Namespace, SUPPRESS
+
+# bench: (RSS budget in MiB, budget in KiB for the Python allocations of the device). For a Pi Zero.
+BENCHES = {
+        "chargery":       (40, 512),
+        "chargery-sinks": (48, 2048),   # the open store blocks: up to 4 KiB per series
+}
+GROWTH_LIMIT = 64       # KiB between the first quarter and the end of the run
+
+def procStatus(field):
+        with open("/proc/self/status", mode='r') as fileObj:
+                for line in fileObj:
+                        if (line.startswith(field + ":")): return(int(line.split()[1]))      # kB
+        return(0)
+
+# the chunks of received bytes of a capture: hex lines or a recording
+def loadChunks(source, channel, cellCount):
+        import binascii
+        if (".ssr" in source):
+                from serialRecorder import RecordingReader, RX
+                reader = RecordingReader(source)
+                chunks = [bytes(payload) for ts, name, kind, payload in reader.records(channel=channel, kinds=(RX,))]
+                reader.close()
+                return(chunks)
+        chunks = []
+        with open(source, mode='r') as fileObj:
+                for n, line in enumerate(fileObj):
+                        line = line.strip()
+                        if (not line or len(line) % 2): continue
+                        chunks.append(cellFrame(cellCount, n) + binascii.unhexlify(line))
+        return(chunks)
+
+# a valid V1.26 cell block (0x56): voltages, Wh and Ah
+def cellFrame(cellCount, n):
+        frame = bytearray(b"\x24\x24\x56") + bytes([13 + 2 * cellCount])
+        for cell in range(cellCount):
+                frame += (3300 + (n + cell) % 50).to_bytes(2, 'big')
+        frame += (123456 + n).to_bytes(4, 'little') + (2345 + n).to_bytes(4, 'little')
+        frame.append(sum(frame) & 0xff)
+        return(bytes(frame))
+
+# the bytes in the open blocks of the local store, bounded by BLOCK_SIZE per series
+def openBlockBytes(store):
+        if (store is None): return(0)
+        return(sum(sys.getsizeof(head.tsCol) + sys.getsizeof(head.valCol) for head in store.heads.values()))
+
+# runs in the child: replay the chunks into one pack, returns the figures
+def runChargery(chunks, frames, cellCount, directory, sinks, trace):
+        import tracemalloc
+        import getChargeryData as bms
+        from deviceManager import DeviceManager
+        args = Namespace(window=15, store=None, remote_write=None,
+                         energy_state=os.path.join(directory, "energy_{pack}.json"),
+                         health_state=os.path.join(directory, "health_{pack}.json"))
+        if (trace): tracemalloc.start()
+        pack = bms.ChargeryPack("A", os.path.join(directory, "ttyBench"), cellCount, args, DeviceManager(pollInterval=3600),
+                                 protocol="V126")
+        if (sinks):
+                from tsStore import TSStore
+                from remoteWrite import RemoteWriter
+                from sampleSink import SinkFile
+                writer = RemoteWriter("http://127.0.0.1:9/api/v1/write", queueDir=os.path.join(directory, "queue"))
+                writer.running = False          # the batches stay in the queue, nothing is sent
+                writer.wakeup.set()
+                pack.sinks = [TSStore(os.path.join(directory, "store"), writer=pack.metric), writer]
+                pack.nullFile = SinkFile(None, pack.sinks)
+        store = pack.sinks[0] if (sinks) else None
+        for name in ("sysFile", "impFile", "healthFile"):
+                setattr(pack, name, os.path.join(directory, os.path.basename(getattr(pack, name))))
+        result = {}
+        done, i, quarter = 0, 0, None
+        start = time.perf_counter()
+        while (done < frames):
+                for frame in pack.reassembler.feed(chunks[i % len(chunks)]):
+                        bms.handleFrame(pack, frame)
+                        done += 1
+                i += 1
+                if (trace and quarter is None and done >= frames // 4):
+                        quarter = tracemalloc.get_traced_memory()[0] - openBlockBytes(store)
+        result["seconds"] = time.perf_counter() - start
+        result["frames"] = done
+        if (trace):
+                current, peak = tracemalloc.get_traced_memory()
+                result.update(peakKiB=peak / 1024, growthKiB=(current - openBlockBytes(store) - quarter) / 1024)
+        else:
+                result.update(rssMiB=procStatus("VmRSS") / 1024, hwmMiB=procStatus("VmHWM") / 1024)
+        pack.close()
+        return(result)
+
+def child(args):
+        chunks = loadChunks(args.input, args.channel, args.cells)
+        if (not chunks): raise SystemExit(f"{args.input}: no data")
+        tmpfs = "/dev/shm" if os.path.isdir("/dev/shm") else None      # like /ramdisk
+        with tempfile.TemporaryDirectory(prefix="memBench", dir=tmpfs) as directory:
+                result = runChargery(chunks, args.frames, args.cells, directory, args.child == "chargery-sinks", args.trace)
+        print(json.dumps(result))
+
+def runChild(name, args, trace, cwd):
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "-n", str(args.frames), "-c", str(args.cells),
+               "-i", args.input] + (["-C", args.channel] if args.channel else []) + (["--trace"] if trace else [])
+        proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if (proc.returncode != 0):
+                lines = proc.stderr.decode(errors='replace').strip().splitlines()
+                return(None, lines[-1] if lines else "failed")
+        return(json.loads(proc.stdout.decode().strip().splitlines()[-1]), "")
+
+def bench(name, rssBudget, peakBudget, args, cwd):
+        plain, err = runChild(name, args, False, cwd)
+        traced, err2 = runChild(name, args, True, cwd) if plain else (None, err)
+        if (traced is None):
+                print(f"{name}: cannot run ({err or err2}), skipped")
+                return(True)
+        ok = plain["hwmMiB"] <= rssBudget and traced["peakKiB"] <= peakBudget and traced["growthKiB"] <= GROWTH_LIMIT
+        print(f"{name}: {plain['frames']} frames in {plain['seconds']:.1f} s, RSS {plain['rssMiB']:.1f} MiB "
+              f"(peak {plain['hwmMiB']:.1f}, budget {rssBudget}), Python peak {traced['peakKiB']:.0f} KiB "
+              f"(budget {peakBudget}), growth {traced['growthKiB']:.1f} KiB {'ok' if ok else 'OVER BUDGET'}")
+        return(ok)
+
+def main(argv=None):
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        parser = ArgumentParser(description="Check the memory use of the collectors over a long replay")
+        parser.add_argument("-b", "--bench", action="append", choices=sorted(BENCHES), help="only this bench (repeatable)")
+        parser.add_argument("-n", "--frames", type=int, default=10000, help="frames to replay (default 10000)")
+        parser.add_argument("-c", "--cells", type=int, default=16, help="cells of the pack (default 16)")
+        parser.add_argument("-i", "--input", default=os.path.join(cwd, "doc", "raw_imp_1.txt"),
+                            help="capture: hex lines or a serialRecorder.py recording (default doc/raw_imp_1.txt)")
+        parser.add_argument("-C", "--channel", help="channel of the recording (e.g. BMS_A)")
+        parser.add_argument("--rss", type=int, help="RSS budget in MiB for every bench instead of the defaults")
+        parser.add_argument("--child", choices=sorted(BENCHES), help=SUPPRESS)
+        parser.add_argument("--trace", action="store_true", help=SUPPRESS)
+        args = parser.parse_args(argv)
+
+        if (args.child):
+                child(args)
+                return(0)
+        allOk = True
+        for name in (args.bench or BENCHES):
+                rssBudget, peakBudget = BENCHES[name]
+                if (not bench(name, args.rss or rssBudget, peakBudget, args, cwd)): allOk = False
+        return(0 if allOk else 1)
+
+if __name__ == "__main__":
+        sys.exit(main())
+
+# End.
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# metricRegistry.py
+# Description: the metrics every collector writes to /ramdisk, in one place.
+#
+# genDashboards.py builds the Grafana dashboards from this registry. When a collector
+# gets a new value (mode), add it here as well and regenerate the dashboards.
+#
+# device entry:
+#   name     file name of the generated dashboard (dashboards/<name>.json)
+#   title    dashboard title
+#   metric   prometheus metric name, may use the dashboard variable ${pack}
+#   poll     seconds between two samples of the collector, sets the dashboard refresh
+#   vars     dashboard template variables: (name, label query)
+#   groups   rows of panels: (row title, [panel, ...])
+#
+# panel(title, modes, unit, kind, ...):
+#   modes    one mode "SOC", several modes ["temp1", "temp2"] or a pattern "CellNum*".
+#            Several modes or a pattern are read with ONE query (mode=~"..."),
+#            not with one query per series.
+#   kind     timeseries, gauge, stat, bargauge or state (name of the active state of a
+#            state set, metric <name>_state, see promState.py)
+#   metric   other metric than the device one, e.g. "BMS_${pack}_energy"
+#   labels   more label matchers, e.g. 'stat="max"'
+#   expr     a complete query instead, use {sel} for the selector of metric + modes
+#   legend   legend format, default {{mode}} when the query returns several series
+
+def panel(title, modes, unit="none", kind="timeseries", metric=None, labels=None, expr=None, legend=None,
+          min=None, max=None, width=None):
+        return({"title": title, "modes": modes, "unit": unit, "kind": kind, "metric": metric, "labels": labels,
+                "expr": expr, "legend": legend, "min": min, "max": max, "width": width})
+
+CHARGERY = {
+        "name":   "chargery",
+        "title":  "Chargery BMS",
+        "metric": "BMS_${pack}",
+        "poll":   2,
+        "vars":   [("pack", "label_values(pack)")],
+        "groups": [
+                ("Battery pack ${pack}", [
+                        panel("SOC", "SOC", "percent", "gauge", min=0, max=100),
+                        panel("Current", "current", "amp", "stat"),
+                        panel("Power", "power", "watt", "stat"),
+                        panel("Battery Voltage", "aggVolts", "volt", "stat"),
+                        panel("Cell Spread", "cellSpread", "mvolt", "stat"),
+                        panel("Work Mode", "workMode", kind="state", metric="BMS_${pack}_state"),
+                        panel("Current / Power", ["current", "power"], "none"),
+                        panel("Battery Voltage", ["aggVolts", "maxEndVolts", "minEndVolts"], "volt"),
+                        panel("Temperature", ["temp1", "temp2"], "celsius"),
+                        panel("Protection", ["chgProtectionInt", "dsgProtectionInt"], "none"),
+                ]),
+                ("Cells ${pack}", [
+                        panel("Realtime Cell Voltages", "CellNum*", "volt", "bargauge", min=2.5, max=3.65, width=12),
+                        panel("Cell Min / Max / Avg", ["minCell", "maxCell", "avgCell"], "volt"),
+                        panel("Cell Voltages", "CellNum*", "volt", width=12),
+                        panel("Cell Spread (mV)", "cellSpread", "mvolt"),
+                        panel("Current min / max per window", "current", "amp", metric="BMS_${pack}_agg",
+                              labels='stat=~"min|max"', legend="{{stat}}"),
+                ]),
+                ("Impedance ${pack}", [
+                        panel("Realtime Cell Impedance", "CellNumImp*", "mohm", "bargauge", metric="BMS_${pack}_imp", width=12),
+                        panel("Pack Impedance", "aggImpedance", "mohm", metric="BMS_${pack}_imp"),
+                        panel("Frames / min", ["ok", "recovered", "discarded"], "none", metric="BMS_${pack}_frames",
+                              expr="increase({sel}[1m])"),
+                ]),
+                ("Health ${pack}", [
+                        panel("Pack Health", "packHealth", "percent", "gauge", metric="BMS_${pack}_health", min=0, max=100),
+                        panel("Capacity Fade", "capacityFade", "percent", "stat", metric="BMS_${pack}_health"),
+                        panel("Capacity", "capacityAh", "amph", "stat", metric="BMS_${pack}_health"),
+                        panel("Cycles", "cycles", "none", "stat", metric="BMS_${pack}_health"),
+                        panel("Cell Health", "CellNumHealth*", "percent", "bargauge", metric="BMS_${pack}_health",
+                              min=0, max=100, width=12),
+                        panel("Cell Impedance Trend", "CellNumImpTrend*", "mohm", metric="BMS_${pack}_health", width=12),
+                ]),
+                ("Energy ${pack}", [
+                        panel("Charged / Discharged 24h", ["chargeWh", "dischargeWh"], "watth", "stat",
+                              expr="increase({sel}[24h])", metric="BMS_${pack}_energy"),
+                        panel("Efficiency", ["coulombEff", "energyEff"], "percent", "stat"),
+                ]),
+        ],
+}
+
+QC_POWER = {
+        "name":   "qc_power",
+        "title":  "QC Power Meter",
+        "metric": "QC_power",
+        "poll":   1,
+        "vars":   [],
+        "groups": [
+                ("Power", [
+                        panel("Total Watts", "totalWatts", "watt", "stat"),
+                        panel("Energy 24h", "whTotal", "watth", "stat", metric="QC_energy", expr="increase({sel}[24h])"),
+                        panel("Watts", ["wattsA", "wattsB", "totalWatts"], "watt", width=16),
+                        panel("Peak Watts", "watts*", "watt", metric="QC_power_agg", labels='stat="max"', width=12),
+                        panel("Volts", ["voltsA", "voltsB"], "volt"),
+                        panel("Amps", ["ampsA", "ampsB"], "amp"),
+                        panel("Frequency", ["freqA", "freqB"], "hertz"),
+                        panel("Power Factor", ["pfA", "pfB"], "none"),
+                ]),
+        ],
+}
+
+RENOGY = {
+        "name":   "renogy",
+        "title":  "Renogy Wanderer",
+        "metric": "Renogy",
+        "poll":   10,
+        "vars":   [],
+        "groups": [
+                ("Charge controller", [
+                        panel("Battery SOC", "SOC", "percent", "gauge", min=0, max=100),
+                        panel("PV Watts", "pvWatts", "watt", "stat"),
+                        panel("Load Watts", "loadWatts", "watt", "stat"),
+                        panel("Net Battery Watts", "netWatts", "watt", "stat"),
+                        panel("Power In 12h", "pvWh", "watth", "stat", metric="Renogy_energy", expr="increase({sel}[12h])"),
+                        panel("Power Out 12h", "loadWh", "watth", "stat", metric="Renogy_energy", expr="increase({sel}[12h])"),
+                        panel("Power", ["pvWatts", "chgWatts", "loadWatts", "netWatts"], "watt", width=12),
+                        panel("Voltage", ["batVolts", "pvVolts", "maxBatV", "minBatV"], "volt", width=12),
+                        panel("Temperature", "sccTemp", "celsius"),
+                        panel("Today", ["todayGenPwr", "todayConsumPwr"], "watth"),
+                        panel("Charge State", "chargeState", "none"),
+                        panel("Charge State", "chargeState", kind="state", metric="Renogy_state"),
+                ]),
+                ("Daily history", [
+                        panel("Generated 30d", "genWh", "watth", "stat", metric="Renogy_history", expr="{sel} - {sel} offset 30d"),
+                        panel("Consumed 30d", "consumWh", "watth", "stat", metric="Renogy_history", expr="{sel} - {sel} offset 30d"),
+                        panel("Last Day", ["genWh", "consumWh"], "watth", "stat", metric="Renogy_lastDay"),
+                        panel("Last Day Battery", ["minBatV", "maxBatV"], "volt", "stat", metric="Renogy_lastDay"),
+                        panel("Energy per Day", ["genWh", "consumWh"], "watth", metric="Renogy_lastDay", width=24),
+                ]),
+        ],
+}
+
+EPEVER = {
+        "name":   "epever",
+        "title":  "Epever Tracer",
+        "metric": "AB_SolarStats",
+        "poll":   5,
+        "vars":   [],
+        "groups": [
+                ("Charge controller", [
+                        panel("Battery SOC", "batSOC", "percent", "gauge", min=0, max=100),
+                        panel("PV Watts", "pvWatts", "watt", "stat"),
+                        panel("Load Watts", "loadWatts", "watt", "stat"),
+                        panel("Net Battery Watts", "netBatWatts", "watt", "stat"),
+                        panel("Generated Today", "genWatts", "watth", "stat"),
+                        panel("Consumed Today", "conWatts", "watth", "stat"),
+                        panel("Solar Stats", ["pvWatts", "batwatts", "loadWatts", "netBatWatts"], "watt", width=12),
+                        panel("Voltage", ["batVolts", "pvVolts", "loadVolts"], "volt", width=12),
+                        panel("Temperature", ["batTemp", "devTemp"], "celsius"),
+                        panel("Charge Status", "chargeStatVal", "none"),
+                        panel("Charge Status", "chargeStatus", kind="state", metric="AB_SolarStats_state"),
+                        panel("Battery", "sysStatus", kind="state", metric="AB_SolarStats_state"),
+                ]),
+        ],
+}
+
+MPP3048 = {
+        "name":   "mpp3048",
+        "title":  "MPP Solar 3048 split phase",
+        "metric": "MPP3048_P[12]",      # both phases with one query, legend {{__name__}}
+        "poll":   4,
+        "vars":   [],
+        "groups": [
+                ("Both phases", [
+                        panel("PV Watts", "pvWatts", "watt", "stat", metric="MPP3048_total"),
+                        panel("AC Watts", "acWatts", "watt", "stat", metric="MPP3048_total"),
+                        panel("AC Load %", "acLoadPC", "percent", "gauge", metric="MPP3048_total", min=0, max=100),
+                        panel("Battery Capacity", "batCap", "percent", "gauge", min=0, max=100),
+                ]),
+                ("Per phase", [
+                        panel("PV Watts", "pvWatts", "watt"),
+                        panel("AC Watts", "acWatts", "watt"),
+                        panel("Volts", ["gridVolts", "batVolts", "pvVolts"], "volt", width=12),
+                        panel("Status", ["sccOK", "sccCharging", "acCharging", "acLost", "acLoadOn",
+                                         "batOverV", "batUnderV"], "none", width=12),
+                        panel("Work Mode", "workMode", kind="state", metric="MPP3048_P[12]_state"),
+                        panel("Charger Source", "srcMode", kind="state", metric="MPP3048_P[12]_state"),
+                        panel("Fault Code", "faultCode", "none", "stat"),
+                ]),
+        ],
+}
+
+MPP5048MGX = {
+        "name":   "mpp5048mgx",
+        "title":  "MPP Solar 5048 MGX",
+        "metric": "MPP5048MGX",
+        "poll":   4,
+        "vars":   [],
+        "groups": [
+                ("Inverter", [
+                        panel("Battery Capacity", "batCap", "percent", "gauge", min=0, max=100),
+                        panel("PV Watts", "pvWatts", "watt", "stat"),
+                        panel("AC Watts", "acWatts", "watt", "stat"),
+                        panel("AC Load %", "acLoadPC", "percent", "gauge", min=0, max=100),
+                        panel("Grid Frequency", "gridHz", "hertz", "stat"),
+                        panel("Power", ["pvWatts", "acWatts"], "watt", width=12),
+                        panel("Volts", ["gridVolts", "acOutVolt", "batVolts", "pvVolts"], "volt", width=12),
+                        panel("Heat Sink Temp", "heatSinkTemp", "celsius"),
+                        panel("Status", ["sccCharging", "acCharging", "acLoadOn", "confChange"], "none"),
+                        panel("Battery Settings", ["batBulkV", "batFloatV", "batUnderVSet"], "volt", "stat"),
+                ]),
+        ],
+}
+
+SNAPSHOT = {
+        "name":   "snapshot",
+        "title":  "Energy Balance",
+        "metric": "snapshot",
+        "poll":   5,
+        "vars":   [],
+        "groups": [
+                ("Balance", [
+                        panel("PV Watts", "pvWatts", "watt", "stat"),
+                        panel("Load Watts", "loadWatts", "watt", "stat"),
+                        panel("Battery Watts", "batteryWatts", "watt", "stat"),
+                        panel("Loss Watts", "lossWatts", "watt", "stat"),
+                        panel("Balance", ["pvWatts", "loadWatts", "batteryWatts", "lossWatts"], "watt", width=24),
+                ]),
+                ("Sampling", [
+                        panel("Poll Time", "pollTime", "s", legend="{{device}}"),
+                        panel("Value Age", "age", "s", legend="{{device}}"),
+                        panel("Missed Ticks", "missed", "none", expr="increase({sel}[1h])", legend="{{device}}"),
+                        panel("Complete", "complete", "none"),
+                ]),
+        ],
+}
+
+LOW_POWER = {
+        "name":   "lowpower",
+        "title":  "Collector Power",
+        "metric": "solarshed_power",
+        "poll":   60,
+        "vars":   [],
+        "groups": [
+                ("Wakeups", [
+                        panel("Wakeups/s", "wakeupsPerSec", "none", "stat"),
+                        panel("Timer Wakeups/s", "timerWakeupsPerSec", "none", "stat"),
+                        panel("Night", "night", "none", "stat"),
+                        panel("Wakeups", ["wakeupsPerSec", "timerWakeupsPerSec"], "none", width=24),
+                ]),
+        ],
+}
+
+DEVICES = [CHARGERY, QC_POWER, RENOGY, EPEVER, MPP3048, MPP5048MGX, SNAPSHOT, LOW_POWER]
+
+# End.
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# mppSession.py
+# Description: keep the MPP Solar inverter (PI30 protocol over USB hidraw) open and poll
+# it without starting mpp-solar for every command.
+#
+# getMPPSolarMGX.sh runs "mpp-solar -p /dev/hidraw0 -c ..." once per command: every call
+# starts python, imports mpp-solar and opens the device again, a few seconds per sample
+# on a Pi Zero. Here the device stays open and the commands go out back to back:
+#  - PI30 framing: command + CRC-16/XMODEM + CR, written in 8 byte HID reports
+#  - the answer "(...<crc><cr>" is read into one reused buffer and checked (CRC, NAK)
+#  - QID (serial number) and QPIRI (ratings) don't change, they are read at start, every
+#    --refresh seconds and when QPIGS reports is_configuration_changed
+#  - QPIGS is polled every --interval seconds (default 1 s instead of 4 s)
+#  - the device is followed with deviceManager.py and reopened after a USB glitch
+#
+# Output: /ramdisk/<name>.prom with the same series as getMPPSolarMGX.sh, so it can
+# replace the script and the dashboards keep working.
+# The serial number and battery type are info labels in /ramdisk/<name>_info.prom.
+#
+# Usage: mppSession.py [-p /dev/hidraw0] [-n MPP5048MGX] [-i 1] [-c QPIGS] [-A alertRules.json] [-M broker] [-D]
+
+import os, sys, time, select
+from argparse import ArgumentParser
+from sampleSink import openPromFile
+from promState import InfoFile
+from deviceManager import DeviceManager
+from profHooks import stageTimer
+
+debug = False
+
+# CRC-16/XMODEM lookup table
+CRC_TABLE = []
+for i in range(256):
+        crc = i << 8
+        for j in range(8):
+                crc = ((crc << 1) ^ 0x1021) if (crc & 0x8000) else (crc << 1)
+        CRC_TABLE.append(crc & 0xffff)
+
+# PI30 CRC: XMODEM, but a byte equal to '(' CR or LF is sent one higher
+def crcBytes(data):
+        crc = 0
+        for b in data:
+                crc = ((crc << 8) & 0xffff) ^ CRC_TABLE[(crc >> 8) ^ b]
+        hi, lo = crc >> 8, crc & 0xff
+        if (hi in (0x28, 0x0d, 0x0a)): hi += 1
+        if (lo in (0x28, 0x0d, 0x0a)): lo += 1
+        return(bytes((hi, lo)))
+
+def frameCommand(cmd):
+        data = cmd.encode("ascii")
+        return(data + crcBytes(data) + b"\r")
+
+# QPIGS fields (PI30), position -> name as printed by mpp-solar
+QPIGS_FIELDS = ["ac_input_voltage", "ac_input_frequency", "ac_output_voltage", "ac_output_frequency",
+                "ac_output_apparent_power", "ac_output_active_power", "ac_output_load", "bus_voltage",
+                "battery_voltage", "battery_charging_current", "battery_capacity", "inverter_heat_sink_temperature",
+                "pv_input_current_for_battery", "pv_input_voltage", "battery_voltage_from_scc",
+                "battery_discharge_current", "device_status", "battery_voltage_offset_for_fans_on",
+                "eeprom_version", "pv_input_power", "device_status2"]
+# device_status bits, left to right
+QPIGS_FLAGS  = ["is_sbu_priority_version_added", "is_configuration_changed", "is_scc_firmware_updated",
+                "is_load_on", "is_battery_voltage_to_steady_while_charging", "is_charging_on",
+                "is_scc_charging_on", "is_ac_charging_on"]
+QPIRI_FIELDS = ["ac_input_voltage", "ac_input_current", "ac_output_voltage", "ac_output_frequency",
+                "ac_output_current", "ac_output_apparent_power", "ac_output_active_power", "battery_voltage",
+                "battery_recharge_voltage", "battery_under_voltage", "battery_bulk_charge_voltage",
+                "battery_float_charge_voltage", "battery_type", "max_ac_charging_current", "max_charging_current"]
+
+# series of the .prom file: (mode, QPIGS field), same names as getMPPSolarMGX.sh
+PROM_VALUES = [("gridVolts", "ac_input_voltage"), ("batVolts", "battery_voltage"), ("pvVolts", "pv_input_voltage"),
+               ("pvAmps", "pv_input_current_for_battery"), ("batCap", "battery_capacity"),
+               ("pvWatts", "pv_input_power"), ("acWatts", "ac_output_active_power"), ("acLoadPC", "ac_output_load"),
+               ("gridHz", "ac_input_frequency"), ("acOutVolt", "ac_output_voltage"), ("acOutHz", "ac_output_frequency"),
+               ("heatSinkTemp", "inverter_heat_sink_temperature"), ("sccCharging", "is_scc_charging_on"),
+               ("acCharging", "is_ac_charging_on"), ("acLoadOn", "is_load_on"), ("confChange", "is_configuration_changed")]
+# ratings from QPIRI: (mode, field)
+PROM_RATINGS = [("ratedWatts", "ac_output_active_power"), ("batBulkV", "battery_bulk_charge_voltage"),
+                ("batFloatV", "battery_float_charge_voltage"), ("batUnderVSet", "battery_under_voltage")]
+
+def parseFields(payload, names):
+        result = {}
+        for name, value in zip(names, payload.split(" ")):
+                result[name] = value
+        return(result)
+
+def parseQPIGS(payload):
+        result = parseFields(payload, QPIGS_FIELDS)
+        for name, bit in zip(QPIGS_FLAGS, result.get("device_status", "")):
+                result[name] = bit
+        return(result)
+
+class MppSession:
+        def __init__(self, devSpec, timeout=2.0, devices=None):
+                self.device  = (devices or DeviceManager(debug=debug)).watch(devSpec)
+                self.timeout = timeout
+                self.fd      = None
+                self.buf     = bytearray(512)   # the answer, reused for every command
+                self.chunk   = bytearray(64)    # one HID read
+                self.latency = {}               # command -> seconds of the last call
+
+        def openHid(self, path):
+                return(os.open(path, os.O_RDWR | os.O_NONBLOCK))
+
+        def close(self):
+                if (self.fd is not None):
+                        try:
+                                os.close(self.fd)
+                        except OSError:
+                                pass
+                self.fd = None
+
+        def ensureOpen(self):
+                if (self.fd is not None and not self.device.changed()): return
+                self.close()
+                self.fd = self.device.open(self.openHid)
+                self.drain()
+
+        # throw away what is left from an aborted command
+        def drain(self):
+                try:
+                        while (select.select([self.fd], [], [], 0)[0] and os.readv(self.fd, [self.chunk]) > 0): pass
+                except OSError:
+                        pass
+
+        # send one command, return the payload without "(" and CRC
+        def command(self, cmd):
+                self.ensureOpen()
+                start = time.monotonic()
+                frame = frameCommand(cmd)
+                try:
+                        for pos in range(0, len(frame), 8):     # HID report size
+                                os.write(self.fd, frame[pos:pos+8])
+                        length = self.readAnswer(start)
+                except OSError:
+                        self.close()                            # reopened with the next command
+                        raise
+                answer = memoryview(self.buf)[:length]
+                if (length < 3 or answer[0] != 0x28):
+                        raise IOError(f"{cmd}: bad answer {bytes(answer)!r}")
+                if (bytes(answer[-2:]) != crcBytes(answer[:-2])):
+                        raise IOError(f"{cmd}: CRC error {bytes(answer)!r}")
+                payload = bytes(answer[1:-2]).decode("ascii", errors="replace")
+                if (payload.startswith("NAK")): raise IOError(f"{cmd}: NAK")
+                self.latency[cmd] = time.monotonic() - start
+                if (debug): print(f"{cmd}: {payload} ({self.latency[cmd] * 1000:.0f} ms)")
+                return(payload)
+
+        # read up to the CR into self.buf, the last HID report is padded with 0 bytes after the
+        # CR (a 0 before it is a CRC byte)
+        def readAnswer(self, start):
+                length = 0
+                while True:
+                        remaining = self.timeout - (time.monotonic() - start)
+                        if (remaining <= 0): raise TimeoutError("no answer from " + str(self.device.path))
+                        if (not select.select([self.fd], [], [], remaining)[0]): continue
+                        count = os.readv(self.fd, [self.chunk])
+                        if (count <= 0): raise IOError("device closed")
+                        cr = self.chunk.find(b"\r", 0, count)
+                        end = count if (cr < 0) else cr
+                        if (length + end > len(self.buf)): raise IOError("answer too long")
+                        self.buf[length:length + end] = self.chunk[:end]
+                        length += end
+                        if (cr >= 0): return(length)
+
+def writeStatus(fileObj, name, status, rated):
+        for mode, field in PROM_VALUES:
+                value = status.get(field)
+                if (value is None or value == ""): continue
+                print(f"{name}{{mode=\"{mode}\"}} {value}", file=fileObj)
+        for mode, field in PROM_RATINGS:
+                value = rated.get(field)
+                if (value): print(f"{name}{{mode=\"{mode}\"}} {value}", file=fileObj)
+
+# one QPIGS poll, QID/QPIRI only at start, every refresh seconds and after a settings change.
+# Also used by snapshotTick.py.
+class MppReader:
+        # retry: seconds to the next QID/QPIRI after a failed one, the last ratings stay
+        def __init__(self, session, name, directory="/ramdisk", refresh=3600, retry=60):
+                self.session    = session
+                self.name       = name
+                self.refresh    = refresh
+                self.retry      = retry
+                self.infoFile   = InfoFile(os.path.join(directory, name + "_info.prom"))  # serial number, see promState.py
+                self.rated      = {}
+                self.lastStatic = None
+
+        def read(self, fileObj):
+                now = time.monotonic()
+                if (self.lastStatic is None or now - self.lastStatic >= self.refresh):
+                        try:
+                                serial = self.session.command("QID")
+                                self.rated = parseFields(self.session.command("QPIRI"), QPIRI_FIELDS)
+                                self.infoFile.set(self.name + "_info", serial=serial, batteryType=self.rated.get("battery_type"))
+                                self.lastStatic = now
+                        except (IOError, ValueError) as err:
+                                print("MPP ratings not read, again in", self.retry, "s:", err)
+                                self.lastStatic = now - self.refresh + self.retry
+                status = parseQPIGS(self.session.command("QPIGS"))
+                if (status.get("is_configuration_changed") == "1"): self.lastStatic = None     # settings changed
+                writeStatus(fileObj, self.name, status, self.rated)
+
+def poll(session, args, sinks):
+        fileName = os.path.join(args.dir, args.name + ".prom")
+        reader = MppReader(session, args.name, args.dir, args.refresh)
+        stages = stageTimer(args.name)
+        nextPoll = time.monotonic()
+        while True:
+                stages.begin()
+                try:
+                        with openPromFile(fileName + ".tmp", sinks) as fileObj:
+                                reader.read(fileObj)
+                                stages.mark("poll")
+                        os.replace(fileName + ".tmp", fileName)
+                        stages.mark("publish")
+                except OSError as err:
+                        print("MPP read failed:", err)
+                nextPoll += args.interval
+                delay = nextPoll - time.monotonic()
+                if (delay > 0):
+                        time.sleep(delay)
+                else:
+                        nextPoll = time.monotonic()             # behind, don't try to catch up
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Poll an MPP Solar inverter over a persistent hidraw session")
+        parser.add_argument("-p", "--port", default="/dev/hidraw0",
+                            help="hidraw device (/dev/hidraw0 [default] or usb:VID:PID@hidraw, see deviceManager.py)")
+        parser.add_argument("-n", "--name", default="MPP5048MGX", help="metric name and file name (default: MPP5048MGX)")
+        parser.add_argument("-d", "--dir", default="/ramdisk", help="output directory (default: /ramdisk)")
+        parser.add_argument("-i", "--interval", type=float, default=1.0, help="QPIGS poll interval in seconds (default: 1)")
+        parser.add_argument("-r", "--refresh", type=float, default=3600, help="read QID/QPIRI again after seconds (default: 3600)")
+        parser.add_argument("-c", "--command", action="append", help="send this command, print the answer and exit (repeatable)")
+        parser.add_argument("-S", "--store", help="Also write every sample into the local time-series store in this directory")
+        parser.add_argument("-R", "--remote-write", help="Also push all samples to this Prometheus remote-write URL")
+        parser.add_argument("-A", "--alerts", help="Check every value against the local alert rules in this file")
+        parser.add_argument("-M", "--mqtt", help="Also publish the changed values to this MQTT broker (host[:port])")
+        parser.add_argument("-E", "--events", type=int, help="Also serve every sample as a live event stream (SSE) on this port")
+        parser.add_argument("-D", "--debug", action="store_true", help="Enable Debug and above (i.e. all) messages")
+        args = parser.parse_args()
+        debug = args.debug
+
+        session = MppSession(args.port)
+        if (args.command):
+                for cmd in args.command:
+                        print(cmd + ":", session.command(cmd))
+                sys.exit(0)
+
+        import profHooks
+        profHooks.install("mppSession-" + args.name, debug=debug)     # kill -USR1 / profHooks.py: profile the running poll
+
+        sinks = []
+        if (args.store):
+                from tsStore import TSStore
+                sinks.append(TSStore(args.store, writer=args.name))
+        if (args.remote_write):
+                from remoteWrite import RemoteWriter
+                sinks.append(RemoteWriter(args.remote_write, queueDir="/var/spool/solarshed/" + args.name, debug=debug))
+        if (args.alerts):
+                from alertEngine import AlertEngine
+                sinks.append(AlertEngine(args.alerts, debug=debug))
+        if (args.mqtt):
+                from mqttSink import MqttSink
+                sinks.append(MqttSink(args.mqtt, debug=debug))
+        if (args.events):
+                from liveStream import LiveStream
+                sinks.append(LiveStream(args.events, debug=debug))
+        try:
+                poll(session, args, sinks)
+        except KeyboardInterrupt:
+                pass
+        for sink in sinks:
+                sink.close()
+
+# End.
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+# mqttSink.py
+# Description: publish the collector samples to an MQTT broker (Home Assistant, Node-RED,
+# local automations) as soon as a snapshot is complete.
+#
+# Scraping the .prom files adds 5-15 s, over MQTT a value is out within the poll.
+# The sink (see sampleSink.py) keeps one connection to the broker:
+#  - one message per device (metric) and snapshot on <topic>/<device>, e.g. solarshed/BMS_A,
+#    compact JSON with only the fields that changed since the last message:
+#      {"ts":1700000000.0,"SOC":81.0,"CellNum3":3.312}
+#    the field is the mode, other labels are added with a dot (current.max, workMode.Charge),
+#    the pack label is left out, it is already in the device name.
+#  - every fullEvery seconds and after a reconnect all fields are sent, a client that
+#    subscribes later (or missed messages) has the complete state again after that
+#  - minimal MQTT 3.1.1 client below (CONNECT, PUBLISH QoS 0, PINGREQ), no paho needed.
+#    A background thread sends, the serial readers never wait for the network.
+#  - while the broker is down the messages wait in a bounded queue, the oldest are
+#    dropped when it is full
+#
+# Shell collectors (exportData.sh for getTracerData.py, getMPPSolar.sh) publish their .prom
+# file once after writing it, the state file keeps the values of the last run:
+#   mqttSink.py -s localhost -c /var/lib/solarshed/mqtt_AB_SolarStats.json /ramdisk/solarData.txt.prom
+# A local stand-in broker for tests, it prints every message:
+#   mqttSink.py -b 1883
+
+import os, sys, json, time, socket, select, struct, threading
+from collections import deque
+from argparse import ArgumentParser
+from sampleSink import splitSeries, parsePromLine
+
+CONNECT     = 1
+CONNACK     = 2
+PUBLISH     = 3
+SUBSCRIBE   = 8
+SUBACK      = 9
+PINGREQ     = 12
+PINGRESP    = 13
+DISCONNECT  = 14
+
+############ MQTT 3.1.1 packets ############
+
+def encodeString(text):
+        data = text.encode() if isinstance(text, str) else text
+        return(struct.pack("!H", len(data)) + data)
+
+def encodePacket(kind, flags, body):
+        header = bytearray([(kind << 4) | flags])
+        length = len(body)
+        while True:                     # remaining length, 7 bits per byte
+                byte = length & 0x7f
+                length >>= 7
+                header.append(byte | 0x80 if length else byte)
+                if (not length): break
+        return(bytes(header) + body)
+
+def connectPacket(clientId, keepalive, username=None, password=None):
+        flags = 0x02                    # clean session
+        payload = encodeString(clientId)
+        if (username is not None):
+                flags |= 0x80
+                payload += encodeString(username)
+                if (password is not None):
+                        flags |= 0x40
+                        payload += encodeString(password)
+        return(encodePacket(CONNECT, 0, encodeString("MQTT") + bytes([4, flags]) + struct.pack("!H", keepalive) + payload))
+
+def publishPacket(topic, payload, retain=False):
+        return(encodePacket(PUBLISH, 1 if retain else 0, encodeString(topic) + payload))
+
+def recvExact(sock, size):
+        data = b""
+        while (len(data) < size):
+                chunk = sock.recv(size - len(data))
+                if (not chunk): raise ConnectionError("connection closed")
+                data += chunk
+        return(data)
+
+# one packet: (type, flags, body)
+def readPacket(sock):
+        first = recvExact(sock, 1)[0]
+        length, shift = 0, 0
+        while True:
+                byte = recvExact(sock, 1)[0]
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if (not byte & 0x80): break
+                if (shift > 21): raise ValueError("bad remaining length")
+        return(first >> 4, first & 0x0f, recvExact(sock, length) if length else b"")
+
+# "host", "host:port"
+def parseBroker(spec):
+        host, _, port = spec.partition(":")
+        return(host or "localhost", int(port) if port else 1883)
+
+############ sink ############
+
+# series -> (device, field): BMS_A{mode="current", stat="max", pack="A"} -> ("BMS_A", "current.max")
+def seriesField(series, dropLabels=("pack",)):
+        metric, labels = splitSeries(series)
+        mode = [v for k, v in labels if k == "mode"]
+        rest = [v for k, v in labels if k != "mode" and k not in dropLabels]
+        return(metric, ".".join(mode + rest) or "value")
+
+class MqttSink:
+        # broker:    "host" or "host:port"
+        # topic:     topic prefix, the device name is added: solarshed/BMS_A
+        # fullEvery: seconds between two messages with all fields, None: only changes
+        # maxQueue:  messages kept while the broker is not reachable
+        def __init__(self, broker, topic="solarshed", clientId=None, keepalive=60, fullEvery=300,
+                     maxQueue=1000, retain=False, username=None, password=None, debug=False):
+                self.host, self.port = parseBroker(broker)
+                self.topic     = topic.rstrip("/")
+                self.clientId  = clientId or f"solarshed-{socket.gethostname()}-{os.getpid()}"
+                self.keepalive = keepalive
+                self.fullEvery = fullEvery
+                self.retain    = retain
+                self.username  = username
+                self.password  = password
+                self.debug     = debug
+                self.fields    = {}             # series -> (device, field), most series repeat
+                self.local     = threading.local()      # .pending: device -> {field: value} since the last commit,
+                                                        # per thread, the solarshed workers share the sink
+                self.last      = {}             # device -> {field: value} last published
+                self.lastFull  = {}             # device -> monotonic time of the last full message
+                self.queue     = deque()
+                self.maxQueue  = maxQueue
+                self.lock      = threading.Lock()
+                self.cond      = threading.Condition(self.lock)
+                self.sock      = None
+                self.sent      = 0
+                self.dropped   = 0
+                self.running   = True
+                self.stopped   = threading.Event()
+                self.thread = threading.Thread(target=self.sender, name="mqttSink", daemon=True)
+                self.thread.start()
+
+        # sink interface, see sampleSink.py
+        def append(self, series, value, ts):
+                key = self.fields.get(series)
+                if (key is None): key = self.fields[series] = seriesField(series)
+                self.pendingValues().setdefault(key[0], {})[key[1]] = value
+
+        def pendingValues(self):
+                pending = getattr(self.local, "pending", None)
+                if (pending is None): pending = self.local.pending = {}
+                return(pending)
+
+        def commit(self, ts):
+                now = time.monotonic()
+                pending, self.local.pending = self.pendingValues(), {}
+                with self.lock:
+                        for device, values in pending.items():
+                                last = self.last.setdefault(device, {})
+                                lastFull = self.lastFull.get(device)
+                                if (self.fullEvery is not None and (lastFull is None or now - lastFull >= self.fullEvery)):
+                                        last.update(values)
+                                        changed = last
+                                        self.lastFull[device] = now
+                                else:
+                                        changed = {k: v for k, v in values.items() if last.get(k) != v}
+                                        last.update(changed)
+                                if (not changed): continue
+                                message = dict(ts=round(ts, 3) if ts else time.time())
+                                message.update(changed)
+                                self.put(self.topic + "/" + device, json.dumps(message, separators=(",", ":")).encode())
+
+        # called with the lock held
+        def put(self, topic, payload):
+                if (len(self.queue) >= self.maxQueue):
+                        self.queue.popleft()
+                        self.dropped += 1
+                self.queue.append((topic, payload))
+                self.cond.notify()
+
+        def connect(self):
+                sock = socket.create_connection((self.host, self.port), timeout=10)
+                try:
+                        sock.sendall(connectPacket(self.clientId, self.keepalive, self.username, self.password))
+                        kind, flags, body = readPacket(sock)
+                        if (kind != CONNACK or len(body) < 2 or body[1] != 0):
+                                raise ConnectionError(f"broker refused the connection: {body.hex()}")
+                except (OSError, ValueError):
+                        sock.close()
+                        raise
+                sock.settimeout(10)
+                if (self.debug): print("MQTT connected to", self.host, self.port)
+                return(sock)
+
+        def disconnect(self):
+                if (self.sock is None): return
+                try:
+                        self.sock.sendall(encodePacket(DISCONNECT, 0, b""))
+                except OSError:
+                        pass
+                self.sock.close()
+                self.sock = None
+
+        def sender(self):
+                backoff = 1
+                lastSend = lastRecv = time.monotonic()
+                while (self.running or self.queue):
+                        if (self.sock is None):
+                                try:
+                                        self.sock = self.connect()
+                                        lastSend = lastRecv = time.monotonic()
+                                        backoff = 1
+                                        with self.lock:
+                                                self.lastFull.clear()   # subscribers may have missed messages, all fields next
+                                except (OSError, ValueError) as err:
+                                        if (self.debug): print("MQTT connect failed:", err)
+                                        if (not self.running): return
+                                        self.stopped.wait(backoff)
+                                        backoff = min(backoff * 2, 60)
+                                        continue
+                        with self.lock:
+                                if (not self.queue and self.running): self.cond.wait(self.keepalive / 2)
+                                item = self.queue.popleft() if self.queue else None
+                        try:
+                                now = time.monotonic()
+                                if (item is not None):
+                                        self.sock.sendall(publishPacket(item[0], item[1], self.retain))
+                                        self.sent += 1
+                                        lastSend = now
+                                elif (now - lastSend >= self.keepalive / 2):
+                                        self.sock.sendall(encodePacket(PINGREQ, 0, b""))
+                                        lastSend = now
+                                while (select.select([self.sock], [], [], 0)[0]):
+                                        readPacket(self.sock)           # PINGRESP, nothing else is expected
+                                        lastRecv = now
+                                if (now - lastRecv > self.keepalive * 1.5):
+                                        raise ConnectionError("no answer from the broker")
+                        except (OSError, ValueError) as err:
+                                if (self.debug): print("MQTT connection lost:", err)
+                                if (item is not None):
+                                        with self.lock:
+                                                self.queue.appendleft(item)     # sent again after the reconnect
+                                self.sock.close()
+                                self.sock = None
+                self.disconnect()
+
+        # send what is queued (up to timeout seconds), then disconnect
+        def close(self, timeout=5):
+                with self.lock:
+                        self.running = False
+                        self.cond.notify()
+                self.stopped.set()
+                self.thread.join(timeout)
+
+################ main ##################
+
+# stand-in broker: CONNECT, SUBSCRIBE (+ and # wildcards), PUBLISH QoS 0, PINGREQ
+def topicMatches(pattern, topic):
+        pat, parts = pattern.split("/"), topic.split("/")
+        for i, level in enumerate(pat):
+                if (level == "#"): return(True)
+                if (i >= len(parts) or (level != "+" and level != parts[i])): return(False)
+        return(len(pat) == len(parts))
+
+def runBroker(port):
+        import socketserver
+        clients = {}            # handler -> [topic filters]
+        lock = threading.Lock()
+
+        class Client(socketserver.BaseRequestHandler):
+                def handle(self):
+                        sock = self.request
+                        try:
+                                while True:
+                                        kind, flags, body = readPacket(sock)
+                                        if (kind == CONNECT):
+                                                with lock: clients[self] = []
+                                                sock.sendall(encodePacket(CONNACK, 0, b"\x00\x00"))
+                                        elif (kind == SUBSCRIBE):
+                                                packetId, pos, granted = body[:2], 2, b""
+                                                while (pos < len(body)):
+                                                        size = struct.unpack_from("!H", body, pos)[0]
+                                                        with lock: clients[self].append(body[pos + 2:pos + 2 + size].decode())
+                                                        pos += 3 + size
+                                                        granted += b"\x00"
+                                                sock.sendall(encodePacket(SUBACK, 0, packetId + granted))
+                                        elif (kind == PUBLISH):
+                                                size = struct.unpack_from("!H", body, 0)[0]
+                                                topic = body[2:2 + size].decode()
+                                                payload = body[2 + size + (2 if flags & 0x06 else 0):]
+                                                print(topic, payload.decode(errors="replace"), flush=True)
+                                                with lock: targets = [c for c, f in clients.items() if any(topicMatches(p, topic) for p in f)]
+                                                for client in targets:
+                                                        try:
+                                                                client.request.sendall(publishPacket(topic, payload))
+                                                        except OSError:
+                                                                pass
+                                        elif (kind == PINGREQ):
+                                                sock.sendall(encodePacket(PINGRESP, 0, b""))
+                                        elif (kind == DISCONNECT):
+                                                break
+                        except (OSError, ValueError):
+                                pass
+                        with lock: clients.pop(self, None)
+
+        class Server(socketserver.ThreadingTCPServer):
+                allow_reuse_address = True
+                daemon_threads = True
+
+        print("MQTT stand-in broker listening on port", port, flush=True)
+        Server(("", port), Client).serve_forever()
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="MQTT publisher helper")
+        parser.add_argument("-b", "--broker", type=int, help="Run a local stand-in broker on this port", default=None)
+        parser.add_argument("-s", "--send", help="Publish the .prom files given as arguments to this broker (host[:port])")
+        parser.add_argument("-t", "--topic", default="solarshed", help="topic prefix (default: solarshed)")
+        parser.add_argument("-c", "--state", help="state file with the values of the last run, only changes are sent")
+        parser.add_argument("files", nargs="*", help=".prom files for --send")
+        args = parser.parse_args()
+
+        if (args.broker):
+                runBroker(args.broker)
+        elif (args.send):
+                # one shot, for the shell collectors
+                sink = MqttSink(args.send, args.topic, fullEvery=None)
+                if (args.state):
+                        try:
+                                with open(args.state, mode='r') as fileObj:
+                                        sink.last = json.load(fileObj)
+                        except (OSError, ValueError):
+                                pass
+                for promFile in args.files:
+                        ts = os.path.getmtime(promFile)
+                        with open(promFile, mode="r") as fileObj:
+                                for line in fileObj:
+                                        sample = parsePromLine(line)
+                                        if (sample is not None): sink.append(sample[0], sample[1], ts)
+                        sink.commit(ts)
+                sink.close(timeout=10)
+                if (sink.queue):
+                        print("MQTT broker not reachable, the changes are sent with the next run")
+                        sys.exit(1)
+                if (args.state):
+                        with open(args.state + ".tmp", mode='w') as fileObj:
+                                json.dump(sink.last, fileObj)
+                        os.replace(args.state + ".tmp", args.state)
+        else:
+                parser.print_help()
+
+# End.
@@ -8,11 +8,67 @@
 # live data is written in prometheus compatible format in /ramdisk 
 # look for the prometheus tag QC_power in Grafana. 
 
-import minimalmodbus
-import serial, time, sys, os
+import time, sys, os
+from windowAggregator import WindowAggregator
+from energyCounter import EnergyIntegrator
+from sampleSink import openPromFile
+from rs485Bus import getBus
 
 debug=False
 
+# min/max/mean of every reading over one scrape interval, see windowAggregator.py
+aggWindow = 15
+aggregator = WindowAggregator(aggWindow)
+
+# Wh per phase, integrated from every reading. Keep the state file off /ramdisk.
+energyState = '/var/lib/solarshed/QC_energy.json'
+integrator = EnergyIntegrator(energyState)
+
+# set a directory (e.g. '/home/pi/tsdb') to keep every reading in the local time-series store
+storeDir = None
+sinks = []
+if (storeDir):
+    from tsStore import TSStore     # only loaded when used, keeps the start fast
+    sinks.append(TSStore(storeDir, writer="QC_power"))
+
+# set an URL (e.g. 'http://prometheus:9090/api/v1/write') to push the readings with remote-write
+remoteWriteUrl = None
+if (remoteWriteUrl):
+    from remoteWrite import RemoteWriter
+    sinks.append(RemoteWriter(remoteWriteUrl, queueDir="/var/spool/solarshed/QC_power"))
+
+# set a rules file (e.g. '/home/pi/alertRules.json') to check every reading against local alert rules
+alertRules = None
+if (alertRules):
+    from alertEngine import AlertEngine
+    sinks.append(AlertEngine(alertRules))
+
+# set a broker (e.g. 'localhost' or 'mqtt.local:1883') to publish the changed values over MQTT, see mqttSink.py
+mqttBroker = None
+if (mqttBroker):
+    from mqttSink import MqttSink
+    sinks.append(MqttSink(mqttBroker))
+
+# set a port (e.g. 8086) to serve every reading as a live event stream (SSE), see liveStream.py
+livePort = None
+if (livePort):
+    from liveStream import LiveStream
+    sinks.append(LiveStream(livePort))
+
+# seconds between two readings on wall clock boundaries, 0 reads again as soon as the meters
+# answered. A few seconds let a battery powered Pi idle in between, see lowPower.py
+pollInterval = 0
+
+# set a directory (e.g. '/home/pi/recordings') to record every Modbus frame, see serialRecorder.py
+recordDir = None
+
+# the two meters: (port, slave address). A by-id link or usb:VID:PID:SERIAL survives a USB
+# re-enumeration, see deviceManager.py. Meters on one RS485 line share the port with
+# different slave addresses, e.g. ('/dev/ttyUSB0', 1) and ('/dev/ttyUSB0', 2); the bus
+# owner (rs485Bus.py) serialises the frames, also against RenogyWanderer.py on the same port.
+meterA = getBus('/dev/ttyUSB0', baudrate=9600, timeout=1, recordDir=recordDir).instrument(1)
+meterB = getBus('/dev/ttyUSB1', baudrate=9600, timeout=1, recordDir=recordDir).instrument(1)
+
 totalWatts = 0
 
 thisWatts = 0
@@ -37,25 +93,19 @@ freqB   = 0
 
 totalWatts = 0
 
-if (len(sys.argv) > 1):
+if (__name__ == "__main__" and len(sys.argv) > 1):     # not when snapshotTick.py imports it
         if (sys.argv[1] == "-d"):
                 debug=True
                 print("sys.argv[0]: Debug: enabled")
 
 
-def readPowerMeter(dev):
+# True when read, None when the meter did not answer (the this* values are then stale)
+def readPowerMeter(powerMeter):
     global totalWatts, thisWatts, thisVolts, thisAmps, thisEnergy, thisFreq, thisPF
 
-    powerMeter = minimalmodbus.Instrument(dev, 1) 
-    powerMeter.serial.baudrate = 9600
-    powerMeter.serial.bytesize = 8
-    powerMeter.serial.parity   = serial.PARITY_NONE
-    powerMeter.serial.stopbits = 1
-    powerMeter.serial.timeout = 1
-    powerMeter.mode = minimalmodbus.MODE_RTU
-
-    if (debug): print("Attempting to read power meter device:", dev, powerMeter)
+    if (debug): print("Attempting to read power meter device:", powerMeter)
     try:
+        powerMeter.prefetch([(0, 10)], functioncode=4)     # registers 0..9 in one frame instead of 7
         voltageReading = powerMeter.read_register(0, 0, 4)
         ampsReading = powerMeter.read_register(1, 0, 4)
         wattsReading = powerMeter.read_register(3, 0, 4)
@@ -80,16 +130,21 @@ def readPowerMeter(dev):
         thisFreq     = frequencyReading/10
         thisPF       = powerFactor/100
         totalWatts  += wattsReading/10
+        return(True)
 
     except IOError:
-        print("Failed to read from powerMeter:", dev)
+        print("Failed to read from powerMeter:", powerMeter)
+        return(None)
+
+# read both meters and write the QC_power lines, also used by snapshotTick.py
+def pollPower(file_object):
+    global totalWatts
 
-while(True):
     cmdStr = ""
 
     # Run the function to read the power meter.
     if (debug): print("# Phase A")
-    readPowerMeter("/dev/ttyUSB0")
+    okA = readPowerMeter(meterA)
 
     voltsA = thisVolts
     ampsA = thisAmps
@@ -99,7 +154,7 @@ while(True):
     pfA = thisPF
 
     if (debug): print("# Phase B")
-    readPowerMeter("/dev/ttyUSB1")
+    okB = readPowerMeter(meterB)
 
     voltsB = thisVolts
     ampsB = thisAmps
@@ -110,6 +165,19 @@ while(True):
 
     if (debug): print("# wattsA:", wattsA, "wattsB:", "Total Consumption:", totalWatts, "w")
 
+    # a phase that was not read is left out, its values are the ones of the other phase
+    if (okA):
+        aggregator.update("wattsA", wattsA)
+        aggregator.update("ampsA", ampsA)
+        integrator.update("wattsA", wattsA, "whA")
+    if (okB):
+        aggregator.update("wattsB", wattsB)
+        aggregator.update("ampsB", ampsB)
+        integrator.update("wattsB", wattsB, "whB")
+    if (okA and okB):
+        aggregator.update("totalWatts", totalWatts)
+        integrator.update("totalWatts", totalWatts, "whTotal")
+
 ################## Volts ####################
     voltStr = "{:4.2f}".format(voltsA)
     voltName = '{mode=\"voltsA\"}'
@@ -164,21 +232,43 @@ while(True):
     dataStrC = f"QC_power{valName} {valStr}"
     if (debug): print("cmdStr:", cmdStr)
 
-    with open('/ramdisk/QC_Watts.prom', mode='w') as file_object:
+    if (okA):
         print(dataStrA,       file=file_object)
+    if (okB):
         print(dataStrB,       file=file_object)
+    if (okA and okB):
         print(dataStrC,       file=file_object)
+    if (okA):
         print(dataVoltStrA,   file=file_object)
-        print(dataVoltStrB,   file=file_object)
         print(dataAmpsStrA,   file=file_object)
-        print(dataAmpsStrB,   file=file_object)
         print(dataEnergyStrA, file=file_object)
-        print(dataEnergyStrB, file=file_object)
         print(dataPFStrA,     file=file_object)
-        print(dataPFStrB,     file=file_object)
         print(dataFreqStrA,   file=file_object)
+    if (okB):
+        print(dataVoltStrB,   file=file_object)
+        print(dataAmpsStrB,   file=file_object)
+        print(dataEnergyStrB, file=file_object)
+        print(dataPFStrB,     file=file_object)
         print(dataFreqStrB,   file=file_object)
- 
+    aggregator.write(file_object, "QC_power_agg")
+    integrator.write(file_object, "QC_energy")
+
     totalWatts = 0
 
+################ main ##################
+
+if __name__ == "__main__":
+    import profHooks
+    profHooks.install("powerMeter")     # kill -USR1 / profHooks.py: profile the running loop
+    stages = profHooks.stageTimer("QC_power")
+    while(True):
+        # the meters are read while the tmp file is open, node_exporter only sees complete files
+        stages.begin()
+        with openPromFile('/ramdisk/QC_Watts.prom.tmp', sinks) as file_object:
+            pollPower(file_object)
+            stages.mark("poll")
+        os.replace('/ramdisk/QC_Watts.prom.tmp', '/ramdisk/QC_Watts.prom')
+        stages.mark("publish")
+        if (pollInterval): time.sleep(pollInterval - time.time() % pollInterval)
+
 # End.
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+# profHooks.py
+# Description: switch profiling on and off in a running collector, results go to a file.
+#
+# -D prints every frame and changes the timing it should show. A collector that falls
+# behind (lost BMS frames, slow Renogy polls) is diagnosed in place, under the real serial
+# load, without a restart. Every collector calls install(name) at the start, that costs a
+# sleeping thread and a socket. Three tools, off until asked for:
+#  - profile  sampling profiler: every thread's stack 100 times per second (sys._current_frames),
+#             the code itself runs as before. Result: <name>-<time>-profile.txt with the
+#             functions by own and total samples, and .collapsed stacks for flamegraph.pl or
+#             speedscope.
+#  - memory   tracemalloc from start to stop: the lines that allocated most in between,
+#             the biggest owners at the end, and the snapshot (.tracemalloc) for later
+#  - stages   time per stage of the read loops: BMS read, reassemble, decode, format,
+#             publish; bus wait and read (rs485Bus.py); poll and publish of the pollers.
+#             Count, mean, max and share per stage: <name>-<time>-stages.txt
+# Switched with signals (kill -USR1: profile and stages on / off, kill -USR2: memory on / off)
+# or with commands on the socket <directory>/<name>.sock, e.g. from here:
+#   profHooks.py getChargeryData status
+#   profHooks.py getChargeryData profile start 200       # Hz
+#   profHooks.py getChargeryData profile stop            # prints the result file
+#   profHooks.py -t 60 solarshed stages                  # start, wait 60 s, stop
+#
+# Output example (stages):
+# loop                     stage           count   mean ms    max ms   total s   share
+# BMS_A                    read             2861    104.62    212.35     299.3   99.3%
+# BMS_A                    reassemble       2861      0.04      0.36       0.1    0.0%
+# BMS_A                    decode           3957      0.08      1.86       0.3    0.1%
+# BMS_A                    publish          1375      0.12      3.54       0.2    0.1%
+#
+# Usage: profHooks.py [-d /var/tmp/solarshed] [-t SECONDS] NAME (profile|memory|stages) [start [ARG]|stop] | NAME status
+
+import os, sys, time, signal, socket, selectors, threading
+from argparse import ArgumentParser
+
+DIRECTORY = "/var/tmp/solarshed"        # sockets and results, off /ramdisk
+timing = False                          # stages on: StageTimer.mark measures
+
+# time between the marks of one loop, one timer per loop (thread)
+class StageTimer:
+        def __init__(self, name):
+                self.name  = name
+                self.last  = None
+                self.stats = {}         # stage -> [count, total s, max s]
+
+        def begin(self):
+                if (timing): self.last = time.perf_counter()
+
+        # the time since begin() or the last mark goes to this stage
+        def mark(self, stage):
+                if (not timing): return
+                now = time.perf_counter()
+                if (self.last is not None):
+                        spent = now - self.last
+                        stat = self.stats.get(stage)
+                        if (stat is None): stat = self.stats[stage] = [0, 0.0, 0.0]
+                        stat[0] += 1
+                        stat[1] += spent
+                        if (spent > stat[2]): stat[2] = spent
+                self.last = now
+
+        def reset(self):
+                self.last  = None
+                self.stats = {}
+
+# one timer per loop name in a process
+timers = {}
+timerLock = threading.Lock()
+
+def stageTimer(name):
+        with timerLock:
+                if (name not in timers): timers[name] = StageTimer(name)
+                return(timers[name])
+
+class ProfHooks:
+        def __init__(self, name, directory=DIRECTORY, debug=False):
+                self.name      = name
+                self.directory = directory
+                self.debug     = debug
+                self.lock      = threading.Lock()
+                self.sampler   = None           # thread of the running profile
+                self.samples   = {}             # (thread, frames...) -> count
+                self.hz        = 100
+                self.started   = {}             # tool -> time.time() of the start
+                self.baseline  = None           # tracemalloc snapshot at the start
+                self.wakeRead, self.wakeWrite = socket.socketpair()
+                self.wakeWrite.setblocking(False)
+                self.selector  = selectors.DefaultSelector()
+                self.selector.register(self.wakeRead, selectors.EVENT_READ)
+                self.listener  = None
+                self.sockName  = os.path.join(directory, name + ".sock")
+                try:
+                        os.makedirs(directory, exist_ok=True)
+                        if (os.path.exists(self.sockName)): os.remove(self.sockName)   # left by a killed run
+                        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self.listener.bind(self.sockName)
+                        self.listener.listen(2)
+                        self.selector.register(self.listener, selectors.EVENT_READ)
+                except OSError as err:
+                        print("Profiling socket", self.sockName, "not available, signals only:", err)
+                        self.listener = None
+                self.thread = threading.Thread(target=self.serve, name="profHooks", daemon=True)
+                self.thread.start()
+
+        # signal handlers only poke the thread, the work is done there
+        def onSignal(self, signum, frame):
+                try:
+                        self.wakeWrite.send(b"p" if (signum == signal.SIGUSR1) else b"m")
+                except OSError:
+                        pass
+
+        def serve(self):
+                while True:
+                        for key, mask in self.selector.select():
+                                if (key.fileobj is self.wakeRead):
+                                        for toggle in self.wakeRead.recv(64):
+                                                if (toggle == ord("p")):
+                                                        running = "profile" in self.started
+                                                        print(self.command("profile stop" if running else "profile start"))
+                                                        print(self.command("stages stop" if running else "stages start"))
+                                                else:
+                                                        print(self.command("memory stop" if ("memory" in self.started) else "memory start"))
+                                else:
+                                        self.client()
+
+        def client(self):
+                try:
+                        conn, addr = self.listener.accept()
+                except OSError:
+                        return
+                with conn:
+                        conn.settimeout(5)
+                        try:
+                                line = conn.makefile(mode='r').readline()
+                                if (self.debug): print("Profiling command:", line.strip())
+                                conn.sendall((self.command(line) + "\n").encode())
+                        except OSError:
+                                pass
+
+        def command(self, line):
+                words = line.split()
+                if (words == ["status"]):
+                        return(self.status())
+                if (len(words) < 2 or words[0] not in ("profile", "memory", "stages") or words[1] not in ("start", "stop")):
+                        return("error: " + line.strip() + " (profile|memory|stages start|stop, status)")
+                tool, action = words[0], words[1]
+                with self.lock:
+                        if (action == "start"):
+                                if (tool in self.started): return(f"{tool} already running")
+                                try:
+                                        getattr(self, tool + "Start")(*words[2:3])
+                                except (ValueError, RuntimeError) as err:
+                                        return("error: " + str(err))
+                                self.started[tool] = time.time()
+                                return(f"{tool} started")
+                        if (tool not in self.started): return(f"{tool} not running")
+                        fileName = self.resultName(tool)
+                        try:
+                                getattr(self, tool + "Stop")(fileName)
+                        except OSError as err:          # the tool is stopped, only the result is lost
+                                return(f"error: {tool} stopped, not written: {err}")
+                        finally:
+                                del self.started[tool]
+                        return(f"{tool} written to {fileName}")
+
+        def status(self):
+                now = time.time()
+                lines = [f"{self.name} pid {os.getpid()}, results in {self.directory}"]
+                for tool in ("profile", "memory", "stages"):
+                        lines.append(f"  {tool}: " + (f"running for {now - self.started[tool]:.0f} s" if (tool in self.started) else "off"))
+                return("\n".join(lines))
+
+        def resultName(self, tool):
+                stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started[tool]))
+                return(os.path.join(self.directory, f"{self.name}-{stamp}-{tool}.txt"))
+
+        ############ profile ############
+
+        def profileStart(self, hz=None):
+                self.hz = float(hz) if hz else 100.0
+                if (not 1 <= self.hz <= 1000): raise ValueError("1 to 1000 Hz")
+                self.samples = {}
+                self.sampler = threading.Thread(target=self.sample, name="profSampler", daemon=True)
+                self.sampler.start()
+
+        def sample(self):
+                labels  = {}            # code -> "function (file:line)"
+                names   = {}
+                skip    = {threading.get_ident(), self.thread.ident}
+                nextAt  = time.perf_counter()
+                nextNames = 0
+                while (self.sampler is threading.current_thread()):      # profileStop clears it
+                        now = time.perf_counter()
+                        if (now >= nextNames):
+                                names = {t.ident: t.name for t in threading.enumerate()}
+                                nextNames = now + 1
+                        for ident, frame in sys._current_frames().items():
+                                if (ident in skip): continue
+                                stack = []
+                                while (frame is not None):
+                                        code = frame.f_code
+                                        label = labels.get(code)
+                                        if (label is None):
+                                                label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                                        stack.append(label)
+                                        frame = frame.f_back
+                                stack.append(names.get(ident, str(ident)))
+                                key = tuple(reversed(stack))
+                                self.samples[key] = self.samples.get(key, 0) + 1
+                        nextAt += 1.0 / self.hz
+                        delay = nextAt - time.perf_counter()
+                        if (delay > 0):
+                                time.sleep(delay)
+                        else:
+                                nextAt = time.perf_counter()    # behind, the sampler doesn't catch up
+
+        def profileStop(self, fileName):
+                sampler, self.sampler = self.sampler, None
+                sampler.join(5)
+                samples = self.samples
+                total = sum(samples.values()) or 1
+                own, inclusive = {}, {}
+                for stack, count in samples.items():
+                        own[stack[-1]] = own.get(stack[-1], 0) + count
+                        for label in set(stack[1:]):
+                                inclusive[label] = inclusive.get(label, 0) + count
+                seconds = time.time() - self.started["profile"]
+                with open(fileName + ".tmp", mode='w') as fileObj:
+                        print(f"# {self.name}: {total} samples in {seconds:.0f} s at {self.hz:g} Hz, all threads"
+                              f" (a thread waiting on the port or a sleep counts as well)", file=fileObj)
+                        print(f"{'own':>7} {'total':>7}  function", file=fileObj)
+                        for label, count in sorted(own.items(), key=lambda item: -item[1])[:30]:
+                                print(f"{100 * count / total:6.1f}% {100 * inclusive.get(label, 0) / total:6.1f}%  {label}", file=fileObj)
+                        print("# by total: the callers", file=fileObj)
+                        for label, count in sorted(inclusive.items(), key=lambda item: -item[1])[:30]:
+                                print(f"{100 * own.get(label, 0) / total:6.1f}% {100 * count / total:6.1f}%  {label}", file=fileObj)
+                os.replace(fileName + ".tmp", fileName)
+                collapsed = fileName[:-4] + ".collapsed"
+                with open(collapsed, mode='w') as fileObj:
+                        for stack, count in samples.items():
+                                print(";".join(stack), count, file=fileObj)
+                self.samples = {}
+
+        ############ memory ############
+
+        def memoryStart(self, frames=None):
+                import tracemalloc
+                if (tracemalloc.is_tracing()): raise RuntimeError("tracemalloc already in use")
+                tracemalloc.start(int(frames) if frames else 1)
+                self.baseline = tracemalloc.take_snapshot()
+
+        def memoryStop(self, fileName):
+                import tracemalloc
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(fileName[:-4] + ".tracemalloc")
+                filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+                snapshot = snapshot.filter_traces(filters)
+                with open(fileName + ".tmp", mode='w') as fileObj:
+                        print(f"# {self.name}: traced {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB", file=fileObj)
+                        print("# grown since the start", file=fileObj)
+                        for stat in snapshot.compare_to(self.baseline.filter_traces(filters), "lineno")[:30]:
+                                print(stat, file=fileObj)
+                        print("# biggest now", file=fileObj)
+                        for stat in snapshot.statistics("lineno")[:30]:
+                                print(stat, file=fileObj)
+                os.replace(fileName + ".tmp", fileName)
+                self.baseline = None
+
+        ############ stages ############
+
+        def stagesStart(self, arg=None):
+                global timing
+                with timerLock:
+                        for timer in timers.values():
+                                timer.reset()
+                timing = True
+
+        def stagesStop(self, fileName):
+                global timing
+                timing = False
+                with timerLock:
+                        loops = sorted(timers.values(), key=lambda t: t.name)
+                with open(fileName + ".tmp", mode='w') as fileObj:
+                        print(f"# {self.name}: {time.time() - self.started['stages']:.0f} s", file=fileObj)
+                        print(f"{'loop':<24} {'stage':<12} {'count':>8} {'mean ms':>9} {'max ms':>9} {'total s':>9} {'share':>7}", file=fileObj)
+                        for timer in loops:
+                                stats = dict(timer.stats)
+                                spent = sum(stat[1] for stat in stats.values()) or 1
+                                for stage, (count, total, worst) in stats.items():
+                                        print(f"{timer.name:<24} {stage:<12} {count:8d} {1000 * total / count:9.2f} {1000 * worst:9.2f} "
+                                              f"{total:9.1f} {100 * total / spent:6.1f}%", file=fileObj)
+                os.replace(fileName + ".tmp", fileName)
+
+# one per process
+hooks = None
+
+def install(name, directory=DIRECTORY, debug=False):
+        global hooks
+        if (hooks is None):
+                hooks = ProfHooks(name, directory, debug)
+                try:
+                        signal.signal(signal.SIGUSR1, hooks.onSignal)
+                        signal.signal(signal.SIGUSR2, hooks.onSignal)
+                except ValueError:
+                        pass            # not the main thread, the socket still works
+        return(hooks)
+
+def send(sockName, line, timeout=60):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.settimeout(timeout)
+                conn.connect(sockName)
+                conn.sendall((line + "\n").encode())
+                return(conn.makefile(mode='r').read().rstrip("\n"))
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Start and stop profiling in a running collector")
+        parser.add_argument("name", help="collector name (getChargeryData, solarshed, ...) or socket path")
+        parser.add_argument("command", nargs="+", help="status | profile|memory|stages start [ARG] | profile|memory|stages stop")
+        parser.add_argument("-d", "--directory", default=DIRECTORY, help=f"sockets and results (default {DIRECTORY})")
+        parser.add_argument("-t", "--time", type=float, help="start, wait this many seconds, stop")
+        args = parser.parse_args()
+
+        sockName = args.name if (os.sep in args.name) else os.path.join(args.directory, args.name + ".sock")
+        try:
+                if (args.time):
+                        print(send(sockName, " ".join([args.command[0], "start"] + [w for w in args.command[1:] if w != "start"])))
+                        time.sleep(args.time)
+                        print(send(sockName, args.command[0] + " stop"))
+                else:
+                        print(send(sockName, " ".join(args.command)))
+        except OSError as err:
+                sys.exit(f"{sockName}: {err}")
+        except KeyboardInterrupt:
+                print(send(sockName, args.command[0] + " stop"))
+
+# End.
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# promState.py
+# Description: export strings without a new time series for every change.
+#
+# A label like myStr="Discharge" on a value makes a new series in Prometheus every time
+# the string changes, the old one stays in the head block for hours. Over months that is
+# a lot of memory on a Pi. Instead:
+#  - states (work mode, charge state, ...) are a state set: one series per known state,
+#    1 for the active one and 0 for the others, plus "other" for an unknown value.
+#    The set of series never grows.
+#      BMS_A_state{mode="workMode", state="Discharge", pack="A"} 1
+#      BMS_A_state{mode="workMode", state="Charge", pack="A"} 0
+#  - static strings (serial number, battery type, unit name) are an info metric with the
+#    value 1, in its own file that is only written when the strings change.
+#      Renogy_info{batType="lithium"} 1
+# The numeric value (modeInt, chargeState, ...) stays in the main file for the graphs and
+# alert rules. The shell collectors write the same format with printf.
+
+import os
+
+def escape(value):
+        return(str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+
+# states: the known state names, value: the current one
+# labels: extra labels for every line, e.g. ', pack="A"'
+def writeStateSet(fileObj, metric, name, value, states, labels=""):
+        known = False
+        for state in states:
+                active = (state == value)
+                known = known or active
+                print(f"{metric}{{mode=\"{name}\", state=\"{escape(state)}\"{labels}}} {1 if active else 0}", file=fileObj)
+        print(f"{metric}{{mode=\"{name}\", state=\"other\"{labels}}} {0 if known else 1}", file=fileObj)
+
+# Info metrics of one collector, e.g. InfoFile('/ramdisk/Renogy_info.prom').
+# set() can be called on every poll, the file is only rewritten when something changed.
+class InfoFile:
+        def __init__(self, fileName):
+                self.fileName = fileName
+                self.infos    = {}      # metric -> {label: value}
+                self.written  = None
+
+        def set(self, metric, **labels):
+                self.infos[metric] = {k: v for k, v in labels.items() if v is not None}
+                text = ""
+                for name, values in self.infos.items():
+                        text += name + "{" + ", ".join(f"{k}=\"{escape(v)}\"" for k, v in values.items()) + "} 1\n"
+                if (text == self.written): return
+                with open(self.fileName + ".tmp", mode='w') as fileObj:
+                        fileObj.write(text)
+                os.replace(self.fileName + ".tmp", self.fileName)
+                self.written = text
+
+# End.
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+# remoteWrite.py
+# Description: push the collector samples in batches to a central Prometheus with the
+# remote-write protocol (protobuf WriteRequest, snappy compressed, HTTP POST).
+#
+# - batches are built in memory and written to a bounded queue directory, so a flaky
+#   uplink neither loses data nor blocks the serial readers
+# - a background thread sends the queue oldest first and retries with backoff
+# - if the queue is full the oldest batches are dropped
+# - python-snappy is used when installed, otherwise the small pure python codec below
+#
+# Prometheus needs --web.enable-remote-write-receiver (or use a receiver like mimir,
+# victoriametrics, ...). For a quick test start a local stand-in receiver:
+#   python3 remoteWrite.py -r 9201
+# and point a collector to http://localhost:9201/api/v1/write
+
+import os, time, struct, socket, threading
+from array import array
+from argparse import ArgumentParser
+from sampleSink import splitSeries
+
+############ snappy (raw block format) ############
+
+def snappyCompress(data):
+        try:
+                import snappy
+                return(snappy.compress(bytes(data)))
+        except ImportError:
+                pass
+        out = bytearray()
+        n = len(data)
+        putUvarint(out, n)
+        table = {}
+        litStart = 0
+        pos = 0
+        while (pos + 4 <= n):
+                key = data[pos:pos+4]
+                cand = table.get(key)
+                table[key] = pos
+                if (cand is None or pos - cand > 0xffff):
+                        pos += 1
+                        continue
+                # extend the match
+                length = 4
+                while (pos + length < n and data[cand + length] == data[pos + length] and length < 64):
+                        length += 1
+                snappyLiteral(out, data, litStart, pos)
+                offset = pos - cand
+                out.append(((length - 1) << 2) | 2)    # copy with 2 byte offset
+                out += struct.pack("<H", offset)
+                pos += length
+                litStart = pos
+        snappyLiteral(out, data, litStart, n)
+        return(bytes(out))
+
+def snappyLiteral(out, data, start, end):
+        while (start < end):
+                length = min(end - start, 65536)
+                if (length <= 60):
+                        out.append((length - 1) << 2)
+                elif (length <= 256):
+                        out.append(60 << 2)
+                        out.append(length - 1)
+                else:
+                        out.append(61 << 2)
+                        out += struct.pack("<H", length - 1)
+                out += data[start:start + length]
+                start += length
+
+def snappyDecompress(data):
+        try:
+                import snappy
+                return(snappy.uncompress(bytes(data)))
+        except ImportError:
+                pass
+        length, pos = getUvarint(data, 0)
+        out = bytearray()
+        while (pos < len(data)):
+                tag = data[pos]
+                pos += 1
+                kind = tag & 3
+                if (kind == 0):
+                        size = tag >> 2
+                        if (size >= 60):
+                                extra = size - 59
+                                size = int.from_bytes(data[pos:pos + extra], "little")
+                                pos += extra
+                        size += 1
+                        out += data[pos:pos + size]
+                        pos += size
+                        continue
+                if (kind == 1):
+                        size = ((tag >> 2) & 7) + 4
+                        offset = ((tag >> 5) << 8) | data[pos]
+                        pos += 1
+                elif (kind == 2):
+                        size = (tag >> 2) + 1
+                        offset = struct.unpack_from("<H", data, pos)[0]
+                        pos += 2
+                else:
+                        size = (tag >> 2) + 1
+                        offset = struct.unpack_from("<I", data, pos)[0]
+                        pos += 4
+                for i in range(size):           # copies may overlap
+                        out.append(out[-offset])
+        if (len(out) != length): raise ValueError("snappy: length mismatch")
+        return(bytes(out))
+
+############ protobuf ############
+
+def putUvarint(buf, n):
+        while (n > 0x7f):
+                buf.append((n & 0x7f) | 0x80)
+                n >>= 7
+        buf.append(n)
+
+def getUvarint(buf, pos):
+        result = 0
+        shift = 0
+        while True:
+                b = buf[pos]
+                pos += 1
+                result |= (b & 0x7f) << shift
+                if (b < 0x80): return(result, pos)
+                shift += 7
+
+def putField(buf, field, payload):
+        buf.append((field << 3) | 2)    # length delimited
+        putUvarint(buf, len(payload))
+        buf += payload
+
+# prometheus.WriteRequest { repeated TimeSeries timeseries = 1; }
+# TimeSeries { repeated Label labels = 1; repeated Sample samples = 2; }
+# Label { string name = 1; string value = 2; }
+# Sample { double value = 1; int64 timestamp = 2; }
+def encodeWriteRequest(seriesList):
+        req = bytearray()
+        for labels, samples in seriesList:
+                ts = bytearray()
+                for name, value in labels:
+                        label = bytearray()
+                        putField(label, 1, name.encode("utf-8"))
+                        putField(label, 2, value.encode("utf-8"))
+                        putField(ts, 1, label)
+                for value, tsMs in samples:
+                        sample = bytearray(b"\x09")
+                        sample += struct.pack("<d", value)
+                        sample.append(0x10)
+                        putUvarint(sample, tsMs & 0xffffffffffffffff)
+                        putField(ts, 2, sample)
+                putField(req, 1, ts)
+        return(bytes(req))
+
+def decodeFields(buf):
+        pos = 0
+        while (pos < len(buf)):
+                key, pos = getUvarint(buf, pos)
+                field, wire = key >> 3, key & 7
+                if (wire == 2):
+                        size, pos = getUvarint(buf, pos)
+                        yield field, buf[pos:pos + size]
+                        pos += size
+                elif (wire == 1):
+                        yield field, buf[pos:pos + 8]
+                        pos += 8
+                elif (wire == 0):
+                        value, pos = getUvarint(buf, pos)
+                        yield field, value
+                else:
+                        raise ValueError("unsupported wire type")
+
+def decodeWriteRequest(buf):
+        result = []
+        for field, tsBuf in decodeFields(buf):
+                if (field != 1): continue
+                labels = []
+                samples = []
+                for f, payload in decodeFields(tsBuf):
+                        if (f == 1):
+                                parts = dict(decodeFields(payload))
+                                labels.append((bytes(parts.get(1, b"")).decode(), bytes(parts.get(2, b"")).decode()))
+                        elif (f == 2):
+                                parts = dict(decodeFields(payload))
+                                samples.append((struct.unpack("<d", parts.get(1, bytes(8)))[0], parts.get(2, 0)))
+                result.append((labels, samples))
+        return(result)
+
+############ queue and sender ############
+
+# the pending samples of one series: two typed arrays instead of a list of tuples,
+# 16 bytes per sample instead of about 120. The labels are split once per series.
+class SampleColumn:
+        __slots__ = ("labels", "values", "times")
+
+        def __init__(self, labels):
+                self.labels = labels
+                self.values = array('d')
+                self.times  = array('q')        # ms
+
+        def __len__(self):
+                return(len(self.values))
+
+        def __iter__(self):
+                return(zip(self.values, self.times))
+
+        def clear(self):
+                del self.values[:]
+                del self.times[:]
+
+class RemoteWriter:
+        # url:        remote-write endpoint, e.g. http://prometheus:9090/api/v1/write
+        # queueDir:   batches waiting to be sent, one file each
+        # maxBatches: queue bound, the oldest batch is dropped when it is full
+        # batchSize:  samples per batch, batchAge: max. seconds before a batch is queued anyway
+        # labels:     extra labels for every series, default instance=<hostname>
+        def __init__(self, url, queueDir="/var/spool/solarshed/remote-write", maxBatches=2000,
+                     batchSize=500, batchAge=10, labels=None, timeout=10, debug=False):
+                self.url        = url
+                self.queueDir   = queueDir
+                self.maxBatches = maxBatches
+                self.batchSize  = batchSize
+                self.batchAge   = batchAge
+                self.timeout    = timeout
+                self.debug      = debug
+                self.labels     = labels if (labels is not None) else [("instance", socket.gethostname())]
+                self.pending    = {}            # series -> SampleColumn, kept from batch to batch
+                self.pendingCnt = 0
+                self.batchStart = time.monotonic()
+                self.seq        = int(time.time() * 1000)
+                self.sent       = 0
+                self.dropped    = 0
+                self.failed     = 0
+                self.wakeup     = threading.Event()
+                self.running    = True
+                os.makedirs(queueDir, exist_ok=True)
+                self.thread = threading.Thread(target=self.sender, name="remoteWrite", daemon=True)
+                self.thread.start()
+
+        # sink interface, see sampleSink.py
+        def append(self, series, value, ts):
+                column = self.pending.get(series)
+                if (column is None):
+                        metric, labels = splitSeries(series)
+                        labels = [("__name__", metric)] + labels + self.labels
+                        labels.sort()
+                        column = self.pending[series] = SampleColumn(labels)
+                column.values.append(value)
+                column.times.append(int(ts * 1000))
+                self.pendingCnt += 1
+
+        def commit(self, ts=None):
+                if (self.pendingCnt >= self.batchSize or (time.monotonic() - self.batchStart) >= self.batchAge):
+                        self.enqueue()
+
+        def enqueue(self):
+                self.batchStart = time.monotonic()
+                if (not self.pendingCnt): return
+                seriesList = [(column.labels, column) for column in self.pending.values() if (len(column))]
+                payload = snappyCompress(encodeWriteRequest(seriesList))
+                for column in self.pending.values():
+                        column.clear()
+                self.pendingCnt = 0
+
+                self.seq += 1
+                tmpName = os.path.join(self.queueDir, "%016d.tmp" % self.seq)
+                with open(tmpName, mode="wb") as fileObj:
+                        fileObj.write(payload)
+                os.replace(tmpName, tmpName[:-4] + ".rw")
+                self.trim()
+                self.wakeup.set()
+
+        def queued(self):
+                return(sorted(f for f in os.listdir(self.queueDir) if f.endswith(".rw")))
+
+        def trim(self):
+                batches = self.queued()
+                while (len(batches) > self.maxBatches):
+                        os.remove(os.path.join(self.queueDir, batches.pop(0)))
+                        self.dropped += 1
+
+        # returns True when the batch is done (sent or not retryable)
+        def post(self, payload):
+                import urllib.request, urllib.error
+                req = urllib.request.Request(self.url, data=payload, method="POST", headers={
+                        "Content-Encoding": "snappy",
+                        "Content-Type": "application/x-protobuf",
+                        "User-Agent": "SolarShed-remote-write",
+                        "X-Prometheus-Remote-Write-Version": "0.1.0"})
+                try:
+                        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                                resp.read()
+                        return(True)
+                except urllib.error.HTTPError as err:
+                        if (400 <= err.code < 500 and err.code != 429):
+                                print("remote write rejected batch:", err.code, err.read()[:200])
+                                self.dropped += 1
+                                return(True)
+                        if (self.debug): print("remote write failed:", err.code)
+                        return(False)
+                except (OSError, ValueError) as err:
+                        if (self.debug): print("remote write failed:", err)
+                        return(False)
+
+        def sender(self):
+                backoff = 1
+                while (self.running):
+                        batches = self.queued()
+                        if (not batches):
+                                self.wakeup.wait(self.batchAge)
+                                self.wakeup.clear()
+                                continue
+                        path = os.path.join(self.queueDir, batches[0])
+                        try:
+                                with open(path, mode="rb") as fileObj:
+                                        payload = fileObj.read()
+                        except OSError:
+                                continue        # trimmed meanwhile
+                        if (self.post(payload)):
+                                try:
+                                        os.remove(path)
+                                except OSError:
+                                        pass
+                                self.sent += 1
+                                backoff = 1
+                        else:
+                                self.failed += 1
+                                self.wakeup.wait(backoff)
+                                self.wakeup.clear()
+                                backoff = min(backoff * 2, 300)
+
+        def close(self):
+                self.enqueue()
+                self.running = False
+                self.wakeup.set()
+
+################ main ##################
+
+def runReceiver(port):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        class Receiver(BaseHTTPRequestHandler):
+                def do_POST(self):
+                        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                        try:
+                                seriesList = decodeWriteRequest(snappyDecompress(body))
+                        except (ValueError, IndexError, struct.error) as err:
+                                self.send_response(400)
+                                self.end_headers()
+                                self.wfile.write(str(err).encode())
+                                return
+                        count = 0
+                        for labels, samples in seriesList:
+                                count += len(samples)
+                                for value, tsMs in samples:
+                                        print(",".join(f"{k}={v}" for k, v in labels), value, tsMs)
+                        print(f"# batch: {len(body)} bytes, {len(seriesList)} series, {count} samples")
+                        self.send_response(204)
+                        self.end_headers()
+
+                def log_message(self, *args):
+                        pass
+
+        print("remote-write receiver listening on port", port)
+        HTTPServer(("", port), Receiver).serve_forever()
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description='Prometheus remote-write helper')
+        parser.add_argument("-r", "--receiver", type=int, help="Run a local stand-in receiver on this port", default=None)
+        parser.add_argument("-s", "--send", type=str, help="Send .prom files given as arguments to this URL", default=None)
+        parser.add_argument("files", nargs="*", help=".prom files for --send")
+        args = parser.parse_args()
+
+        if (args.receiver):
+                runReceiver(args.receiver)
+        elif (args.send):
+                # one shot, for the shell collectors
+                from sampleSink import parsePromLine
+                writer = RemoteWriter(args.send, debug=True)
+                for promFile in args.files:
+                        ts = os.path.getmtime(promFile)
+                        with open(promFile, mode="r") as fileObj:
+                                for line in fileObj:
+                                        sample = parsePromLine(line)
+                                        if (sample is not None): writer.append(sample[0], sample[1], ts)
+                writer.enqueue()
+                # give the sender a moment, whatever is left stays queued for the next run
+                deadline = time.monotonic() + writer.timeout
+                while (writer.queued() and time.monotonic() < deadline):
+                        time.sleep(0.1)
+        else:
+                parser.print_help()
+
+# End.
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# renogyHistory.py
+# Description: fetch the daily history of the Renogy controller once a day and keep it
+# in a local cache, exported as counters that change once a day.
+#
+# The energy panels over months run increase() / sum_over_time() over 10 s samples of
+# pvWatts and todayGenPwr, expensive on a Pi. The Wanderer keeps a table of its last days
+# (assumed: from 0xF000, 10 registers per day, 0xF000 the running day, 0xF00A the day
+# before, ...):
+#   minBatV maxBatV (0.1 V), maxChgAmps maxDischgAmps (0.01 A), maxChgWatts maxDischgWatts (W),
+#   chgAh dischgAh (Ah), genWh consumWh (0.1 Wh, like todayGenPwr)
+# The controller counts its days itself (upDays, 0x115, a new day at dawn). At the start
+# and whenever upDays moved on, the finished days that are not in the cache yet are read,
+# 12 days per frame (120 registers) with CONFIG priority on the bus. The cache (JSON, off
+# /ramdisk) is keyed by the day number of the controller and has the date of the Pi for
+# every day (read before dawn the older days are one day early, the day numbers are exact).
+# After a reset of the controller (upDays starts again at 1) the new days are numbered on
+# after the cached ones.
+#
+# Exported to <file> when a day was added, no date label, so no new series every day:
+#  - the sums over all cached days as counters: a month of energy is
+#    Renogy_history{mode="genWh"} - Renogy_history{mode="genWh"} offset 30d
+#  - the values of the last finished day (Renogy_lastDay)
+#  - the number of cached days (Renogy_historyDays, a gauge)
+# The days themselves go into Prometheus with their own time with backfill.py (a sample of
+# Renogy_daily per field at the end of every day):
+#   backfill.py /var/lib/solarshed/Renogy_history.json -o renogy.om
+#
+# Output example:
+# # TYPE Renogy_history counter
+# Renogy_history{mode="genWh"} 812345.6
+# Renogy_historyDays 87
+# Renogy_lastDay{mode="genWh"} 2210.4
+#
+# Usage: renogyHistory.py [-p /dev/ttyUSB0] [-s 1] [-c /var/lib/solarshed/Renogy_history.json] [-n 30]
+
+import os, sys, json, time, datetime
+from argparse import ArgumentParser
+
+BASE          = 0xF000
+DAY_REGISTERS = 10
+DAYS_PER_READ = 12      # 120 registers, a Modbus read takes up to 125
+FIELDS = [("minBatV", 0.1), ("maxBatV", 0.1), ("maxChgAmps", 0.01), ("maxDischgAmps", 0.01),
+          ("maxChgWatts", 1), ("maxDischgWatts", 1), ("chgAh", 1), ("dischgAh", 1),
+          ("genWh", 0.1), ("consumWh", 0.1)]
+COUNTERS = ["chgAh", "dischgAh", "genWh", "consumWh"]
+
+class RenogyHistory:
+        # instrument: minimalmodbus.Instrument or a bus instrument (rs485Bus.py)
+        # maxDays:    days back that are read, the controller may keep fewer
+        def __init__(self, instrument, cacheFile, fileName=None, maxDays=30, sinks=None, retry=600, debug=False):
+                self.instrument = instrument
+                self.cacheFile  = cacheFile
+                self.fileName   = fileName
+                self.maxDays    = maxDays
+                self.sinks      = sinks or []
+                self.retry      = retry
+                self.debug      = debug
+                self.days       = {}            # day number -> {"date": ..., field: value}
+                self.upDays     = None          # day of the controller at the last sync
+                self.lastUpDays = None          # the same, saved in the cache: finds a reset of the controller
+                self.offset     = 0             # day number - upDays, grows with every reset
+                self.failedAt   = None
+                self.load()
+
+        def load(self):
+                try:
+                        with open(self.cacheFile, mode='r') as fileObj:
+                                cache = json.load(fileObj)
+                        self.days = {int(day): values for day, values in cache.get("days", {}).items()}
+                        self.lastUpDays = cache.get("upDays")
+                        self.offset = int(cache.get("offset", 0))
+                except (OSError, ValueError):
+                        self.days = {}
+
+        def save(self):
+                try:
+                        cacheDir = os.path.dirname(self.cacheFile)
+                        if (cacheDir): os.makedirs(cacheDir, exist_ok=True)
+                        with open(self.cacheFile + ".tmp", mode='w') as fileObj:
+                                json.dump({"upDays": self.lastUpDays, "offset": self.offset,
+                                           "days": {str(day): self.days[day] for day in sorted(self.days)}}, fileObj)
+                        os.replace(self.cacheFile + ".tmp", self.cacheFile)
+                except OSError as err:
+                        print("Failed to save Renogy history:", self.cacheFile, err)
+
+        # the day numbers of the finished days in the table that are not cached yet
+        def missing(self, upDays):
+                return([n for n in range(1, min(self.maxDays, upDays - 1) + 1) if (self.offset + upDays - n) not in self.days])
+
+        # call with every upDays reading, reads only when a day was finished. True: days added
+        def sync(self, upDays):
+                if (upDays == self.upDays): return(False)
+                if (self.failedAt is not None and time.monotonic() - self.failedAt < self.retry): return(False)
+                if (self.lastUpDays is not None and upDays < self.lastUpDays):
+                        print("Renogy controller reset (upDays", self.lastUpDays, "->", str(upDays) + "), new days after day", self.offset + self.lastUpDays)
+                        self.offset += self.lastUpDays
+                self.lastUpDays = upDays
+                today = datetime.date.today()
+                added = 0
+                wanted = self.missing(upDays)
+                try:
+                        # neighbouring days in one frame, at most DAYS_PER_READ
+                        while (wanted):
+                                first = wanted[0]
+                                run = [n for n in wanted if n < first + DAYS_PER_READ]
+                                count = run[-1] - first + 1
+                                values = self.instrument.read_registers(BASE + first * DAY_REGISTERS, count * DAY_REGISTERS)
+                                if (self.debug): print("Renogy history: read days", first, "to", run[-1], "back")
+                                for n in run:
+                                        regs = values[(n - first) * DAY_REGISTERS:(n - first + 1) * DAY_REGISTERS]
+                                        day = {"date": (today - datetime.timedelta(days=n)).isoformat()}
+                                        for (field, scale), register in zip(FIELDS, regs):
+                                                day[field] = round(register * scale, 2)
+                                        self.days[self.offset + upDays - n] = day
+                                        added += 1
+                                wanted = wanted[len(run):]
+                except (IOError, ValueError) as err:   # the bus and minimalmodbus errors
+                        print("Renogy history not read, again in", self.retry, "s:", err)
+                        self.failedAt = time.monotonic()
+                        if (added): self.save()
+                        return(added > 0)
+                self.failedAt = None
+                self.upDays = upDays
+                self.save()
+                if (self.fileName): self.writeFile()
+                return(added > 0)
+
+        def write(self, fileObj, metric="Renogy_history"):
+                print(f"# TYPE {metric} counter", file=fileObj)
+                for field in COUNTERS:
+                        print(f"{metric}{{mode=\"{field}\"}} {sum(day.get(field, 0) for day in self.days.values()):.1f}", file=fileObj)
+                print(f"# TYPE {metric}Days gauge", file=fileObj)
+                print(f"{metric}Days {len(self.days)}", file=fileObj)
+                if (self.days):
+                        last = self.days[max(self.days)]
+                        for field, scale in FIELDS:
+                                print(f"Renogy_lastDay{{mode=\"{field}\"}} {last.get(field, 0)}", file=fileObj)
+
+        def writeFile(self):
+                from sampleSink import openPromFile
+                with openPromFile(self.fileName + ".tmp", self.sinks) as fileObj:
+                        self.write(fileObj)
+                os.replace(self.fileName + ".tmp", self.fileName)
+
+# the cached days as (unix time at the end of the day, field, value), oldest first, see backfill.py
+def dailySamples(cacheFile):
+        with open(cacheFile, mode='r') as fileObj:
+                days = json.load(fileObj).get("days", {})
+        for day in sorted(days, key=int):
+                values = days[day]
+                end = datetime.datetime.combine(datetime.date.fromisoformat(values["date"]), datetime.time(23, 59, 59))
+                for field, scale in FIELDS:
+                        if (field in values): yield(end.timestamp(), field, values[field])
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Read the daily history of a Renogy controller into the local cache")
+        parser.add_argument("-p", "--port", default="/dev/ttyUSB0", help="port of the controller (default /dev/ttyUSB0)")
+        parser.add_argument("-s", "--slave", type=int, default=1, help="Modbus slave address (default 1)")
+        parser.add_argument("-c", "--cache", default="/var/lib/solarshed/Renogy_history.json", help="cache file")
+        parser.add_argument("-n", "--days", type=int, default=30, help="days back to read (default 30)")
+        parser.add_argument("-D", "--debug", action="store_true", help="Enable Debug and above (i.e. all) messages")
+        args = parser.parse_args()
+
+        from rs485Bus import getBus, CONFIG
+        bus = getBus(args.port, baudrate=9600, timeout=2, debug=args.debug)
+        history = RenogyHistory(bus.instrument(args.slave, CONFIG), args.cache, maxDays=args.days, debug=args.debug)
+        try:
+                upDays = bus.instrument(args.slave).read_register(0x115)
+        except (IOError, ValueError) as err:
+                sys.exit(f"Renogy not read: {err}")
+        history.sync(upDays)
+        for day in sorted(history.days)[-args.days:]:
+                print(day, history.days[day])
+        history.write(sys.stdout)
+
+# End.
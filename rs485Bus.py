@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# rs485Bus.py
+# Description: one owner per RS485 port for several Modbus slaves on the same line.
+#
+# Two masters talking on one RS485 segment garble each other's frames (collisions,
+# timeouts). The bus owner is the only one that talks to the port:
+#  - all transactions of a process go through one queue and one thread per port
+#  - between two frames the inter-frame gap is kept: 3.5 character times, at least minGap
+#  - requests are served by priority (LIVE before NORMAL before CONFIG), but a request
+#    waiting longer than maxWait goes first, so config reads are not starved
+#  - queued register reads of the same slave that are contiguous or overlap are merged into
+#    one read_registers() frame (up to maxSpan registers); slaves take turns within a priority.
+#    Reads across a gap of unrequested registers only with mergeGap for slaves that answer
+#    them (a hole in the register map gives "illegal data address")
+#  - every transaction holds a flock on /run/lock/solarshed-<tty>.lock, so two scripts
+#    (powerMeter.py and RenogyWanderer.py) on one port wait for each other instead of colliding
+#  - the port is found with deviceManager.py and reopened after a USB re-enumeration or a
+#    serial error; a failed transaction fails only its own requests, a caller waits at
+#    most requestTimeout for the bus
+#  - with recordDir all frames of the port are recorded with serialRecorder.py
+#
+# bus = getBus('/dev/ttyUSB0', baudrate=9600)
+# meter = bus.instrument(2)                     # slave 2, looks like a minimalmodbus Instrument
+# meter.prefetch([(0, 10)], functioncode=4)     # one frame for registers 0..9
+# volts = meter.read_register(0, 1, 4)          # served from the prefetch
+
+import os, time, fcntl, threading
+from profHooks import stageTimer
+
+LIVE   = 0
+NORMAL = 1
+CONFIG = 2
+
+class BusRequest:
+        __slots__ = ("slave", "start", "count", "functioncode", "call", "priority", "seq", "enqueued",
+                     "done", "result", "error")
+
+        def __init__(self, slave, start, count, functioncode, call, priority, seq):
+                self.slave        = slave
+                self.start        = start
+                self.count        = count
+                self.functioncode = functioncode
+                self.call         = call        # fn(instrument) instead of a register read
+                self.priority     = priority
+                self.seq          = seq
+                self.enqueued     = time.monotonic()
+                self.done         = threading.Event()
+                self.result       = None
+                self.error        = None
+
+        def wait(self, timeout=None):
+                if (not self.done.wait(timeout)):
+                        raise TimeoutError(f"bus request for slave {self.slave} timed out")
+                if (self.error is not None): raise self.error
+                return(self.result)
+
+class Rs485Bus:
+        def __init__(self, devSpec, baudrate=9600, bytesize=8, parity='N', stopbits=1, timeout=1,
+                     minGap=0.005, maxWait=2.0, mergeGap=0, maxSpan=125, reopenWait=5.0, requestTimeout=30.0,
+                     lockDir="/run/lock", recordDir=None, devices=None, debug=False):
+                from deviceManager import DeviceManager
+                self.devSpec    = devSpec
+                self.settings   = (baudrate, bytesize, parity, stopbits, timeout)
+                # 3.5 characters of 11 bits (start, 8 data, parity/stop, stop)
+                self.gap        = max(minGap, 3.5 * 11 / baudrate)
+                self.maxWait    = maxWait
+                self.mergeGap   = mergeGap      # unrequested registers read to merge two reads
+                self.mergeGaps  = {}            # slave -> mergeGap, see instrument()
+                self.maxSpan    = maxSpan
+                self.reopenWait = reopenWait
+                self.requestTimeout = requestTimeout    # default wait of read(), call() and prefetch()
+                self.lockDir    = lockDir
+                self.debug      = debug
+                self.device     = (devices or DeviceManager(debug=debug)).watch(devSpec)
+                self.modbus     = None          # minimalmodbus.Instrument, the address is set per transaction
+                self.lockFile   = None
+                self.reopen     = False         # settings changed, see configure()
+                self.recorder   = None
+                if (recordDir):
+                        from serialRecorder import getRecorder
+                        self.recorder = getRecorder(recordDir, prefix="rs485")
+                self.lastEnd    = 0.0
+                self.lastSlave  = None
+                self.queue      = []
+                self.seq        = 0
+                self.cond       = threading.Condition()
+                self.stats      = {"requests": 0, "transactions": 0, "merged": 0, "errors": 0, "reopens": 0}
+                self.stages     = stageTimer("bus " + devSpec)  # wait and read, when switched on (profHooks.py)
+                self.thread     = threading.Thread(target=self.run, name="rs485Bus " + devSpec, daemon=True)
+                self.thread.start()
+
+        # mergeGap: for this slave, when its register map has no holes
+        def instrument(self, slave, priority=LIVE, mergeGap=None):
+                if (mergeGap is not None):
+                        with self.cond:
+                                self.mergeGaps[slave] = mergeGap
+                return(BusInstrument(self, slave, priority))
+
+        # new serial settings for the running bus (config reload), the port is reopened
+        # before the next transaction, queued requests stay
+        def configure(self, baudrate=9600, bytesize=8, parity='N', stopbits=1, timeout=1, minGap=0.005):
+                settings = (baudrate, bytesize, parity, stopbits, timeout)
+                with self.cond:
+                        if (settings == self.settings): return
+                        self.settings = settings
+                        self.gap      = max(minGap, 3.5 * 11 / baudrate)
+                        self.reopen   = True
+
+        def openPort(self, path):
+                import minimalmodbus
+                baudrate, bytesize, parity, stopbits, timeout = self.settings
+                modbus = minimalmodbus.Instrument(path, 1)
+                modbus.serial.baudrate = baudrate
+                modbus.serial.bytesize = bytesize
+                modbus.serial.parity   = parity
+                modbus.serial.stopbits = stopbits
+                modbus.serial.timeout  = timeout
+                modbus.mode = minimalmodbus.MODE_RTU
+                modbus.clear_buffers_before_each_transaction = True
+                if (self.recorder is not None):
+                        from serialRecorder import RecordingPort
+                        modbus.serial = RecordingPort(modbus.serial, self.recorder, self.devSpec)
+                return(modbus)
+
+        def openLock(self, path):
+                if (self.lockFile is not None): os.close(self.lockFile)
+                self.lockFile = None
+                try:
+                        self.lockFile = os.open(os.path.join(self.lockDir, "solarshed-" + os.path.basename(path) + ".lock"),
+                                                os.O_RDWR | os.O_CREAT, 0o666)
+                except OSError:
+                        pass    # no lock dir, only this process is arbitrated
+
+        def submitMany(self, items, priority=LIVE):
+                requests = []
+                with self.cond:
+                        for slave, start, count, functioncode, call in items:
+                                self.seq += 1
+                                requests.append(BusRequest(slave, start, count, functioncode, call, priority, self.seq))
+                        self.queue.extend(requests)
+                        self.stats["requests"] += len(requests)
+                        self.cond.notify()
+                return(requests)
+
+        # blocking register read, the raw 16 bit values
+        def read(self, slave, start, count=1, functioncode=3, priority=LIVE, timeout=None):
+                return(self.submitMany([(slave, start, count, functioncode, None)], priority)[0].wait(timeout or self.requestTimeout))
+
+        # run fn(instrument) for anything else (read_long, write_register, ...)
+        def call(self, slave, fn, priority=NORMAL, timeout=None):
+                return(self.submitMany([(slave, 0, 0, None, fn)], priority)[0].wait(timeout or self.requestTimeout))
+
+        # next request and the reads that can go into the same frame, called with the lock held
+        def takeBatch(self):
+                now = time.monotonic()
+                overdue = [r for r in self.queue if (now - r.enqueued) > self.maxWait]
+                if (overdue):
+                        first = min(overdue, key=lambda r: r.seq)
+                else:
+                        first = min(self.queue, key=lambda r: (r.priority, r.slave == self.lastSlave, r.seq))
+                self.queue.remove(first)
+                batch = [first]
+                if (first.call is not None): return(batch)
+
+                lo, hi = first.start, first.start + first.count
+                gap = self.mergeGaps.get(first.slave, self.mergeGap)
+                merged = True
+                while merged:
+                        merged = False
+                        for r in self.queue:
+                                if (r.call is not None or r.slave != first.slave or r.functioncode != first.functioncode): continue
+                                if (r.start > hi + gap or r.start + r.count < lo - gap): continue
+                                if (max(hi, r.start + r.count) - min(lo, r.start) > self.maxSpan): continue
+                                lo, hi = min(lo, r.start), max(hi, r.start + r.count)
+                                batch.append(r)
+                                self.queue.remove(r)
+                                merged = True
+                                break
+                self.stats["merged"] += len(batch) - 1
+                return(batch)
+
+        def ensureOpen(self):
+                if (self.modbus is not None and not self.device.changed() and not self.reopen): return(True)
+                self.reopen = False
+                if (self.modbus is not None):
+                        try:
+                                self.modbus.serial.close()
+                        except Exception:
+                                pass
+                        self.modbus = None
+                        self.stats["reopens"] += 1
+                self.modbus = self.device.open(self.openPort, maxWait=self.reopenWait)
+                if (self.modbus is None): return(False)
+                self.openLock(self.device.path)
+                return(True)
+
+        def execute(self, batch):
+                first = batch[0]
+                self.stages.begin()
+                try:
+                        if (not self.ensureOpen()): raise IOError("device not present: " + self.devSpec)
+                        wait = self.lastEnd + self.gap - time.monotonic()
+                        if (wait > 0): time.sleep(wait)
+                        if (self.lockFile is not None):
+                                fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+                        self.stages.mark("wait")        # gap and the other scripts on the port
+                        try:
+                                self.modbus.address = first.slave
+                                if (first.call is not None):
+                                        first.result = first.call(self.modbus)
+                                else:
+                                        lo = min(r.start for r in batch)
+                                        hi = max(r.start + r.count for r in batch)
+                                        values = self.modbus.read_registers(lo, hi - lo, first.functioncode)
+                                        for r in batch:
+                                                r.result = values[r.start - lo:r.start - lo + r.count]
+                                        if (self.debug): print("bus", self.devSpec, "slave", first.slave, "read", hex(lo), hi - lo,
+                                                               "registers for", len(batch), "requests")
+                        finally:
+                                self.lastEnd = time.monotonic()
+                                if (self.lockFile is not None): fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+                                self.stages.mark("read")
+                        self.stats["transactions"] += 1
+                except Exception as err:        # minimalmodbus: NoResponseError, InvalidResponseError, ... or a broken call fn
+                        self.stats["errors"] += 1
+                        # the port itself failed (SerialException, unplugged adapter): reopen it even
+                        # when the adapter comes back under the same name
+                        if (isinstance(err, OSError) and not self.isModbusError(err)): self.reopen = True
+                        for r in batch:
+                                r.error = err
+                self.lastSlave = first.slave
+                for r in batch:
+                        r.done.set()
+
+        def isModbusError(self, err):
+                try:
+                        from minimalmodbus import ModbusException
+                except ImportError:
+                        return(False)
+                return(isinstance(err, (ModbusException, TimeoutError)))
+
+        def run(self):
+                while True:
+                        with self.cond:
+                                while (not self.queue):
+                                        self.cond.wait()
+                                batch = self.takeBatch()
+                        self.execute(batch)
+
+# Stand-in for minimalmodbus.Instrument that goes through the bus. Registers read with
+# prefetch() are served from the cache until the next prefetch() or clear().
+class BusInstrument:
+        def __init__(self, bus, slave, priority=LIVE):
+                self.bus      = bus
+                self.slave    = slave
+                self.priority = priority
+                self.cache    = {}
+
+        def __repr__(self):
+                return(f"BusInstrument(slave={self.slave}, port={self.bus.devSpec}, path={self.bus.device.path})")
+
+        # blocks: [(start, count), ...], all submitted at once so the bus can merge them
+        def prefetch(self, blocks, functioncode=3, timeout=None):
+                self.cache = {}
+                requests = self.bus.submitMany([(self.slave, start, count, functioncode, None) for start, count in blocks],
+                                               self.priority)
+                for (start, count), request in zip(blocks, requests):
+                        for i, value in enumerate(request.wait(timeout or self.bus.requestTimeout)):
+                                self.cache[(functioncode, start + i)] = value
+
+        def clear(self):
+                self.cache = {}
+
+        def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+                return(self.bus.read(self.slave, registeraddress, number_of_registers, functioncode, self.priority))
+
+        def read_register(self, registeraddress, number_of_decimals=0, functioncode=3, signed=False):
+                value = self.cache.get((functioncode, registeraddress))
+                if (value is None): value = self.read_registers(registeraddress, 1, functioncode)[0]
+                if (signed and value >= 0x8000): value -= 0x10000
+                if (number_of_decimals): value = value / (10 ** number_of_decimals)
+                return(value)
+
+        def call(self, fn):
+                return(self.bus.call(self.slave, fn, self.priority))
+
+# one bus per port in a process, instruments of different slaves share it
+buses = {}
+busLock = threading.Lock()
+
+def getBus(devSpec, **settings):
+        with busLock:
+                if (devSpec not in buses): buses[devSpec] = Rs485Bus(devSpec, **settings)
+                return(buses[devSpec])
+
+# End.
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# sampleSink.py
+# Description: tee the prometheus lines the collectors print into their .prom files
+# to other consumers (local time-series store, ...).
+#
+# The collectors write every value with print(dataStr, file=fileObj). SinkFile wraps
+# that file object: the text still goes into the .prom file unchanged, but every
+# complete sample line is also handed to the sinks as (series, value, timestamp).
+#
+# A sink is any object with
+#   append(series, value, ts)   series is the full name incl. labels: BMS_A{mode="SOC"}
+#   commit(ts)                  called once the snapshot (the .prom file) is complete
+
+import time
+
+PROM_BUFFER = 16384     # bytes, a snapshot goes to the .prom file in one write
+
+# split a prometheus text line into (series, value), None for comments and garbage
+def parsePromLine(line):
+        line = line.strip()
+        if (not line or line[0] == "#"): return(None)
+        pos = line.rfind(" ")
+        if (pos < 0): return(None)
+        try:
+                value = float(line[pos+1:])
+        except ValueError:
+                return(None)
+        series = line[:pos].rstrip()
+        return(series, value)
+
+# split a series name into (metric, [(label, value), ...])
+# BMS_A{mode="SOC", stat="min"} -> ("BMS_A", [("mode", "SOC"), ("stat", "min")])
+def splitSeries(series):
+        pos = series.find("{")
+        if (pos < 0): return(series, [])
+        metric = series[:pos].strip()
+        labels = []
+        rest = series[pos+1:series.rfind("}")]
+        while rest:
+                eq = rest.find("=")
+                if (eq < 0): break
+                name = rest[:eq].strip().lstrip(",").strip()
+                start = rest.find("\"", eq) + 1
+                end = start
+                while (end < len(rest) and rest[end] != "\""):
+                        if (rest[end] == "\\"): end += 1
+                        end += 1
+                labels.append((name, rest[start:end].replace('\\"', '"')))
+                rest = rest[end+1:]
+        return(metric, labels)
+
+class SinkFile:
+        def __init__(self, fileObj, sinks, clock=time.time):
+                self.fileObj = fileObj
+                self.sinks   = sinks
+                self.clock   = clock
+                self.partial = ""
+
+        def write(self, text):
+                textLen = len(text)
+                if (self.fileObj is not None): self.fileObj.write(text)
+                if (not self.sinks): return(textLen)
+                text = self.partial + text
+                lines = text.split("\n")
+                self.partial = lines.pop()      # last piece has no newline yet
+                if (lines):
+                        ts = self.clock()
+                        for line in lines:
+                                sample = parsePromLine(line)
+                                if (sample is None): continue
+                                for sink in self.sinks:
+                                        sink.append(sample[0], sample[1], ts)
+                return(textLen)
+
+        def commit(self):
+                ts = self.clock()
+                for sink in self.sinks:
+                        sink.commit(ts)
+
+        def flush(self):
+                if (self.fileObj is not None): self.fileObj.flush()
+
+        def close(self):
+                self.commit()
+                if (self.fileObj is not None): self.fileObj.close()
+
+        def fileno(self):
+                return(self.fileObj.fileno())
+
+        def __enter__(self):
+                return(self)
+
+        def __exit__(self, *exc):
+                self.close()
+
+# open a .prom (tmp) file, tee'd to the sinks if there are any
+def openPromFile(fileName, sinks):
+        fileObj = open(fileName, mode='w', buffering=PROM_BUFFER)
+        if (sinks): return(SinkFile(fileObj, sinks))
+        return(fileObj)
+
+# End.
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# serialRecorder.py
+# Description: record the raw serial / Modbus traffic of the collectors into a compact
+# binary log, and read it back for replay and debugging.
+#
+# Hex lines on stdout (-D) double the size and are slow to replay. Here every chunk read
+# from or written to a port is one record with a monotonic timestamp, so a live system
+# can capture field bugs (e.g. the 0x58 frame length) for days:
+#  - file header:  "SSREC\x01\0\0", wall clock and monotonic ns at the start of the file
+#  - record:       payload length (u32), monotonic ns (i64), channel (u8), kind (u8), payload
+#                  kind CHANNEL names a channel number (written again in every file),
+#                  RX / TX are port bytes, MARK is a note (port opened, lost, ...)
+#  - the files rotate at maxBytes, the oldest are deleted beyond keep files
+#  - with compress="zstd" a finished file is compressed in the background (needs the
+#    zstandard package, without it the files stay uncompressed)
+#  - the writes are buffered and flushed every flushInterval seconds by a thread of the
+#    recorder, a serial reader never waits for the SD card; the recorders are closed at
+#    exit, a torn record at the end of a file (power cut) is ignored on read
+#
+# The reader maps the file (mmap), indexes the record offsets and timestamps in one pass
+# and finds a time with bisect, without parsing the records before it.
+#
+# serialRecorder.py stats FILE...                      # channels, records, bytes, time span
+# serialRecorder.py dump FILE [-c BMS_A] [-s 60 -e 120] # records as hex, seconds from the start
+# serialRecorder.py cat FILE -c BMS_A > raw.bin         # the received bytes of one channel
+
+import os, sys, mmap, time, glob, struct, atexit, bisect, threading
+from array import array
+from argparse import ArgumentParser
+
+MAGIC   = b"SSREC\x01\x00\x00"
+HEADER  = struct.Struct("<8sdq8x")      # magic, wall clock, monotonic ns
+RECORD  = struct.Struct("<IqBB")        # payload length, monotonic ns, channel, kind
+
+CHANNEL = 0
+RX      = 1
+TX      = 2
+MARK    = 3
+KINDS   = {CHANNEL: "channel", RX: "rx", TX: "tx", MARK: "mark"}
+
+class SerialRecorder:
+        def __init__(self, directory, prefix="serial", maxBytes=16 << 20, keep=20, compress=None,
+                     flushInterval=1.0, debug=False):
+                self.directory     = directory
+                self.prefix        = prefix
+                self.maxBytes      = maxBytes
+                self.keep          = keep
+                self.compress      = compress
+                self.flushInterval = flushInterval
+                self.debug         = debug
+                self.channels      = {}         # name -> number
+                self.fileObj       = None
+                self.fileName      = None
+                self.size          = 0
+                self.dirty         = False      # records not flushed yet
+                self.lock          = threading.Lock()
+                os.makedirs(directory, exist_ok=True)
+                self.flusher = threading.Thread(target=self.flushLoop, name="serialRecorder", daemon=True)
+                self.flusher.start()
+
+        def openFile(self):
+                self.fileName = os.path.join(self.directory, time.strftime(self.prefix + "-%Y%m%d-%H%M%S.ssr"))
+                suffix = 1
+                while (os.path.exists(self.fileName)):
+                        self.fileName = os.path.join(self.directory, time.strftime(self.prefix + "-%Y%m%d-%H%M%S") + f"-{suffix}.ssr")
+                        suffix += 1
+                self.fileObj = open(self.fileName, mode='wb', buffering=256 * 1024)
+                self.fileObj.write(HEADER.pack(MAGIC, time.time(), time.monotonic_ns()))
+                self.size = HEADER.size
+                for name, number in self.channels.items():
+                        self.writeRecord(number, CHANNEL, name.encode())
+                if (self.debug): print("Recording to", self.fileName)
+
+        def writeRecord(self, channel, kind, data):
+                self.fileObj.write(RECORD.pack(len(data), time.monotonic_ns(), channel, kind))
+                self.fileObj.write(data)
+                self.size += RECORD.size + len(data)
+
+        # number of a channel (one per port), created on first use
+        def channel(self, name):
+                with self.lock:
+                        number = self.channels.get(name)
+                        if (number is None):
+                                number = self.channels[name] = len(self.channels) + 1
+                                if (self.fileObj is not None): self.writeRecord(number, CHANNEL, name.encode())
+                        return(number)
+
+        def record(self, channel, kind, data):
+                if (not data): return
+                with self.lock:
+                        if (self.fileObj is None): self.openFile()
+                        self.writeRecord(channel, kind, data)
+                        self.dirty = True
+                        if (self.size >= self.maxBytes): self.rotate()
+
+        def mark(self, channel, text):
+                self.record(channel, MARK, text.encode())
+
+        def flush(self):
+                with self.lock:
+                        if (self.fileObj is None or not self.dirty): return
+                        try:
+                                self.fileObj.flush()
+                        except OSError as err:
+                                print("Failed to flush recording", self.fileName, err)
+                        self.dirty = False
+
+        # also when no more bytes come in (port lost, quiet line)
+        def flushLoop(self):
+                while True:
+                        time.sleep(self.flushInterval)
+                        self.flush()
+
+        # called with the lock held
+        def rotate(self):
+                self.fileObj.close()
+                self.dirty = False
+                finished = self.fileName
+                self.fileObj = None
+                if (self.compress == "zstd"):
+                        threading.Thread(target=self.compressFile, args=(finished,), daemon=True).start()
+                self.cleanup()
+                self.openFile()
+
+        def compressFile(self, fileName):
+                try:
+                        import zstandard
+                except ImportError:
+                        print("zstandard is not installed, recordings stay uncompressed")
+                        self.compress = None
+                        return
+                try:
+                        with open(fileName, mode='rb') as src, open(fileName + ".zst.tmp", mode='wb') as dst:
+                                zstandard.ZstdCompressor(level=3).copy_stream(src, dst)
+                        os.replace(fileName + ".zst.tmp", fileName + ".zst")
+                        os.remove(fileName)
+                except OSError as err:
+                        print("Failed to compress", fileName, err)
+
+        def cleanup(self):
+                files = sorted(glob.glob(os.path.join(self.directory, self.prefix + "-*.ssr*")), key=os.path.getmtime)
+                for fileName in files[:-self.keep] if self.keep else []:
+                        try:
+                                os.remove(fileName)
+                        except OSError:
+                                pass
+
+        def close(self):
+                with self.lock:
+                        if (self.fileObj is not None):
+                                self.fileObj.close()
+                                self.fileObj = None
+                        self.dirty = False
+
+# A port (pyserial Serial) that records everything read and written, e.g. the serial port
+# of a minimalmodbus Instrument. All other attributes go to the port.
+class RecordingPort:
+        def __init__(self, port, recorder, name):
+                object.__setattr__(self, "port", port)
+                object.__setattr__(self, "recorder", recorder)
+                object.__setattr__(self, "number", recorder.channel(name))
+
+        def read(self, size=1):
+                data = self.port.read(size)
+                self.recorder.record(self.number, RX, data)
+                return(data)
+
+        def write(self, data):
+                self.recorder.record(self.number, TX, bytes(data))
+                return(self.port.write(data))
+
+        def __getattr__(self, name):
+                return(getattr(self.port, name))
+
+        def __setattr__(self, name, value):
+                setattr(self.port, name, value)
+
+# one recorder per directory in a process, e.g. the bus and the BMS reader share it
+recorders = {}
+recorderLock = threading.Lock()
+
+def getRecorder(directory, **settings):
+        with recorderLock:
+                if (not recorders): atexit.register(closeRecorders)
+                if (directory not in recorders): recorders[directory] = SerialRecorder(directory, **settings)
+                return(recorders[directory])
+
+# the buffered records of all recorders to disk, at exit and when a daemon shuts down
+def closeRecorders():
+        with recorderLock:
+                for recorder in recorders.values():
+                        recorder.close()
+
+class RecordingReader:
+        def __init__(self, fileName):
+                self.fileName = fileName
+                if (fileName.endswith(".zst")):
+                        import zstandard
+                        with open(fileName, mode='rb') as fileObj:
+                                self.data = zstandard.ZstdDecompressor().stream_reader(fileObj).read()
+                        self.map = None
+                else:
+                        with open(fileName, mode='rb') as fileObj:
+                                self.map = mmap.mmap(fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+                        self.data = self.map
+                if (len(self.data) < HEADER.size): raise ValueError(fileName + ": not a recording")
+                magic, self.wallStart, self.monoStart = HEADER.unpack_from(self.data, 0)
+                if (magic != MAGIC): raise ValueError(fileName + ": not a recording")
+                self.offsets  = array('Q')      # record offsets
+                self.times    = array('q')      # and their timestamps, for bisect
+                self.channels = {}              # number -> name
+                self.index()
+
+        def index(self):
+                data, pos, end = self.data, HEADER.size, len(self.data)
+                while (pos + RECORD.size <= end):
+                        length, ts, channel, kind = RECORD.unpack_from(data, pos)
+                        if (pos + RECORD.size + length > end): break    # torn at the end, still written or crashed
+                        if (kind == CHANNEL):
+                                self.channels[channel] = bytes(data[pos + RECORD.size:pos + RECORD.size + length]).decode()
+                        self.offsets.append(pos)
+                        self.times.append(ts)
+                        pos += RECORD.size + length
+
+        def __len__(self):
+                return(len(self.offsets))
+
+        def wallTime(self, ts):
+                return(self.wallStart + (ts - self.monoStart) / 1e9)
+
+        # first record at or after ts (monotonic ns)
+        def find(self, ts):
+                return(bisect.bisect_left(self.times, ts))
+
+        # (ts, channel name, kind, payload) with optional time range (seconds from the start)
+        def records(self, start=None, end=None, channel=None, kinds=None):
+                first = self.find(self.monoStart + int(start * 1e9)) if start is not None else 0
+                last  = self.find(self.monoStart + int(end * 1e9)) if end is not None else len(self.offsets)
+                view  = memoryview(self.data)
+                for i in range(first, last):
+                        pos = self.offsets[i]
+                        length, ts, number, kind = RECORD.unpack_from(self.data, pos)
+                        if (kinds is not None and kind not in kinds): continue
+                        name = self.channels.get(number, str(number))
+                        if (channel is not None and name != channel): continue
+                        yield(ts, name, kind, view[pos + RECORD.size:pos + RECORD.size + length])
+
+        def close(self):
+                if (self.map is None): return
+                try:
+                        self.map.close()
+                except BufferError:
+                        pass            # a payload view is still used, closed when it is gone
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Read serial recordings")
+        parser.add_argument("command", choices=["stats", "dump", "cat"])
+        parser.add_argument("files", nargs="+", help="recording files (.ssr or .ssr.zst)")
+        parser.add_argument("-c", "--channel", help="only this channel (e.g. BMS_A or the port)")
+        parser.add_argument("-s", "--start", type=float, help="seconds from the start of the file")
+        parser.add_argument("-e", "--end", type=float, help="seconds from the start of the file")
+        args = parser.parse_intermixed_args()
+
+        for fileName in args.files:
+                reader = RecordingReader(fileName)
+                if (args.command == "stats"):
+                        counts = {}
+                        for ts, name, kind, payload in reader.records(args.start, args.end, args.channel):
+                                entry = counts.setdefault((name, KINDS.get(kind, kind)), [0, 0])
+                                entry[0] += 1
+                                entry[1] += len(payload)
+                        span = (reader.times[-1] - reader.times[0]) / 1e9 if len(reader) else 0
+                        print(f"{fileName}: {len(reader)} records, {span:.1f} s from",
+                              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(reader.wallStart)))
+                        for (name, kind), (records, size) in sorted(counts.items()):
+                                print(f"  {name:20} {kind:8} {records:8} records {size:10} bytes")
+                elif (args.command == "dump"):
+                        for ts, name, kind, payload in reader.records(args.start, args.end, args.channel):
+                                wall = reader.wallTime(ts)
+                                text = bytes(payload).decode(errors="replace") if kind in (CHANNEL, MARK) else payload.hex()
+                                print(time.strftime("%H:%M:%S", time.localtime(wall)) + f".{int(wall * 1000) % 1000:03d}",
+                                      name, KINDS.get(kind, kind), text)
+                else:
+                        for ts, name, kind, payload in reader.records(args.start, args.end, args.channel, (RX,)):
+                                sys.stdout.buffer.write(payload)
+                reader.close()
+
+# End.
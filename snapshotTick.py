@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# snapshotTick.py
+# Description: coordinated sampling, one clock asks all devices at once and the values
+# are published as one snapshot with one timestamp.
+#
+# Every collector runs its own loop (BMS frames every second, MPP every 1-4 s, Renogy
+# every 10 s, the power meters without a pause), so a panel like PV in = load + battery
+# + losses mixes values taken seconds apart. Here:
+#  - one tick on wall clock boundaries (every --interval seconds, e.g. :00 :05 :10)
+#  - on the tick all polled devices are asked concurrently, one thread per device.
+#    The Modbus slaves on one RS485 line are still serialised by the bus owner
+#    (rs485Bus.py), different ports run in parallel.
+#  - the BMS can't be asked, it sends frames by itself. With --bms the packs are read in
+#    this process (like getChargeryData.py, same files), the snapshot takes their latest
+#    values at the tick. Other collectors (getTracerData.py, the shell scripts) are read
+#    from their .prom file with --file, the age of the file is in the snapshot.
+#  - a device that doesn't answer before the deadline (--deadline, part of the interval)
+#    is left out of this snapshot, it isn't asked again before its request is done.
+#  - all lines of the polled devices go into one file (/ramdisk/snapshot.prom, written
+#    atomically) and to the sinks with the tick time as the timestamp. Don't run
+#    powerMeter.py / RenogyWanderer.py / mppSession.py for the same devices beside it.
+#  - the energy balance is computed from the same snapshot: sums of the series matching
+#    the --pv, --load and --battery patterns (shell style, like the alert rules),
+#    losses = pv - load - battery (battery > 0 is charging). Without a value for every
+#    pattern the balance is left out and snapshot{mode="complete"} is 0.
+#
+# Output example:
+# snapshot{mode="pvWatts"} 412.0
+# snapshot{mode="lossWatts"} 23.5
+# snapshot{mode="pollTime", device="renogy"} 0.412
+# snapshot{mode="age", device="BMS_A"} 0.61
+#
+# Usage: snapshotTick.py [-i 5] [--meters] [--renogy] [--mpp /dev/hidraw0] [--bms /dev/ttyUSB2 -c 16]
+#                        [--file /ramdisk/solarData.txt.prom] [-S DIR] [-R URL] [-A RULES] [-M BROKER] [-D]
+
+import os, io, time, fnmatch, threading
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor, wait
+from sampleSink import SinkFile, parsePromLine
+from profHooks import stageTimer
+
+debug = False
+
+# defaults of the energy balance, any series in the snapshot can be used
+PV_SERIES      = ['Renogy{mode="pvWatts"}', 'MPP*{mode="pvWatts"}']
+LOAD_SERIES    = ['QC_power{mode="totalWatts"}', 'Renogy{mode="loadWatts"}']
+BATTERY_SERIES = ['BMS_*{mode="power", pack=*}']
+
+# a device asked on every tick: poll(fileObj) writes its prometheus lines
+class PollSource:
+        published = True        # the lines go into the snapshot file
+
+        def __init__(self, name, poll):
+                self.name     = name
+                self.poll     = poll
+                self.future   = None
+                self.duration = None
+                self.missed   = 0       # ticks left out, still busy or too slow
+                self.errors   = 0
+
+        def collect(self, fileObj):
+                self.poll(fileObj)
+                return(0.0)
+
+# a .prom file written by another collector, only read for the balance and the age
+class FileSource(PollSource):
+        published = False
+
+        def __init__(self, fileName, maxAge):
+                PollSource.__init__(self, os.path.basename(fileName).split(".")[0], None)
+                self.fileName = fileName
+                self.maxAge   = maxAge
+
+        def collect(self, fileObj):
+                age = time.time() - os.path.getmtime(self.fileName)
+                if (age <= self.maxAge):
+                        with open(self.fileName, mode='r') as promFile:
+                                fileObj.write(promFile.read())
+                return(age)
+
+# a Chargery pack read in this process (getChargeryData.py), the latest values at the tick
+class PackSource(PollSource):
+        published = False       # the pack writes its own files
+
+        def __init__(self, pack):
+                PollSource.__init__(self, pack.metric, None)
+                self.pack = pack
+
+        def collect(self, fileObj):
+                import getChargeryData
+                pack = self.pack
+                if (pack.lastUpdate is None): return(None)
+                getChargeryData.writeDerived(pack, fileObj)
+                if (pack.current is not None):
+                        print(f"{pack.metric}{{mode=\"current\"{pack.label}}} {pack.current}", file=fileObj)
+                if (pack.soc is not None):
+                        print(f"{pack.metric}{{mode=\"SOC\"{pack.label}}} {pack.soc}", file=fileObj)
+                return(time.monotonic() - pack.lastUpdate)
+
+class SnapshotTick:
+        def __init__(self, sources, fileName, sinks, interval=5.0, deadline=0.8,
+                     pv=PV_SERIES, load=LOAD_SERIES, battery=BATTERY_SERIES):
+                self.sources  = sources
+                self.fileName = fileName
+                self.sinks    = sinks
+                self.interval = interval
+                self.deadline = deadline * interval
+                self.balance  = {"pvWatts": pv, "loadWatts": load, "batteryWatts": battery}
+                self.pool     = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="snapshot")
+
+        def run(self, source, fileObj):
+                start = time.monotonic()
+                try:
+                        age = source.collect(fileObj)
+                except Exception as err:        # IOError of a port, a missing file, ...
+                        print("Snapshot source", source.name, "failed:", err)
+                        source.errors += 1
+                        age = None
+                source.duration = time.monotonic() - start
+                return(age)
+
+        # sleep until the next wall clock boundary, e.g. :05 with 5 s
+        def waitTick(self):
+                now = time.time()
+                tick = (int(now / self.interval) + 1) * self.interval
+                time.sleep(max(0.0, tick - now))
+                return(tick)
+
+        def sample(self, tickTime):
+                jobs = {}
+                for source in self.sources:
+                        if (source.future is not None and not source.future.done()):
+                                source.missed += 1      # last request still running
+                                continue
+                        buf = io.StringIO()
+                        source.future = self.pool.submit(self.run, source, buf)
+                        jobs[source.future] = (source, buf)
+                done, late = wait(jobs, timeout=self.deadline)
+
+                text, values, ages = "", {}, {}
+                for future, (source, buf) in jobs.items():     # in the order of the sources
+                        if (future not in done): continue
+                        ages[source.name] = future.result()
+                        lines = buf.getvalue()
+                        if (source.published): text += lines
+                        for line in lines.split("\n"):
+                                sample = parsePromLine(line)
+                                if (sample is not None): values[sample[0]] = sample[1]
+                for future in late:
+                        jobs[future][0].missed += 1
+                return(text, values, ages)
+
+        def writeBalance(self, fileObj, values):
+                sums = {}
+                for mode, patterns in self.balance.items():
+                        total = 0.0
+                        for pattern in patterns:
+                                found = [v for s, v in values.items() if fnmatch.fnmatchcase(s, pattern)]
+                                if (not found): return(False)
+                                total += sum(found)
+                        sums[mode] = total
+                for mode, total in sums.items():
+                        print(f"snapshot{{mode=\"{mode}\"}} {total:.1f}", file=fileObj)
+                lossWatts = sums["pvWatts"] - sums["loadWatts"] - sums["batteryWatts"]
+                print(f"snapshot{{mode=\"lossWatts\"}} {lossWatts:.1f}", file=fileObj)
+                return(True)
+
+        def write(self, tickTime, text, values, ages):
+                tmpName = self.fileName + ".tmp"
+                fileObj = open(tmpName, mode='w')
+                if (self.sinks): fileObj = SinkFile(fileObj, self.sinks, clock=lambda: tickTime)  # one timestamp for all
+                with fileObj:
+                        fileObj.write(text)
+                        complete = self.writeBalance(fileObj, values)
+                        print(f"snapshot{{mode=\"complete\"}} {1 if complete else 0}", file=fileObj)
+                        print(f"snapshot{{mode=\"time\"}} {tickTime:.3f}", file=fileObj)
+                        for source in self.sources:
+                                device = f", device=\"{source.name}\""
+                                if (source.duration is not None):
+                                        print(f"snapshot{{mode=\"pollTime\"{device}}} {source.duration:.3f}", file=fileObj)
+                                if (ages.get(source.name) is not None and not source.published):
+                                        print(f"snapshot{{mode=\"age\"{device}}} {ages[source.name]:.2f}", file=fileObj)
+                                print(f"snapshot{{mode=\"missed\"{device}}} {source.missed}", file=fileObj)
+                                print(f"snapshot{{mode=\"errors\"{device}}} {source.errors}", file=fileObj)
+                os.replace(tmpName, self.fileName)
+
+        def loop(self):
+                stages = stageTimer("snapshot")         # when switched on (profHooks.py)
+                while True:
+                        tickTime = self.waitTick()
+                        stages.begin()
+                        text, values, ages = self.sample(tickTime)
+                        stages.mark("sample")
+                        self.write(tickTime, text, values, ages)
+                        stages.mark("publish")
+                        if (debug): print("Snapshot", time.strftime("%H:%M:%S", time.localtime(tickTime)), len(values), "values,",
+                                          ", ".join(f"{s.name} {s.duration:.2f}s" for s in self.sources if s.duration is not None))
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Sample all devices on one clock and publish one snapshot")
+        parser.add_argument("-i", "--interval", type=float, default=5.0, help="seconds between two snapshots (default: 5)")
+        parser.add_argument("--deadline", type=float, default=0.8,
+                            help="part of the interval a device has to answer (default: 0.8)")
+        parser.add_argument("-o", "--output", default="/ramdisk/snapshot.prom", help="snapshot file (default: /ramdisk/snapshot.prom)")
+        parser.add_argument("--meters", action="store_true", help="poll the QC power meters (settings in powerMeter.py)")
+        parser.add_argument("--renogy", action="store_true", help="poll the Renogy controller (settings in RenogyWanderer.py)")
+        parser.add_argument("--mpp", action="append", help="poll the MPP inverter on this hidraw device (repeatable)")
+        parser.add_argument("--mpp-name", action="append", help="metric name per --mpp device (default: MPP5048MGX)")
+        parser.add_argument("--bms", action="append", help="read a Chargery BMS on this port in this process (repeatable, packs A, B, ...)")
+        parser.add_argument("-c", "--cells", type=int, default=8, help="cells per BMS pack (default: 8)")
+        parser.add_argument("-P", "--protocol", default="V126", help="Chargery protocol version (default: V126)")
+        parser.add_argument("--file", action="append", help="read this .prom file of another collector (repeatable)")
+        parser.add_argument("--max-age", type=float, default=30, help="ignore --file files older than this (default: 30 s)")
+        parser.add_argument("--pv", action="append", help="series pattern of PV power (repeatable, default: Renogy and MPP pvWatts)")
+        parser.add_argument("--load", action="append", help="series pattern of load power (repeatable, default: QC totalWatts and Renogy loadWatts)")
+        parser.add_argument("--battery", action="append", help="series pattern of battery power, > 0 charging (default: BMS_* power)")
+        parser.add_argument("-S", "--store", help="Also write every snapshot into the local time-series store in this directory")
+        parser.add_argument("-R", "--remote-write", help="Also push all snapshots to this Prometheus remote-write URL")
+        parser.add_argument("-A", "--alerts", help="Check every value against the local alert rules in this file")
+        parser.add_argument("-M", "--mqtt", help="Also publish the changed values to this MQTT broker (host[:port])")
+        parser.add_argument("-E", "--events", type=int, help="Also serve every snapshot as a live event stream (SSE) on this port")
+        parser.add_argument("-D", "--debug", action="store_true", help="Enable Debug and above (i.e. all) messages")
+        args = parser.parse_args()
+        debug = args.debug
+
+        sinks = []
+        if (args.store):
+                from tsStore import TSStore
+                sinks.append(TSStore(args.store, writer="snapshot"))
+        if (args.remote_write):
+                from remoteWrite import RemoteWriter
+                sinks.append(RemoteWriter(args.remote_write, queueDir="/var/spool/solarshed/snapshot", debug=debug))
+        if (args.alerts):
+                from alertEngine import AlertEngine
+                alertEngine = AlertEngine(args.alerts, debug=debug)
+                sinks.append(alertEngine)
+        if (args.mqtt):
+                from mqttSink import MqttSink
+                mqttSink = MqttSink(args.mqtt, debug=debug)
+                sinks.append(mqttSink)
+        if (args.events):
+                from liveStream import LiveStream
+                liveStream = LiveStream(args.events, debug=debug)
+                sinks.append(liveStream)
+
+        import profHooks
+        profHooks.install("snapshotTick", debug=debug)        # kill -USR1 / profHooks.py: profile the running ticker
+
+        sources = []
+        if (args.meters):
+                import powerMeter
+                powerMeter.debug = debug
+                sources.append(PollSource("meters", powerMeter.pollPower))
+        if (args.renogy):
+                import RenogyWanderer
+                RenogyWanderer.debug = debug
+                sources.append(PollSource("renogy", RenogyWanderer.pollRenogy))
+        for i, port in enumerate(args.mpp or []):
+                from mppSession import MppSession, MppReader
+                name = args.mpp_name[i] if (args.mpp_name and i < len(args.mpp_name)) else "MPP5048MGX"
+                reader = MppReader(MppSession(port), name, os.path.dirname(args.output))
+                sources.append(PollSource(name, reader.read))
+        if (args.bms):
+                import getChargeryData
+                from deviceManager import DeviceManager
+                getChargeryData.debug = debug
+                getChargeryData.protocolVersion = args.protocol
+                if (args.alerts): getChargeryData.alertEngine = alertEngine     # the packs check their values too
+                if (args.mqtt): getChargeryData.mqttSink = mqttSink
+                if (args.events): getChargeryData.liveStream = liveStream
+                bmsArgs = Namespace(window=15, store=args.store, remote_write=args.remote_write,
+                                    energy_state="/var/lib/solarshed/BMS_{pack}_energy.json",
+                                    health_state="/var/lib/solarshed/BMS_{pack}_health.json")
+                devices = DeviceManager(debug=debug)
+                for i, port in enumerate(args.bms):
+                        pack = getChargeryData.ChargeryPack(chr(ord('A') + i), port, args.cells, bmsArgs, devices)
+                        threading.Thread(target=getChargeryData.readPack, args=(pack,), name=pack.metric, daemon=True).start()
+                        sources.append(PackSource(pack))
+        for fileName in args.file or []:
+                sources.append(FileSource(fileName, args.max_age))
+        if (not sources):
+                parser.error("nothing to sample, give --meters, --renogy, --mpp, --bms or --file")
+
+        ticker = SnapshotTick(sources, args.output, sinks, args.interval, args.deadline,
+                              args.pv or PV_SERIES, args.load or LOAD_SERIES, args.battery or BATTERY_SERIES)
+        try:
+                ticker.loop()
+        except KeyboardInterrupt:
+                pass
+        for sink in sinks:
+                sink.close()
+
+# End.
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+# solarshed.py
+# Description: run the collectors from one config file and reload it without a restart.
+#
+# Ports, cell counts, protocol versions and poll intervals are constants or command line
+# flags in every collector, a change means a restart and the samples in between are lost.
+# Here the devices are described in one JSON file (see solarshed.example.json):
+#   "output":  directory of the .prom files (default /ramdisk)
+#   "sinks":   {"store": DIR, "remoteWrite": URL, "alerts": RULES, "mqtt": BROKER, "live": PORT, "record": DIR}
+#   "schedule": {"lowPower": true, "slot": 5, "nightFactor": 6, ...} one timer for all devices,
+#               aligned slots and longer intervals at night, see lowPower.py
+#   "devices": {"<name>": {"driver": ..., ...}, ...}
+#     chargery  port, pack (default A), cells, protocol (V126), window (15)
+#               the BMS frames, same files as getChargeryData.py (BMS_<pack>_sys.prom, ...)
+#     modbus    port, slave, baudrate (9600), timeout (1), interval (s), metric (<name>),
+#               registers: [{"mode": "batVolts", "address": "0x101", "decimals": 1,
+#                            "functioncode": 3, "signed": false, "mask": "0xff", "shift": 0}]
+#               the registers are read in as few frames as possible (rs485Bus.py),
+#               devices on one port share the bus, give them the same baudrate and timeout;
+#               mergeGap (0): also read up to that many unrequested registers between two
+#               blocks to save frames, only for slaves without holes in their register map
+#     mpp       port (/dev/hidraw0), interval (1), refresh (3600), metric (<name>)
+#   Each modbus / mpp device writes <output>/<name>.prom every interval seconds.
+#
+# The file is read again on SIGHUP or when it changed (checked every 2 s). Only devices
+# whose entry changed are stopped and started again, the others keep running. The ports
+# are kept: a BMS port, an MPP session or an RS485 bus go to the new worker of the same
+# port (new serial settings only reopen the bus). A config with errors is reported and the
+# running one stays. A change of "sinks", "output" or "schedule" restarts all devices.
+#
+# Usage: solarshed.py [-c /etc/solarshed.json] [-D]
+#        kill -HUP <pid>                        # reload now
+
+import os, json, time, signal, atexit, threading
+from argparse import ArgumentParser, Namespace
+from sampleSink import openPromFile
+from profHooks import stageTimer
+
+debug = False
+
+def number(value):
+        return(int(value, 0) if isinstance(value, str) else value)
+
+# everything the workers share: sinks and the ports left by stopped workers
+class Context:
+        def __init__(self, config):
+                self.spec    = config.get("sinks", {})
+                self.output  = config.get("output", "/ramdisk")
+                self.schedule = config.get("schedule", {})
+                self.shared  = []               # alert engine, MQTT and live stream, one for all devices
+                self.alertEngine = None
+                self.mqttSink    = None
+                self.liveStream  = None
+                self.scheduler   = None
+                self.ports   = {}               # (driver, port) -> handle of a stopped worker
+                from deviceManager import DeviceManager
+                self.devices = DeviceManager(debug=debug)
+                if (self.spec.get("alerts")):
+                        from alertEngine import AlertEngine
+                        self.alertEngine = AlertEngine(self.spec["alerts"], debug=debug)
+                        self.shared.append(self.alertEngine)
+                if (self.spec.get("mqtt")):
+                        from mqttSink import MqttSink
+                        self.mqttSink = MqttSink(self.spec["mqtt"], debug=debug)
+                        self.shared.append(self.mqttSink)
+                if (self.spec.get("live")):
+                        from liveStream import LiveStream
+                        self.liveStream = LiveStream(self.spec["live"], debug=debug)
+                        self.shared.append(self.liveStream)
+                if (self.schedule.get("lowPower")):
+                        from lowPower import SlotScheduler
+                        s = self.schedule
+                        self.scheduler = SlotScheduler(s.get("slot", 5), s.get("nightFactor", 6), s.get("nightAfter", 900),
+                                                       s.get("pv"), s.get("pvThreshold", 0), os.path.join(self.output, "solarshed_power.prom"),
+                                                       s.get("report", 60), s.get("slack", 0.05), debug=debug)
+                        self.shared.append(self.scheduler)     # sees the PV values of all devices
+
+        # the store and remote-write sinks of one device, plus the shared ones
+        def sinks(self, name):
+                sinks = []
+                if (self.spec.get("store")):
+                        from tsStore import TSStore
+                        sinks.append(TSStore(self.spec["store"], writer=name))
+                if (self.spec.get("remoteWrite")):
+                        from remoteWrite import RemoteWriter
+                        sinks.append(RemoteWriter(self.spec["remoteWrite"], queueDir="/var/spool/solarshed/" + name, debug=debug))
+                return(sinks + self.shared)
+
+        def closeSinks(self, sinks):
+                for sink in sinks:
+                        if (sink not in self.shared): sink.close()
+
+        def take(self, key):
+                return(self.ports.pop(key, None))
+
+        def release(self, key, handle):
+                self.ports[key] = handle
+
+        # ports no new worker took
+        def closePorts(self):
+                for key, handle in self.ports.items():
+                        if (debug): print("Closing unused port", key)
+                        try:
+                                handle.close()
+                        except OSError:
+                                pass
+                self.ports = {}
+
+        def close(self):
+                self.closePorts()
+                for sink in self.shared:
+                        sink.close()
+                if (self.spec.get("record")):
+                        from serialRecorder import closeRecorders
+                        closeRecorders()        # the buffered frames of the bus and the BMS readers
+
+# a device asked every interval seconds, poll() writes the lines of <output>/<name>.prom
+class PollWorker:
+        def __init__(self, name, spec, context):
+                self.name     = name
+                self.spec     = spec
+                self.context  = context
+                self.metric   = spec.get("metric", name)
+                self.interval = float(spec.get("interval", 10))
+                self.fileName = os.path.join(context.output, name + ".prom")
+                self.sinks    = context.sinks(name)
+                self.stopped  = threading.Event()
+                self.job      = None            # the slot of this worker in low-power mode
+                self.stages   = stageTimer(name)        # poll and publish, when switched on (profHooks.py)
+                self.thread   = threading.Thread(target=self.run, name=name, daemon=True)
+
+        def start(self):
+                if (self.context.scheduler): self.job = self.context.scheduler.add(self.name, self.interval)
+                self.thread.start()
+
+        def pollFile(self):
+                self.stages.begin()
+                try:
+                        with openPromFile(self.fileName + ".tmp", self.sinks) as fileObj:
+                                self.poll(fileObj)
+                                self.stages.mark("poll")
+                        os.replace(self.fileName + ".tmp", self.fileName)
+                        self.stages.mark("publish")
+                except (OSError, ValueError) as err:
+                        print("Device", self.name, "read failed:", err)
+
+        def run(self):
+                if (self.job is not None):
+                        self.pollFile()         # the first one now, then in the slots
+                        while (self.job.wait()):
+                                self.pollFile()
+                        return
+                nextPoll = time.monotonic()
+                while (not self.stopped.is_set()):
+                        self.pollFile()
+                        nextPoll += self.interval
+                        delay = nextPoll - time.monotonic()
+                        if (delay < 0):
+                                nextPoll, delay = time.monotonic(), 0       # behind, don't try to catch up
+                        self.stopped.wait(delay)
+
+        def stop(self, timeout=10):
+                self.stopped.set()
+                if (self.job is not None): self.context.scheduler.remove(self.job)
+                self.thread.join(timeout)
+                self.context.closeSinks(self.sinks)
+
+class ModbusWorker(PollWorker):
+        def __init__(self, name, spec, context):
+                PollWorker.__init__(self, name, spec, context)
+                from rs485Bus import getBus
+                settings = dict(baudrate=int(spec.get("baudrate", 9600)), timeout=float(spec.get("timeout", 1)))
+                bus = getBus(spec["port"], recordDir=context.spec.get("record"), devices=context.devices, debug=debug, **settings)
+                bus.configure(**settings)       # the bus of this port outlives the worker, only new settings reopen it
+                mergeGap = spec.get("mergeGap")
+                self.instrument = bus.instrument(int(spec.get("slave", 1)), mergeGap=None if (mergeGap is None) else int(mergeGap))
+                self.registers  = []
+                for reg in spec["registers"]:
+                        self.registers.append((reg["mode"], number(reg["address"]), int(reg.get("decimals", 0)),
+                                               int(reg.get("functioncode", 3)), bool(reg.get("signed", False)),
+                                               number(reg.get("mask", 0)), int(reg.get("shift", 0))))
+                # neighbouring registers per function code, the bus merges them into frames
+                self.blocks = {}
+                for mode, address, decimals, functioncode, signed, mask, shift in sorted(self.registers, key=lambda r: (r[3], r[1])):
+                        blocks = self.blocks.setdefault(functioncode, [])
+                        if (blocks and address <= blocks[-1][0] + blocks[-1][1]):
+                                blocks[-1][1] = max(blocks[-1][1], address - blocks[-1][0] + 1)
+                        else:
+                                blocks.append([address, 1])
+
+        def poll(self, fileObj):
+                for functioncode, blocks in self.blocks.items():
+                        self.instrument.prefetch([tuple(b) for b in blocks], functioncode=functioncode)
+                for mode, address, decimals, functioncode, signed, mask, shift in self.registers:
+                        value = self.instrument.read_register(address, 0, functioncode, signed)
+                        if (shift): value >>= shift
+                        if (mask): value &= mask
+                        if (decimals): value = round(value / (10 ** decimals), decimals)
+                        print(f"{self.metric}{{mode=\"{mode}\"}} {value}", file=fileObj)
+
+class MppWorker(PollWorker):
+        def __init__(self, name, spec, context):
+                spec = dict({"interval": 1}, **spec)
+                PollWorker.__init__(self, name, spec, context)
+                from mppSession import MppSession, MppReader
+                self.key     = ("mpp", spec.get("port", "/dev/hidraw0"))
+                self.session = context.take(self.key) or MppSession(self.key[1], devices=context.devices)
+                self.reader  = MppReader(self.session, self.metric, context.output, float(spec.get("refresh", 3600)))
+
+        def stop(self, timeout=10):
+                PollWorker.stop(self, timeout)
+                self.context.release(self.key, self.session)
+
+# one Chargery pack, the BMS sends by itself, see getChargeryData.py
+class ChargeryWorker:
+        def __init__(self, name, spec, context):
+                import getChargeryData
+                self.bms     = getChargeryData
+                self.name    = name
+                self.context = context
+                self.key     = ("chargery", spec["port"])
+                getChargeryData.debug       = debug
+                getChargeryData.alertEngine = context.alertEngine
+                getChargeryData.mqttSink    = context.mqttSink
+                getChargeryData.liveStream  = context.liveStream
+                if (context.scheduler): getChargeryData.lowPower()
+                if (context.spec.get("record") and getChargeryData.recorder is None):
+                        import serialRecorder
+                        getChargeryData.recorder = serialRecorder.getRecorder(context.spec["record"], prefix="chargery")
+                        getChargeryData.RX = serialRecorder.RX
+                args = Namespace(window=int(spec.get("window", 15)),
+                                 store=context.spec.get("store"), remote_write=context.spec.get("remoteWrite"),
+                                 energy_state=spec.get("energyState", "/var/lib/solarshed/BMS_{pack}_energy.json"),
+                                 health_state=spec.get("healthState", "/var/lib/solarshed/BMS_{pack}_health.json"))
+                self.pack = getChargeryData.ChargeryPack(spec.get("pack", "A"), spec["port"], int(spec.get("cells", 8)),
+                                                         args, context.devices, protocol=spec.get("protocol", "V126"))
+                old = context.take(self.key)
+                if (old is not None):
+                        # keep reading the open port: same device watch, the port is not reopened
+                        context.devices.unwatch(self.pack.device)
+                        self.pack.device, self.pack.port = old.device, old.port
+                self.thread = threading.Thread(target=getChargeryData.readPack, args=(self.pack,), name=name, daemon=True)
+
+        def start(self):
+                self.thread.start()
+
+        def stop(self, timeout=10):
+                pack = self.pack
+                pack.running = False
+                self.thread.join(timeout)
+                # the state goes to the files now, the new pack of this port loads it
+                for owner in (pack.integrator, pack.health):
+                        owner.save()
+                        atexit.unregister(owner.save)
+                for fileObj in (pack.fileObj, pack.fileObjImp):
+                        if (fileObj is not None): fileObj.close()
+                self.context.closeSinks(pack.sinks)
+                if (pack.port is not None):
+                        self.context.release(self.key, OpenPort(pack.device, pack.port))
+                else:
+                        self.context.devices.unwatch(pack.device)
+
+# the open BMS port and its device watch, handed from a stopped pack to the next one
+class OpenPort:
+        def __init__(self, device, port):
+                self.device = device
+                self.port   = port
+
+        def close(self):
+                self.port.close()
+                self.device.manager.unwatch(self.device)
+
+DRIVERS = {"chargery": ChargeryWorker, "modbus": ModbusWorker, "mpp": MppWorker}
+
+class Daemon:
+        def __init__(self, configFile):
+                self.configFile = configFile
+                self.config     = None
+                self.context    = None
+                self.workers    = {}            # name -> worker
+                self.specs      = {}            # name -> device entry of the running worker
+                self.mtime      = None
+                self.reloadNow  = threading.Event()
+
+        def readConfig(self):
+                mtime = os.path.getmtime(self.configFile)
+                with open(self.configFile, mode='r') as fileObj:
+                        config = json.load(fileObj)
+                for name, spec in config.get("devices", {}).items():
+                        if (spec.get("driver") not in DRIVERS):
+                                raise ValueError(f"device {name}: unknown driver {spec.get('driver')}")
+                        if (spec["driver"] != "mpp" and "port" not in spec):
+                                raise ValueError(f"device {name}: needs a port")
+                return(config, mtime)
+
+        def reload(self):
+                try:
+                        config, mtime = self.readConfig()
+                except (OSError, ValueError) as err:
+                        print("Config", self.configFile, "not loaded, keeping the running one:", err)
+                        return
+                self.mtime = mtime
+                if (config == self.config): return
+                devices = config.get("devices", {})
+                if (self.context is None or config.get("sinks", {}) != self.context.spec or config.get("output", "/ramdisk") != self.context.output
+                    or config.get("schedule", {}) != self.context.schedule):
+                        self.stopAll()
+                        if (self.context is not None): self.context.close()
+                        self.context = Context(config)
+                for name in list(self.workers):
+                        if (devices.get(name) != self.specs[name]):
+                                print("Stopping", name)
+                                self.workers.pop(name).stop()
+                                del self.specs[name]
+                for name, spec in devices.items():
+                        if (name in self.workers): continue
+                        print("Starting", name, spec["driver"], spec.get("port", ""))
+                        try:
+                                worker = DRIVERS[spec["driver"]](name, spec, self.context)
+                        except (OSError, ValueError, KeyError) as err:
+                                print("Device", name, "not started:", err)
+                                continue
+                        worker.start()
+                        self.workers[name] = worker
+                        self.specs[name] = spec
+                self.context.closePorts()
+                self.config = config
+
+        def stopAll(self):
+                for name, worker in self.workers.items():
+                        worker.stop()
+                self.workers = {}
+                self.specs = {}
+
+        def run(self, checkInterval=2.0):
+                self.reload()
+                while True:
+                        self.reloadNow.wait(checkInterval)
+                        if (self.reloadNow.is_set()):
+                                self.reloadNow.clear()
+                                print("SIGHUP, reloading", self.configFile)
+                                self.reload()
+                                continue
+                        try:
+                                if (os.path.getmtime(self.configFile) != self.mtime): self.reload()
+                        except OSError:
+                                pass            # replaced right now, next round
+
+################ main ##################
+
+if __name__ == "__main__":
+        parser = ArgumentParser(description="Run the collectors described in a config file, reload it on SIGHUP or change")
+        parser.add_argument("-c", "--config", default="/etc/solarshed.json", help="config file (default: /etc/solarshed.json)")
+        parser.add_argument("-D", "--debug", action="store_true", help="Enable Debug and above (i.e. all) messages")
+        args = parser.parse_args()
+        debug = args.debug
+
+        import profHooks
+        profHooks.install("solarshed", debug=debug)   # kill -USR1 / profHooks.py: profile the running devices
+        daemon = Daemon(args.config)
+        signal.signal(signal.SIGHUP, lambda signum, frame: daemon.reloadNow.set())
+        try:
+                daemon.run()
+        except KeyboardInterrupt:
+                pass
+        daemon.stopAll()
+        if (daemon.context is not None): daemon.context.close()
+
+# End.
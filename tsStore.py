@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+# tsStore.py
+# Description: small embedded append-only time-series store for offline-first operation.
+#
+# The .prom files in /ramdisk only hold the latest snapshot. When the link to the
+# Prometheus host is down the data is lost. The collectors can write every sample at
+# full resolution into this store as well and the data can be exported for backfill
+# later on (see the export command below).
+#
+# Layout on disk (store directory, keep it on the SD card, not on /ramdisk):
+#   YYYYMMDD-<writer>.seg   one segment file per day and writing process
+#
+# A segment is a sequence of fixed-size blocks (BLOCK_SIZE bytes). Every block holds
+# the samples of one series, stored columnar:
+#   header | series name | timestamp column | value column | zero padding
+#   timestamps: ms since epoch, delta-of-delta, zigzag varint (regular polls -> 1 byte)
+#   values:     scaled to integers (10^scaleExp), delta, zigzag varint
+# Blocks are self describing, so several collectors can share one store directory
+# without a common index. Reads go through mmap. A torn block at the end of a segment
+# (power cut while writing) is cut off when the segment is opened again, so the blocks
+# after it stay at BLOCK_SIZE offsets.
+#
+# Memory: one open block (max. BLOCK_SIZE bytes) per series and writer.
+# Retention: segments older than retentionDays are deleted, compact() rewrites the
+# partly filled blocks of closed days into full blocks. A writer compacts by itself when
+# a new day starts (its own segments before yesterday, in a thread).
+#
+# usage: tsStore.py DIR {stats,series,export,compact,ingest} ...
+
+import os, sys, time, mmap, struct, math, threading
+from argparse import ArgumentParser
+
+BLOCK_SIZE  = 4096
+BLOCK_MAGIC = b"TSB1"
+# magic, version, scaleExp, nameLen, count, tsLen, valLen, firstTs, lastTs
+BLOCK_HEAD  = struct.Struct("<4sBBHHHHqq")
+
+def zigzag(n):
+        return((n << 1) ^ (n >> 63))
+
+def unzigzag(n):
+        return((n >> 1) ^ -(n & 1))
+
+def putVarint(buf, n):
+        while (n > 0x7f):
+                buf.append((n & 0x7f) | 0x80)
+                n >>= 7
+        buf.append(n)
+
+def getVarint(buf, pos):
+        result = 0
+        shift = 0
+        while True:
+                b = buf[pos]
+                pos += 1
+                result |= (b & 0x7f) << shift
+                if (b < 0x80): return(result, pos)
+                shift += 7
+
+# the block currently written for one series, kept in memory until it is full
+class HeadBlock:
+        __slots__ = ("name", "scaleExp", "tsCol", "valCol", "count", "firstTs", "lastTs", "lastDelta", "lastVal")
+
+        def __init__(self, name, scaleExp):
+                self.name      = name
+                self.scaleExp  = scaleExp
+                self.tsCol     = bytearray()
+                self.valCol    = bytearray()
+                self.count     = 0
+                self.firstTs   = 0
+                self.lastTs    = 0
+                self.lastDelta = 0
+                self.lastVal   = 0
+
+        def space(self):
+                return(BLOCK_SIZE - BLOCK_HEAD.size - len(self.name) - len(self.tsCol) - len(self.valCol))
+
+        # returns False when the sample does not fit anymore
+        def append(self, tsMs, intVal):
+                if (self.count == 0):
+                        self.firstTs = tsMs
+                        self.lastTs  = tsMs
+                delta = tsMs - self.lastTs
+                tsLen  = len(self.tsCol)
+                valLen = len(self.valCol)
+                putVarint(self.tsCol, zigzag(delta - self.lastDelta))
+                putVarint(self.valCol, zigzag(intVal - self.lastVal))
+                if (self.space() < 0 or self.count == 0xffff):
+                        del self.tsCol[tsLen:]
+                        del self.valCol[valLen:]
+                        return(False)
+                self.lastDelta = delta
+                self.lastTs    = tsMs
+                self.lastVal   = intVal
+                self.count    += 1
+                return(True)
+
+        def encode(self):
+                block = bytearray(BLOCK_SIZE)
+                BLOCK_HEAD.pack_into(block, 0, BLOCK_MAGIC, 1, self.scaleExp, len(self.name), self.count,
+                                     len(self.tsCol), len(self.valCol), self.firstTs, self.lastTs)
+                pos = BLOCK_HEAD.size
+                block[pos:pos + len(self.name)] = self.name
+                pos += len(self.name)
+                block[pos:pos + len(self.tsCol)] = self.tsCol
+                pos += len(self.tsCol)
+                block[pos:pos + len(self.valCol)] = self.valCol
+                return(block)
+
+# returns (series, scaleExp, count, column start, tsLen, valLen, firstTs, lastTs) or None
+def readBlockHeader(buf, offset):
+        magic, version, scaleExp, nameLen, count, tsLen, valLen, firstTs, lastTs = BLOCK_HEAD.unpack_from(buf, offset)
+        if (magic != BLOCK_MAGIC): return(None)
+        pos = offset + BLOCK_HEAD.size
+        name = bytes(buf[pos:pos + nameLen]).decode("utf-8")
+        return(name, scaleExp, count, pos + nameLen, tsLen, valLen, firstTs, lastTs)
+
+# iterate the (tsMs, value) samples of one block
+def decodeBlock(buf, offset):
+        head = readBlockHeader(buf, offset)
+        if (head is None): return
+        name, scaleExp, count, pos, tsLen, valLen, firstTs, lastTs = head
+        scale = 10 ** scaleExp
+        tsPos  = pos
+        valPos = pos + tsLen
+        ts = firstTs
+        delta = 0
+        val = 0
+        for i in range(count):
+                dod, tsPos = getVarint(buf, tsPos)
+                delta += unzigzag(dod)
+                ts += delta
+                dv, valPos = getVarint(buf, valPos)
+                val += unzigzag(dv)
+                yield (ts, val / scale)
+
+def segmentDay(fileName):
+        return(fileName[0:8])
+
+class TSStore:
+        def __init__(self, path, writer="default", retentionDays=30, flushInterval=300, scaleExp=3, clock=time.time,
+                     autoCompact=True):
+                self.path          = path
+                self.writer        = writer
+                self.retentionDays = retentionDays
+                self.flushInterval = flushInterval
+                self.scaleExp      = scaleExp
+                self.scale         = 10 ** scaleExp
+                self.clock         = clock
+                self.heads         = {}
+                self.segFile       = None
+                self.segDay        = None
+                self.lastFlush     = clock()
+                self.autoCompact   = autoCompact
+                self.compactDay    = None       # last day that started a compaction
+                self.compacting    = None       # thread of the running compaction
+                os.makedirs(path, exist_ok=True)
+
+        ############ write ############
+
+        def segmentFor(self, tsMs):
+                day = time.strftime("%Y%m%d", time.gmtime(tsMs / 1000))
+                if (day != self.segDay):
+                        if (self.segFile is not None): self.segFile.close()
+                        self.segDay  = day
+                        segPath = os.path.join(self.path, day + "-" + self.writer + ".seg")
+                        self.segFile = open(segPath, mode="ab")
+                        size = self.segFile.tell()
+                        if (size % BLOCK_SIZE):
+                                print("Cutting a torn block off", segPath, size % BLOCK_SIZE, "bytes")
+                                self.segFile.truncate(size - size % BLOCK_SIZE)
+                        self.expire()
+                        if (self.autoCompact and day > (self.compactDay or "")): self.startCompact(day, tsMs)
+                return(self.segFile)
+
+        def writeBlock(self, head):
+                if (head.count == 0): return
+                self.segmentFor(head.firstTs).write(head.encode())
+
+        def append(self, series, value, ts=None):
+                if (ts is None): ts = self.clock()
+                if (not math.isfinite(value)): return
+                tsMs = int(ts * 1000)
+                intVal = int(round(value * self.scale))
+                head = self.heads.get(series)
+                if (head is not None and head.count > 0):
+                        # a block never spans two days, retention works on whole files
+                        if (int(head.firstTs / 86400000) != int(tsMs / 86400000)):
+                                self.writeBlock(head)
+                                head = None
+                if (head is None):
+                        head = HeadBlock(series.encode("utf-8")[:255], self.scaleExp)
+                        self.heads[series] = head
+                if (not head.append(tsMs, intVal)):
+                        self.writeBlock(head)
+                        head = HeadBlock(head.name, self.scaleExp)
+                        self.heads[series] = head
+                        head.append(tsMs, intVal)
+
+        # sink interface, see sampleSink.py
+        def commit(self, ts=None):
+                if ((self.clock() - self.lastFlush) >= self.flushInterval): self.flush()
+
+        # Write all open blocks, even if they are not full yet. Keeps the SD card writes
+        # down to one burst per flushInterval, compact() merges the partial blocks later.
+        def flush(self):
+                for head in self.heads.values():
+                        self.writeBlock(head)
+                self.heads = {}
+                if (self.segFile is not None):
+                        self.segFile.flush()
+                        os.fsync(self.segFile.fileno())
+                self.lastFlush = self.clock()
+
+        def close(self):
+                self.flush()
+                if (self.segFile is not None): self.segFile.close()
+                self.segFile = None
+                self.segDay  = None
+
+        ############ maintenance ############
+
+        def segments(self):
+                return(sorted(f for f in os.listdir(self.path) if f.endswith(".seg")))
+
+        def expire(self):
+                if (not self.retentionDays): return
+                oldest = time.strftime("%Y%m%d", time.gmtime(self.clock() - self.retentionDays * 86400))
+                for fileName in self.segments():
+                        if (segmentDay(fileName) < oldest):
+                                try:
+                                        os.remove(os.path.join(self.path, fileName))
+                                except OSError:
+                                        pass    # removed by another writer
+
+        # the days before yesterday, a late block of yesterday may still come with the next flush
+        def startCompact(self, day, tsMs):
+                self.compactDay = day
+                if (self.compacting is not None and self.compacting.is_alive()): return
+                before = time.strftime("%Y%m%d", time.gmtime(tsMs / 1000 - 86400))
+                self.compacting = threading.Thread(target=self.compact, args=(before, self.writer), name="tsStore compact", daemon=True)
+                self.compacting.start()
+
+        # Merge partly filled blocks of closed days (before the day given, default today) into
+        # full blocks. writer: only the segments of this writer
+        def compact(self, before=None, writer=None):
+                if (before is None): before = time.strftime("%Y%m%d", time.gmtime(self.clock()))
+                self.expire()
+                for fileName in self.segments():
+                        if (segmentDay(fileName) >= before): continue
+                        if (writer is not None and fileName[9:-4] != writer): continue
+                        segPath = os.path.join(self.path, fileName)
+                        blocks = os.path.getsize(segPath) // BLOCK_SIZE
+                        samples = {}
+                        partial = {}            # series -> partly filled blocks, one per series is the best there is
+                        for name, scaleExp, count, first, last, offset, free in self.blockInfo(segPath):
+                                if (free > 64): partial[name] = partial.get(name, 0) + 1
+                        if (max(partial.values(), default=0) <= 1): continue
+                        for series, ts, value in self.scanFile(segPath):
+                                samples.setdefault(series, []).append((ts, value))
+                        tmpPath = segPath + ".tmp"
+                        with open(tmpPath, mode="wb") as fileObj:
+                                for series, values in samples.items():
+                                        values.sort()
+                                        head = HeadBlock(series.encode("utf-8"), self.scaleExp)
+                                        for ts, value in values:
+                                                intVal = int(round(value * self.scale))
+                                                if (not head.append(ts, intVal)):
+                                                        fileObj.write(head.encode())
+                                                        head = HeadBlock(head.name, self.scaleExp)
+                                                        head.append(ts, intVal)
+                                        if (head.count): fileObj.write(head.encode())
+                                fileObj.flush()
+                                os.fsync(fileObj.fileno())
+                        os.replace(tmpPath, segPath)
+                        print("compacted", fileName, blocks, "->", os.path.getsize(segPath) // BLOCK_SIZE, "blocks")
+
+        ############ read ############
+
+        def blockInfo(self, segPath):
+                size = os.path.getsize(segPath)
+                if (size < BLOCK_SIZE): return
+                with open(segPath, mode="rb") as fileObj:
+                        with mmap.mmap(fileObj.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                                for offset in range(0, size - BLOCK_SIZE + 1, BLOCK_SIZE):
+                                        head = readBlockHeader(buf, offset)
+                                        if (head is None): continue
+                                        name, scaleExp, count, pos, tsLen, valLen, firstTs, lastTs = head
+                                        free = BLOCK_SIZE - (pos - offset) - tsLen - valLen
+                                        yield (name, scaleExp, count, firstTs, lastTs, offset, free)
+
+        def scanFile(self, segPath, series=None, start=0, end=None):
+                size = os.path.getsize(segPath)
+                if (size < BLOCK_SIZE): return
+                with open(segPath, mode="rb") as fileObj:
+                        with mmap.mmap(fileObj.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                                for offset in range(0, size - BLOCK_SIZE + 1, BLOCK_SIZE):
+                                        head = readBlockHeader(buf, offset)
+                                        if (head is None): continue
+                                        name, scaleExp, count, pos, tsLen, valLen, firstTs, lastTs = head
+                                        if (series is not None and not series(name)): continue
+                                        if (lastTs < start or (end is not None and firstTs > end)): continue
+                                        for ts, value in decodeBlock(buf, offset):
+                                                if (ts < start or (end is not None and ts > end)): continue
+                                                yield (name, ts, value)
+
+        # Iterate (series, tsMs, value) in file order. series: exact name, a callable
+        # filter or None for all. start/end in ms since epoch. Blocks still in memory
+        # are included.
+        def query(self, series=None, start=0, end=None):
+                if (isinstance(series, str)):
+                        wanted = series
+                        series = lambda name: name == wanted
+                firstDay = time.strftime("%Y%m%d", time.gmtime(start / 1000))
+                lastDay  = time.strftime("%Y%m%d", time.gmtime(end / 1000)) if (end is not None) else "99999999"
+                for fileName in self.segments():
+                        day = segmentDay(fileName)
+                        if (day < firstDay or day > lastDay): continue
+                        yield from self.scanFile(os.path.join(self.path, fileName), series, start, end)
+                for head in list(self.heads.values()):
+                        name = head.name.decode("utf-8")
+                        if (head.count == 0 or (series is not None and not series(name))): continue
+                        buf = head.encode()
+                        for ts, value in decodeBlock(buf, 0):
+                                if (ts < start or (end is not None and ts > end)): continue
+                                yield (name, ts, value)
+
+        def seriesNames(self):
+                names = set()
+                for fileName in self.segments():
+                        for info in self.blockInfo(os.path.join(self.path, fileName)):
+                                names.add(info[0])
+                return(sorted(names))
+
+        # OpenMetrics text with timestamps (seconds), usable for backfilling
+        def export(self, fileObj, series=None, start=0, end=None):
+                count = 0
+                for name, ts, value in self.query(series, start, end):
+                        print(f"{name} {value!r} {ts / 1000:.3f}", file=fileObj)
+                        count += 1
+                print("# EOF", file=fileObj)
+                return(count)
+
+################ main ##################
+
+if __name__ == "__main__":
+        from sampleSink import parsePromLine
+
+        parser = ArgumentParser(description='Local time-series store')
+        parser.add_argument("path", type=str, help="Store directory")
+        parser.add_argument("command", choices=["stats", "series", "export", "compact", "ingest"],
+                            help="stats: segment/block usage, series: list series, export: OpenMetrics for backfill, "
+                                 "compact: merge partial blocks and apply retention, ingest: append .prom files")
+        parser.add_argument("files", nargs="*", help=".prom files for ingest")
+        parser.add_argument("-s", "--start", type=float, help="Export start, unix time in seconds", default=0)
+        parser.add_argument("-e", "--end", type=float, help="Export end, unix time in seconds", default=None)
+        parser.add_argument("-m", "--match", type=str, help="Only series starting with this prefix", default=None)
+        parser.add_argument("-w", "--writer", type=str, help="Writer name for ingest (default: ingest)", default="ingest")
+        parser.add_argument("-r", "--retention", type=int, help="Retention in days (default: 30)", default=30)
+        args = parser.parse_args()
+
+        store = TSStore(args.path, writer=args.writer, retentionDays=args.retention)
+        match = None
+        if (args.match): match = lambda name: name.startswith(args.match)
+
+        if (args.command == "stats"):
+                for fileName in store.segments():
+                        segPath = os.path.join(args.path, fileName)
+                        blocks = 0
+                        samples = 0
+                        free = 0
+                        for info in store.blockInfo(segPath):
+                                blocks += 1
+                                samples += info[2]
+                                free += info[6]
+                        used = blocks * BLOCK_SIZE
+                        print(f"{fileName}: {blocks} blocks, {samples} samples, {used / 1024:.0f} KiB, "
+                              f"{(used - free) / max(samples, 1):.2f} bytes/sample")
+        elif (args.command == "series"):
+                for name in store.seriesNames():
+                        if (match is None or match(name)): print(name)
+        elif (args.command == "export"):
+                end = args.end * 1000 if (args.end is not None) else None
+                store.export(sys.stdout, match, int(args.start * 1000), end)
+        elif (args.command == "compact"):
+                store.compact()
+        elif (args.command == "ingest"):
+                # for the shell collectors: tsStore.py /home/pi/tsdb ingest /ramdisk/MPP5048MGX.prom
+                for promFile in args.files:
+                        ts = os.path.getmtime(promFile)
+                        with open(promFile, mode="r") as fileObj:
+                                for line in fileObj:
+                                        sample = parsePromLine(line)
+                                        if (sample is not None): store.append(sample[0], sample[1], ts)
+                store.close()
+
+# End.
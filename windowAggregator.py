@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# windowAggregator.py
+# Description: keep running min, max, mean and count of selected series over a
+# fixed time window (normally the Prometheus scrape interval) and write them as
+# summary series next to the normal values in /ramdisk.
+#
+# Prometheus only sees the last value written before each scrape. Devices like the
+# Chargery BMS or the QC power meters deliver several samples per scrape interval,
+# so short peaks (inrush current, cell voltage spikes) get lost. The aggregator
+# sees every sample and exports the rollup of the last complete window.
+#
+# Output example (metric BMS_A_agg):
+# BMS_A_agg{mode="current", stat="min"} -12.3
+# BMS_A_agg{mode="current", stat="max"} 85.1
+# BMS_A_agg{mode="current", stat="mean"} 40.21
+# BMS_A_agg{mode="current", stat="count"} 15
+
+import time
+
+class WindowStats:
+        __slots__ = ("minVal", "maxVal", "total", "count")
+
+        def __init__(self):
+                self.minVal = None
+                self.maxVal = None
+                self.total  = 0.0
+                self.count  = 0
+
+        def add(self, value):
+                if (self.count == 0):
+                        self.minVal = value
+                        self.maxVal = value
+                else:
+                        if (value < self.minVal): self.minVal = value
+                        if (value > self.maxVal): self.maxVal = value
+                self.total += value
+                self.count += 1
+
+        def mean(self):
+                if (self.count == 0): return(None)
+                return(self.total / self.count)
+
+class WindowAggregator:
+        # window: length of one aggregation window in seconds, use the scrape interval
+        # modes:  list of series to aggregate, None aggregates everything passed to update()
+        def __init__(self, window=15, modes=None, clock=time.monotonic):
+                self.window  = window
+                self.modes   = modes
+                self.clock   = clock
+                self.start   = clock()
+                self.current = {}       # running window
+                self.last    = {}       # last complete window, this is what gets exported
+
+        def wants(self, mode):
+                if (self.modes is None): return(True)
+                for m in self.modes:
+                        # allow simple prefix patterns like "CellNum*"
+                        if (m.endswith("*") and mode.startswith(m[:-1])): return(True)
+                        if (m == mode): return(True)
+                return(False)
+
+        def rollover(self):
+                now = self.clock()
+                if ((now - self.start) >= self.window):
+                        self.last    = self.current
+                        self.current = {}
+                        # keep windows aligned, skip empty windows after a long gap
+                        self.start  += self.window * int((now - self.start) / self.window)
+
+        def update(self, mode, value):
+                if (not self.wants(mode)): return
+                self.rollover()
+                stats = self.current.get(mode)
+                if (stats is None):
+                        stats = WindowStats()
+                        self.current[mode] = stats
+                stats.add(float(value))
+
+        # Export the last complete window. Until the first window is complete the
+        # running window is exported so the series show up right after start.
+        # labels: extra labels for every line, e.g. ', pack="A"'
+        def write(self, fileObj, metric, labels=""):
+                self.rollover()
+                stats = self.last if (self.last) else self.current
+                for mode, s in stats.items():
+                        if (s.count == 0): continue
+                        print(f"{metric}{{mode=\"{mode}\", stat=\"min\"{labels}}} {s.minVal:g}", file=fileObj)
+                        print(f"{metric}{{mode=\"{mode}\", stat=\"max\"{labels}}} {s.maxVal:g}", file=fileObj)
+                        print(f"{metric}{{mode=\"{mode}\", stat=\"mean\"{labels}}} {s.mean():g}", file=fileObj)
+                        print(f"{metric}{{mode=\"{mode}\", stat=\"count\"{labels}}} {s.count}", file=fileObj)
+
+# End.